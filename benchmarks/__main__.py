@@ -0,0 +1,60 @@
+import argparse
+import asyncio
+import json
+import sys
+from typing import Any, Dict, List, Optional
+
+from benchmarks.harness import BENCH_DB_ENV, format_report, running_bench
+from benchmarks.scenarios import SCENARIOS
+
+
+async def run(options: argparse.Namespace) -> List[Dict[str, Any]]:
+    summaries = []
+    async with running_bench(options.song_duration, options.seed_songs) as bench:
+        for name in options.scenarios:
+            print(f"Running {name}...", file=sys.stderr)
+            for recorder in await SCENARIOS[name](bench, options):
+                summaries.append(recorder.summary())
+    return summaries
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m benchmarks",
+        description="Load test djoek against local stand-ins for its services.",
+        epilog=f"Requires {BENCH_DB_ENV} to point at a scratch Postgres database.",
+    )
+    parser.add_argument(
+        "scenarios",
+        nargs="*",
+        metavar="scenario",
+        help=f"scenarios to run: {', '.join(SCENARIOS)} (default: all)",
+    )
+    parser.add_argument("--seed-songs", type=int, default=1000)
+    parser.add_argument("--song-duration", type=float, default=180.0)
+    parser.add_argument("--listeners", type=int, default=200)
+    parser.add_argument("--users", type=int, default=20)
+    parser.add_argument("--rounds", type=int, default=10)
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=50)
+    parser.add_argument("--queue-size", type=int, default=200)
+    parser.add_argument("--adds", type=int, default=20)
+    parser.add_argument("--autoplay-seconds", type=float, default=10.0)
+    parser.add_argument("--autoplay-song-duration", type=float, default=0.2)
+    parser.add_argument("--json", help="also write the results to this file")
+    options = parser.parse_args(argv)
+
+    unknown = set(options.scenarios) - set(SCENARIOS)
+    if unknown:
+        parser.error(f"unknown scenarios: {', '.join(sorted(unknown))}")
+    options.scenarios = options.scenarios or list(SCENARIOS)
+
+    summaries = asyncio.run(run(options))
+    print(format_report(summaries))
+    if options.json:
+        with open(options.json, "w") as f:
+            json.dump(summaries, f, indent=4)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,202 @@
+import asyncio
+import logging
+import time
+from pathlib import Path
+from typing import List, Optional, Set, Tuple
+
+logger = logging.getLogger(__name__)
+
+SUBSYSTEMS = {"database", "update", "playlist", "player", "options", "mixer"}
+
+
+class FakeMPD:
+    """
+    Speaks enough of the MPD line protocol for djoek's player. Songs "play"
+    for `song_duration` seconds, the playlist is consumed as it goes.
+    """
+
+    def __init__(self, music_dir: Path, song_duration: float = 180.0) -> None:
+        self.music_dir = music_dir
+        self.song_duration = song_duration
+        self.playlist: List[Tuple[int, str]] = []
+        self.next_id = 1
+        self.state = "stop"
+        self.song_started = 0.0
+        self.database: Set[str] = set()
+        self.clients: List[Tuple[Set[str], asyncio.Event]] = []
+        self.writers: Set[asyncio.StreamWriter] = set()
+        self.played: List[Tuple[float, str]] = []
+        self.refill_latencies: List[float] = []
+        self.advanced: Optional[float] = None
+        self.server: Optional[asyncio.AbstractServer] = None
+        self.clock_task: Optional["asyncio.Task[None]"] = None
+
+    async def start(self, host: str = "127.0.0.1", port: int = 0) -> int:
+        self.database = {path.name for path in self.music_dir.iterdir()}
+        self.server = await asyncio.start_server(self.handle, host, port)
+        self.clock_task = asyncio.get_event_loop().create_task(self.clock())
+        return int(self.server.sockets[0].getsockname()[1])
+
+    async def stop(self) -> None:
+        if self.clock_task is not None:
+            self.clock_task.cancel()
+        if self.server is not None:
+            self.server.close()
+            await self.server.wait_closed()
+        for writer in self.writers:
+            writer.close()
+        while self.clients:
+            await asyncio.sleep(0.01)
+
+    def emit(self, *subsystems: str) -> None:
+        # Like MPD, remember changes per client until its next idle command.
+        for changed, event in self.clients:
+            changed.update(subsystems)
+            event.set()
+
+    def start_song(self) -> None:
+        self.song_started = time.monotonic()
+        if self.playlist:
+            self.played.append((time.monotonic(), self.playlist[0][1]))
+
+    async def clock(self) -> None:
+        while True:
+            await asyncio.sleep(min(self.song_duration / 4, 0.5))
+            if (
+                self.state == "play"
+                and self.playlist
+                and time.monotonic() - self.song_started >= self.song_duration
+            ):
+                self.playlist.pop(0)
+                self.advanced = time.monotonic()
+                if self.playlist:
+                    self.start_song()
+                else:
+                    self.state = "stop"
+                self.emit("player", "playlist")
+
+    def status(self) -> List[Tuple[str, str]]:
+        response = [
+            ("repeat", "0"),
+            ("random", "0"),
+            ("single", "0"),
+            ("consume", "1"),
+            ("playlistlength", str(len(self.playlist))),
+            ("state", self.state),
+        ]
+        if self.state == "play" and self.playlist:
+            response.append(("songid", str(self.playlist[0][0])))
+            if len(self.playlist) > 1:
+                response.append(("nextsongid", str(self.playlist[1][0])))
+        return response
+
+    async def execute(self, command: str, args: str) -> List[Tuple[str, str]]:
+        if command == "status":
+            return self.status()
+
+        if command in ("random", "repeat", "single", "consume"):
+            return []
+
+        if command == "play":
+            if self.playlist and self.state != "play":
+                self.state = "play"
+                self.start_song()
+                self.emit("player")
+            return []
+
+        if command == "addid":
+            filename = args.strip('"')
+            if filename not in self.database:
+                if not filename.startswith("http://"):
+                    raise LookupError("No such song")
+            if self.advanced is not None:
+                self.refill_latencies.append(time.monotonic() - self.advanced)
+                self.advanced = None
+            song_id = self.next_id
+            self.next_id += 1
+            self.playlist.append((song_id, filename))
+            self.emit("playlist")
+            return [("Id", str(song_id))]
+
+        if command == "playlistid":
+            song_id = int(args)
+            for playlist_song_id, filename in self.playlist:
+                if playlist_song_id == song_id:
+                    return [("file", filename), ("Id", str(song_id))]
+            raise LookupError("No such song")
+
+        if command == "update":
+            self.database = {path.name for path in self.music_dir.iterdir()}
+            self.emit("update", "database")
+            return [("updating_db", "1")]
+
+        if command == "find":
+            _, filename = args.split(" ", 1)
+            filename = filename.strip('"')
+            return [("file", filename)] if filename in self.database else []
+
+        raise LookupError(f"unknown command {command!r}")
+
+    async def handle(
+        self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        changed: Set[str] = set()
+        event = asyncio.Event()
+        client = (changed, event)
+        self.clients.append(client)
+        self.writers.add(writer)
+
+        writer.write(b"OK MPD 0.21.0\n")
+        pending: Optional[bytes] = None
+        try:
+            while True:
+                line_raw = pending if pending is not None else await reader.readline()
+                pending = None
+                if not line_raw:
+                    break
+                line = line_raw.decode("utf-8").rstrip("\n")
+                command, _, args = line.partition(" ")
+
+                if command == "noidle":
+                    continue
+
+                if command == "idle":
+                    wanted = set(args.split()) if args else SUBSYSTEMS
+                    t_readline = asyncio.ensure_future(reader.readline())
+                    while not changed & wanted and not t_readline.done():
+                        event.clear()
+                        t_event = asyncio.ensure_future(event.wait())
+                        await asyncio.wait(
+                            {t_event, t_readline}, return_when=asyncio.FIRST_COMPLETED
+                        )
+                        t_event.cancel()
+
+                    for subsystem in sorted(changed & wanted):
+                        writer.write(f"changed: {subsystem}\n".encode("utf-8"))
+                    changed.difference_update(wanted)
+                    writer.write(b"OK\n")
+                    await writer.drain()
+
+                    line_raw = await t_readline
+                    if not line_raw:
+                        break
+                    if line_raw.startswith(b"noidle"):
+                        continue
+                    pending = line_raw
+                    continue
+
+                try:
+                    response = await self.execute(command, args)
+                except LookupError as e:
+                    writer.write(f"ACK [50@0] {{{command}}} {e}\n".encode("utf-8"))
+                else:
+                    for key, value in response:
+                        writer.write(f"{key}: {value}\n".encode("utf-8"))
+                    writer.write(b"OK\n")
+                await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            self.clients.remove(client)
+            self.writers.discard(writer)
+            writer.close()
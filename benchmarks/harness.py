@@ -0,0 +1,242 @@
+import asyncio
+import os
+import statistics
+import tempfile
+import time
+from contextlib import asynccontextmanager
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional
+
+from benchmarks.fake_mpd import FakeMPD
+from benchmarks.stubs import AUDIENCE, CLIENT_ID, Auth0Stub, RealAsyncClient
+
+BENCH_DB_ENV = "DJOEK_BENCH_DB_URI"
+
+
+def configure_environment(workdir: Path) -> None:
+    """
+    Point djoek's settings at the local stand-ins. Must run before anything
+    from djoek is imported.
+    """
+    db_uri = os.environ.get(BENCH_DB_ENV)
+    if not db_uri:
+        raise SystemExit(
+            f"Set {BENCH_DB_ENV} to a scratch Postgres database, its tables "
+            "will be dropped and recreated."
+        )
+
+    music_dir = workdir / "music"
+    music_dir.mkdir(exist_ok=True)
+    os.environ.update(
+        {
+            "DJOEK_DB_URI": db_uri,
+            "DJOEK_MPD_HOST": "127.0.0.1",
+            "DJOEK_MUSIC_DIR": str(music_dir),
+            "DJOEK_STATE_PATH": "",
+            "DJOEK_AUTH0_DOMAIN": "auth0.bench",
+            "DJOEK_AUTH0_AUDIENCE": AUDIENCE,
+            "DJOEK_AUTH0_PARTIES": CLIENT_ID,
+            "DJOEK_STORAGE_BUDGET": "0",
+        }
+    )
+
+
+class Recorder:
+    def __init__(
+        self, name: str, clock: Callable[[], float] = time.perf_counter
+    ) -> None:
+        self.name = name
+        self.clock = clock
+        self.samples: List[float] = []
+        self.errors = 0
+        self.started = time.perf_counter()
+        self.finished: Optional[float] = None
+
+    @asynccontextmanager
+    async def measure(self) -> AsyncIterator[None]:
+        started = self.clock()
+        try:
+            yield
+        except Exception:
+            self.errors += 1
+            raise
+        else:
+            self.samples.append(self.clock() - started)
+
+    def stop(self) -> None:
+        self.finished = time.perf_counter()
+
+    def percentile(self, p: float) -> float:
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(len(ordered) - 1, int(len(ordered) * p / 100))]
+
+    def summary(self) -> Dict[str, Any]:
+        elapsed = (self.finished or time.perf_counter()) - self.started
+        return {
+            "name": self.name,
+            "count": len(self.samples),
+            "errors": self.errors,
+            "throughput": len(self.samples) / elapsed if elapsed else 0.0,
+            "mean_ms": statistics.mean(self.samples) * 1000 if self.samples else 0.0,
+            "p50_ms": self.percentile(50) * 1000,
+            "p90_ms": self.percentile(90) * 1000,
+            "p99_ms": self.percentile(99) * 1000,
+            "max_ms": max(self.samples) * 1000 if self.samples else 0.0,
+        }
+
+
+def format_report(summaries: List[Dict[str, Any]]) -> str:
+    header = (
+        f"{'measurement':<32} {'count':>7} {'errors':>6} {'req/s':>9} "
+        f"{'p50 ms':>9} {'p90 ms':>9} {'p99 ms':>9} {'max ms':>9}"
+    )
+    lines = [header, "-" * len(header)]
+    for s in summaries:
+        lines.append(
+            f"{s['name']:<32} {s['count']:>7} {s['errors']:>6} "
+            f"{s['throughput']:>9.1f} {s['p50_ms']:>9.2f} {s['p90_ms']:>9.2f} "
+            f"{s['p99_ms']:>9.2f} {s['max_ms']:>9.2f}"
+        )
+    return "\n".join(lines)
+
+
+class Bench:
+    """
+    Boots the djoek app in-process with uvicorn, against a fake MPD server,
+    stubbed HTTP upstreams and the scratch database.
+    """
+
+    def __init__(self, workdir: Path, song_duration: float, seed_songs: int) -> None:
+        self.workdir = workdir
+        self.song_duration = song_duration
+        self.seed_songs = seed_songs
+        self.auth0 = Auth0Stub()
+        self.base_url = ""
+        self.ws_url = ""
+        self.mpd: Optional[FakeMPD] = None
+        self.server: Any = None
+        self.server_task: Optional["asyncio.Task[None]"] = None
+        self.client = RealAsyncClient(timeout=60)
+
+    def auth_headers(self, user: int) -> Dict[str, str]:
+        return {"Authorization": f"Bearer {self.auth0.token(f'bench|{user}')}"}
+
+    def reset_database(self) -> None:
+        from peewee import fn
+
+        from benchmarks.stubs import silent_mp3
+        from djoek.models import (
+            PlayerState,
+            QueueEntry,
+            QuotaUsage,
+            Song,
+            User,
+            Vote,
+            database,
+            init_database,
+        )
+
+        models = [User, Song, QueueEntry, PlayerState, Vote, QuotaUsage]
+        init_database()
+        database.drop_tables(models)
+        database.create_tables(models)
+
+        seeder = User.create(sub="bench|seed", profile={"sub": "bench|seed"})
+        songs = [
+            Song(
+                title=f"Seed song {i}",
+                tags=["seed"],
+                search_field=fn.to_tsvector(f"seed song {i}"),
+                external_id=f"youtube:seed{i:07d}",
+                extension=".mp3",
+                preview_url=f"https://youtu.be/seed{i:07d}",
+                duration=self.song_duration,
+                user=seeder,
+            )
+            for i in range(self.seed_songs)
+        ]
+        Song.bulk_create(songs, batch_size=500)
+
+        audio = silent_mp3()
+        for song in songs:
+            song.path.write_bytes(audio)
+        database.close()
+
+    async def start(self) -> None:
+        import uvicorn
+
+        import djoek.settings as settings
+        from benchmarks import stubs
+
+        stubs.install(self.auth0)
+        self.patch_media()
+        self.reset_database()
+
+        self.mpd = FakeMPD(settings.MUSIC_DIR, self.song_duration)
+        settings.MPD_PORT = await self.mpd.start()
+
+        from djoek import app
+
+        config = uvicorn.Config(app, host="127.0.0.1", port=0, log_level="warning")
+        self.server = uvicorn.Server(config)
+        self.server.install_signal_handlers = lambda: None
+
+        self.server_task = asyncio.get_event_loop().create_task(self.server.serve())
+        while not self.server.started:
+            await asyncio.sleep(0.01)
+
+        port = self.server.servers[0].sockets[0].getsockname()[1]
+        self.base_url = f"http://127.0.0.1:{port}"
+        self.ws_url = f"ws://127.0.0.1:{port}"
+
+        # Wait until the player picked its first songs.
+        while not self.mpd.played:
+            await asyncio.sleep(0.01)
+
+    def patch_media(self) -> None:
+        """
+        Replace youtube-dl and loudgain by local file writes. Tagging still
+        runs for real with mutagen.
+        """
+        from benchmarks.stubs import silent_mp3
+        from djoek import normalize
+        from djoek.prefetch import incoming_dir
+        from djoek.providers.registry import PROVIDERS
+
+        audio = silent_mp3()
+
+        async def download(content_id: str, song: Any, prefetch: bool = False) -> None:
+            await asyncio.sleep(0.05)
+            path = incoming_dir() / song.filename if prefetch else song.path
+            path.write_bytes(audio)
+
+        async def loudgain(paths: List[Path]) -> List[Path]:
+            await asyncio.sleep(0.01 * len(paths))
+            return []
+
+        for provider in PROVIDERS.values():
+            provider.download = download  # type: ignore
+        normalize.loudgain = loudgain
+
+    async def stop(self) -> None:
+        await self.client.aclose()
+        if self.server is not None:
+            self.server.should_exit = True
+        if self.server_task is not None:
+            await self.server_task
+        if self.mpd is not None:
+            await self.mpd.stop()
+
+
+@asynccontextmanager
+async def running_bench(song_duration: float, seed_songs: int) -> AsyncIterator[Bench]:
+    with tempfile.TemporaryDirectory(prefix="djoek-bench-") as workdir:
+        configure_environment(Path(workdir))
+        bench = Bench(Path(workdir), song_duration, seed_songs)
+        await bench.start()
+        try:
+            yield bench
+        finally:
+            await bench.stop()
@@ -0,0 +1,431 @@
+import argparse
+import asyncio
+import time
+from typing import Any, Awaitable, Callable, Dict, List
+
+import websockets
+
+from benchmarks.harness import Bench, Recorder
+
+Scenario = Callable[[Bench, argparse.Namespace], Awaitable[List[Recorder]]]
+SCENARIOS: Dict[str, Scenario] = {}
+
+
+def scenario(name: str) -> Callable[[Scenario], Scenario]:
+    def register(f: Scenario) -> Scenario:
+        SCENARIOS[name] = f
+        return f
+
+    return register
+
+
+class Listeners:
+    def __init__(self, bench: Bench, count: int) -> None:
+        self.bench = bench
+        self.count = count
+        self.received = [0] * count
+        self.event = asyncio.Event()
+        self.tasks: List["asyncio.Task[None]"] = []
+        self.connections: List[websockets.WebSocketClientProtocol] = []
+
+    async def __aenter__(self) -> "Listeners":
+        for i in range(self.count):
+            ws = await websockets.connect(f"{self.bench.ws_url}/events")
+            self.connections.append(ws)
+            self.tasks.append(asyncio.get_event_loop().create_task(self.listen(i, ws)))
+        return self
+
+    async def __aexit__(self, *exc_info: object) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*[ws.close() for ws in self.connections])
+
+    async def listen(self, i: int, ws: websockets.WebSocketClientProtocol) -> None:
+        async for _ in ws:
+            self.received[i] += 1
+            self.event.set()
+
+    async def wait_all(self, since: List[int]) -> None:
+        while any(count <= seen for count, seen in zip(self.received, since)):
+            self.event.clear()
+            await self.event.wait()
+
+
+@scenario("votes")
+async def votes(bench: Bench, options: argparse.Namespace) -> List[Recorder]:
+    """
+    N websocket listeners while users keep voting on the current song.
+    """
+    storm = Recorder(f"vote storm ({options.listeners} listeners)")
+    fanout = Recorder(f"vote fan-out ({options.listeners} listeners)")
+    headers = [bench.auth_headers(user) for user in range(options.users)]
+
+    async def voter(user: int) -> None:
+        for i in range(options.rounds):
+            direction = "up" if i % 2 == 0 else "down"
+            async with storm.measure():
+                r = await bench.client.post(
+                    f"{bench.base_url}/current/vote/{direction}", headers=headers[user]
+                )
+                r.raise_for_status()
+
+    async with Listeners(bench, options.listeners) as listeners:
+        await asyncio.gather(*[voter(user) for user in range(options.users)])
+        storm.stop()
+
+        for i in range(options.rounds):
+            since = list(listeners.received)
+            direction = "up" if i % 2 == 0 else "down"
+            async with fanout.measure():
+                r = await bench.client.post(
+                    f"{bench.base_url}/current/vote/{direction}", headers=headers[0]
+                )
+                r.raise_for_status()
+                await asyncio.wait_for(listeners.wait_all(since), 10)
+        fanout.stop()
+
+    return [storm, fanout]
+
+
+@scenario("status")
+async def status(bench: Bench, options: argparse.Namespace) -> List[Recorder]:
+    """
+    Clients polling the status endpoint, anonymous and authenticated.
+    """
+    anonymous = Recorder("GET / anonymous")
+    authenticated = Recorder("GET / authenticated")
+    headers = bench.auth_headers(0)
+
+    async def poll(recorder: Recorder, headers: Dict[str, str]) -> None:
+        for _ in range(options.requests):
+            async with recorder.measure():
+                r = await bench.client.get(f"{bench.base_url}/", headers=headers)
+                r.raise_for_status()
+
+    await asyncio.gather(
+        *[poll(anonymous, {}) for _ in range(options.concurrency)],
+        *[poll(authenticated, headers) for _ in range(options.concurrency)],
+    )
+    anonymous.stop()
+    authenticated.stop()
+    return [anonymous, authenticated]
+
+
+@scenario("playlist")
+async def playlist(bench: Bench, options: argparse.Namespace) -> List[Recorder]:
+    """
+    Authenticated clients fetching a long queue, from the cached view and
+    with the view rendered again for every request.
+    """
+    from djoek import app
+    from djoek.models import QueueEntry, Song
+
+    player = app.state.player
+    repository = app.state.repository
+    cached = Recorder(f"GET /playlist/ ({options.queue_size} songs, cached)")
+    rendered = Recorder(f"GET /playlist/ ({options.queue_size} songs, rendered)")
+    render_cpu = Recorder(
+        f"cpu render playlist ({options.queue_size} songs)", clock=time.process_time
+    )
+    headers = bench.auth_headers(0)
+
+    playing = [song.id for song in (player.current_song, player.next_song) if song]
+    song_ids = await app.state.manager.execute(
+        Song.select(Song.id)
+        .where(Song.id.not_in(playing))
+        .order_by(Song.id)
+        .limit(options.queue_size)
+        .tuples()
+    )
+    for (song_id,) in song_ids:
+        await player.enqueue(song_id)
+    while len(player.queue) < len(song_ids):
+        await asyncio.sleep(0.01)
+
+    async def poll(recorder: Recorder, invalidate: bool) -> None:
+        for _ in range(options.requests):
+            async with recorder.measure():
+                if invalidate:
+                    player.views.invalidate()
+                r = await bench.client.get(
+                    f"{bench.base_url}/playlist/", headers=headers
+                )
+                r.raise_for_status()
+
+    try:
+        await asyncio.gather(*[poll(cached, False) for _ in range(options.concurrency)])
+        cached.stop()
+        await asyncio.gather(
+            *[poll(rendered, True) for _ in range(options.concurrency)]
+        )
+        rendered.stop()
+
+        for _ in range(options.requests):
+            player.views.invalidate()
+            async with render_cpu.measure():
+                player.views.get("playlist", True)
+        render_cpu.stop()
+    finally:
+        await app.state.manager.execute(QueueEntry.delete())
+        await repository.notify("update")
+
+    return [cached, rendered, render_cpu]
+
+
+@scenario("search")
+async def search(bench: Bench, options: argparse.Namespace) -> List[Recorder]:
+    """
+    Bursts of concurrent searches against the library and the providers.
+    Searches of all at once also record when their first results arrived.
+    """
+    providers = ["local", "youtube", "soundcloud", "all"]
+    recorders = {provider: Recorder(f"search {provider}") for provider in providers}
+    first_results = Recorder("search all (first results)")
+    headers = bench.auth_headers(0)
+
+    async def search_all(q: str) -> None:
+        started = time.perf_counter()
+        async with bench.client.stream(
+            "POST",
+            f"{bench.base_url}/search/",
+            json={"provider": "all", "q": q},
+            headers=headers,
+        ) as r:
+            r.raise_for_status()
+            first = True
+            async for line in r.aiter_lines():
+                if first and line.strip():
+                    first_results.samples.append(time.perf_counter() - started)
+                    first = False
+
+    async def searcher(worker: int) -> None:
+        for i in range(options.requests):
+            provider = providers[(worker + i) % len(providers)]
+            async with recorders[provider].measure():
+                if provider == "all":
+                    await search_all(f"seed {i}")
+                    continue
+                r = await bench.client.post(
+                    f"{bench.base_url}/search/",
+                    json={"provider": provider, "q": f"seed {i}"},
+                    headers=headers,
+                )
+                r.raise_for_status()
+
+    await asyncio.gather(*[searcher(worker) for worker in range(options.concurrency)])
+    for recorder in [*recorders.values(), first_results]:
+        recorder.stop()
+    return [*recorders.values(), first_results]
+
+
+@scenario("adds")
+async def adds(bench: Bench, options: argparse.Namespace) -> List[Recorder]:
+    """
+    Concurrent library additions of songs that aren't in the library yet.
+    """
+    recorder = Recorder(f"library add (x{options.adds})")
+    run = int(time.time() * 1000) % 100000
+
+    async def add(i: int) -> None:
+        async with recorder.measure():
+            r = await bench.client.post(
+                f"{bench.base_url}/library/",
+                json={"external_id": f"youtube:add{run:05d}{i:03d}", "enqueue": False},
+                headers=bench.auth_headers(i % options.users),
+            )
+            r.raise_for_status()
+
+    await asyncio.gather(*[add(i) for i in range(options.adds)])
+    recorder.stop()
+    return [recorder]
+
+
+@scenario("prefetch")
+async def prefetch(bench: Bench, options: argparse.Namespace) -> List[Recorder]:
+    """
+    A YouTube search followed by adding its top result a moment later, with
+    and without prefetching the top results of searches.
+    """
+    import djoek.settings as settings
+
+    run = int(time.time() * 1000) % 100000
+    headers = bench.auth_headers(0)
+    recorders = []
+    prefetch_results = settings.PREFETCH_RESULTS
+    try:
+        for mode, results in (("off", 0), ("on", 2)):
+            settings.PREFETCH_RESULTS = results
+            recorder = Recorder(f"search and add, prefetch {mode}")
+            for i in range(options.adds):
+                r = await bench.client.post(
+                    f"{bench.base_url}/search/",
+                    json={"provider": "youtube", "q": f"{i:02d}{mode}{run:05d}"},
+                    headers=headers,
+                )
+                r.raise_for_status()
+                await asyncio.sleep(0.5)
+                async with recorder.measure():
+                    r = await bench.client.post(
+                        f"{bench.base_url}/library/",
+                        json={"external_id": r.json()[0]["external_id"]},
+                        headers=headers,
+                    )
+                    r.raise_for_status()
+            recorder.stop()
+            recorders.append(recorder)
+    finally:
+        settings.PREFETCH_RESULTS = prefetch_results
+    return recorders
+
+
+async def ffmpeg(*args: str) -> None:
+    process = await asyncio.create_subprocess_exec(
+        "ffmpeg", "-loglevel", "error", "-y", *args
+    )
+    if await process.wait() != 0:
+        raise RuntimeError(f"ffmpeg exited with status {process.returncode}")
+
+
+@scenario("extract")
+async def extract(bench: Bench, options: argparse.Namespace) -> List[Recorder]:
+    """
+    What an add spends on the audio after youtube-dl downloaded it: the mp3
+    re-encode and tagging against keeping the native stream. Runs ffmpeg on
+    a generated Opus in WebM file of --song-duration seconds, like YouTube
+    serves.
+    """
+    from djoek.media import tag_file
+
+    source = bench.workdir / "source.webm"
+    await ffmpeg(
+        "-f",
+        "lavfi",
+        "-i",
+        f"sine=frequency=440:duration={options.song_duration}",
+        "-c:a",
+        "libopus",
+        "-b:a",
+        "160k",
+        str(source),
+    )
+
+    modes = {
+        "mp3": (".mp3", ["-c:a", "libmp3lame", "-q:a", "1"]),
+        "native": (".opus", ["-c:a", "copy"]),
+    }
+    recorders = []
+    for mode, (extension, codec_args) in modes.items():
+        recorder = Recorder(f"extract {mode} (x{options.adds})")
+        for i in range(options.adds):
+            path = bench.workdir / f"extract{i}{extension}"
+            async with recorder.measure():
+                await ffmpeg("-i", str(source), "-vn", *codec_args, str(path))
+                await tag_file(path, "extract", None)
+        recorder.stop()
+        recorders.append(recorder)
+    return recorders
+
+
+@scenario("autoplay")
+async def autoplay(bench: Bench, options: argparse.Namespace) -> List[Recorder]:
+    """
+    A long auto-play run with very short songs. Measures how quickly the
+    player refills MPD's playlist after a song ends.
+    """
+    assert bench.mpd is not None
+    recorder = Recorder("auto-play refill")
+
+    song_duration = bench.mpd.song_duration
+    bench.mpd.song_duration = options.autoplay_song_duration
+    bench.mpd.refill_latencies.clear()
+    try:
+        await asyncio.sleep(options.autoplay_seconds)
+    finally:
+        bench.mpd.song_duration = song_duration
+
+    recorder.samples = list(bench.mpd.refill_latencies)
+    recorder.stop()
+    return [recorder]
+
+
+@scenario("queries")
+async def queries(bench: Bench, options: argparse.Namespace) -> List[Recorder]:
+    """
+    The hot queries through peewee and through the asyncpg repository.
+    Records process CPU time and latency per call. Runs sequentially so the
+    process time is not shared with other requests.
+    """
+    from peewee import JOIN, fn
+
+    from djoek import app
+    from djoek.models import Song, User
+
+    manager = app.state.manager
+    repository = app.state.repository
+    song = await manager.get(Song.select().order_by(Song.id))
+    profile = {"sub": "bench|queries"}
+
+    cases: Dict[str, Dict[str, Callable[[], Awaitable[Any]]]] = {
+        "song by id": {
+            "peewee": lambda: manager.get(
+                Song.select(Song, User)
+                .join(User, JOIN.LEFT_OUTER)
+                .where(Song.id == song.id)
+            ),
+            "asyncpg": lambda: repository.song_by_id(song.id),
+        },
+        "song by file": {
+            "peewee": lambda: manager.get(
+                Song.select(Song, User)
+                .join(User, JOIN.LEFT_OUTER)
+                .where(
+                    Song.external_id == song.external_id,
+                    Song.extension == song.extension,
+                )
+            ),
+            "asyncpg": lambda: repository.song_by_file(
+                song.external_id, song.extension
+            ),
+        },
+        "song ratings": {
+            "peewee": lambda: manager.execute(
+                Song.select(
+                    Song.id, (Song.upvotes - Song.downvotes).alias("rating_")
+                ).order_by(Song.id)
+            ),
+            "asyncpg": lambda: repository.ratings(),
+        },
+        "mark played": {
+            "peewee": lambda: manager.execute(
+                Song.update(last_played=fn.NOW()).where(Song.id == song.id)
+            ),
+            "asyncpg": lambda: repository.mark_played(song.id),
+        },
+        "vote update": {
+            "peewee": lambda: manager.execute(
+                Song.update({Song.upvotes: Song.upvotes + 1}).where(Song.id == song.id)
+            ),
+            "asyncpg": lambda: repository.vote(song.id, "upvotes", 1),
+        },
+        "user upsert": {
+            "peewee": lambda: manager.execute(
+                User.insert(sub=profile["sub"], profile=profile).on_conflict(
+                    conflict_target=[User.sub], update={User.profile: profile}
+                )
+            ),
+            "asyncpg": lambda: repository.upsert_user(profile["sub"], profile),
+        },
+    }
+
+    recorders = []
+    for name, implementations in cases.items():
+        for kind, run_query in implementations.items():
+            cpu = Recorder(f"cpu {name} ({kind})", clock=time.process_time)
+            latency = Recorder(f"{name} ({kind})")
+            for _ in range(options.requests):
+                async with cpu.measure(), latency.measure():
+                    await run_query()
+            cpu.stop()
+            latency.stop()
+            recorders.extend([cpu, latency])
+    return recorders
@@ -0,0 +1,171 @@
+import base64
+import time
+from functools import partial
+from typing import Any, Dict
+
+import httpx
+import jose.jwt
+from cryptography.hazmat.backends import default_backend
+from cryptography.hazmat.primitives import serialization
+from cryptography.hazmat.primitives.asymmetric import rsa
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse
+
+KEY_ID = "bench"
+CLIENT_ID = "bench-client"
+AUDIENCE = "bench-audience"
+
+RealAsyncClient = httpx.AsyncClient
+
+
+def b64uint(value: int) -> str:
+    data = value.to_bytes((value.bit_length() + 7) // 8, "big")
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode("ascii")
+
+
+class Auth0Stub:
+    def __init__(self) -> None:
+        self.key = rsa.generate_private_key(
+            public_exponent=65537, key_size=2048, backend=default_backend()
+        )
+        self.private_pem = self.key.private_bytes(
+            serialization.Encoding.PEM,
+            serialization.PrivateFormat.PKCS8,
+            serialization.NoEncryption(),
+        )
+
+    def jwks(self) -> Dict[str, Any]:
+        numbers = self.key.public_key().public_numbers()
+        return {
+            "keys": [
+                {
+                    "kid": KEY_ID,
+                    "kty": "RSA",
+                    "alg": "RS256",
+                    "use": "sig",
+                    "n": b64uint(numbers.n),
+                    "e": b64uint(numbers.e),
+                }
+            ]
+        }
+
+    def token(self, sub: str) -> str:
+        now = int(time.time())
+        return str(
+            jose.jwt.encode(
+                {
+                    "sub": sub,
+                    "aud": AUDIENCE,
+                    "azp": CLIENT_ID,
+                    "iat": now,
+                    "exp": now + 86400,
+                },
+                self.private_pem,
+                algorithm="RS256",
+                headers={"kid": KEY_ID},
+            )
+        )
+
+
+def video_item(video_id: str) -> Dict[str, Any]:
+    return {
+        "kind": "youtube#video",
+        "id": video_id,
+        "snippet": {"title": f"Bench video {video_id}", "tags": ["bench", "stub"]},
+        "contentDetails": {"duration": "PT3M30S"},
+    }
+
+
+def build_app(auth0: Auth0Stub) -> Starlette:
+    """
+    A single ASGI app standing in for Auth0, the YouTube Data API, noembed and
+    the SoundCloud API.
+    """
+    app = Starlette()
+
+    @app.route("/.well-known/jwks.json")
+    async def jwks(request: Request) -> JSONResponse:
+        return JSONResponse(auth0.jwks())
+
+    @app.route("/userinfo")
+    async def userinfo(request: Request) -> JSONResponse:
+        token = request.headers["authorization"].split()[1]
+        claims = jose.jwt.get_unverified_claims(token)
+        return JSONResponse({"sub": claims["sub"], "nickname": claims["sub"]})
+
+    @app.route("/youtube/v3/search")
+    async def youtube_search(request: Request) -> JSONResponse:
+        q = request.query_params["q"]
+        return JSONResponse(
+            {
+                "items": [
+                    {
+                        "id": {
+                            "kind": "youtube#video",
+                            "videoId": f"{q[:8]:_<8}{i:03d}",
+                        },
+                        "snippet": {"title": f"{q} result {i}"},
+                    }
+                    for i in range(10)
+                ]
+            }
+        )
+
+    @app.route("/youtube/v3/videos")
+    async def youtube_videos(request: Request) -> JSONResponse:
+        ids = request.query_params["id"].split(",")
+        return JSONResponse({"items": [video_item(video_id) for video_id in ids]})
+
+    @app.route("/embed")
+    async def noembed(request: Request) -> JSONResponse:
+        return JSONResponse({"title": "Bench video"})
+
+    @app.route("/tracks")
+    async def soundcloud_tracks(request: Request) -> JSONResponse:
+        track_id = request.query_params["ids"]
+        return JSONResponse(
+            [
+                {
+                    "id": int(track_id),
+                    "title": f"Bench track {track_id}",
+                    "tag_list": "bench stub",
+                    "permalink_url": f"https://soundcloud.com/bench/{track_id}",
+                    "user": {"username": "bench"},
+                }
+            ]
+        )
+
+    @app.route("/search/tracks")
+    async def soundcloud_search(request: Request) -> JSONResponse:
+        q = request.query_params["q"]
+        return JSONResponse(
+            {
+                "collection": [
+                    {
+                        "id": i,
+                        "title": f"{q} track {i}",
+                        "permalink_url": f"https://soundcloud.com/bench/{i}",
+                        "full_duration": 210000,
+                        "policy": "ALLOW",
+                        "user": {"username": "bench"},
+                    }
+                    for i in range(25)
+                ]
+            }
+        )
+
+    return app
+
+
+def install(auth0: Auth0Stub) -> None:
+    """
+    Route every httpx client created by djoek to the stub app.
+    """
+    httpx.AsyncClient = partial(RealAsyncClient, app=build_app(auth0))  # type: ignore
+
+
+def silent_mp3(seconds: float = 1.0) -> bytes:
+    # MPEG-1 layer III, 128 kbit/s, 44.1 kHz frames of silence.
+    frame = b"\xff\xfb\x90\x64" + b"\x00" * 413
+    return frame * int(seconds * 44100 / 1152)
@@ -71,6 +71,41 @@ const useApi = () => {
         return data.map(transformItemSchema)
       },
 
+      async searchAll (query, onResults) {
+        // Results stream in as NDJSON, a line per source, so use fetch.
+        const token = await this.token()
+        const response = await fetch('/api/search/', {
+          method: 'POST',
+          headers: {
+            Authorization: `Bearer ${token}`,
+            'Content-Type': 'application/json',
+          },
+          body: JSON.stringify({ q: query, provider: 'all' }),
+        })
+        if (!response.ok) {
+          throw new Error(response.statusText)
+        }
+
+        const reader = response.body.getReader()
+        const decoder = new TextDecoder()
+        let buffer = ''
+        for (;;) {
+          const { done, value } = await reader.read()
+          buffer += decoder.decode(value, { stream: !done })
+          const lines = buffer.split('\n')
+          buffer = lines.pop()
+          for (const line of lines) {
+            const { provider, items } = JSON.parse(line)
+            if (items) {
+              onResults(provider, items.map(transformItemSchema))
+            }
+          }
+          if (done) {
+            return
+          }
+        }
+      },
+
       async vote (direction) {
         await this.authRequest('post', `/api/current/vote/${direction}`, null)
       },
@@ -8,8 +8,16 @@ from starlette.staticfiles import StaticFiles
 
 import djoek.settings as settings
 from djoek.api import app
+from djoek.diagnostics import setup_diagnostics, shutdown_diagnostics
+from djoek.downloader import downloader
+from djoek.media import shutdown_executor
 from djoek.models import setup_manager, shutdown_manager
 from djoek.player import setup_player, shutdown_player
+from djoek.quota import youtube_quota
+from djoek.relay import setup_relay, shutdown_relay
+from djoek.repository import setup_repository, shutdown_repository
+from djoek.segmenter import setup_segmenter, shutdown_segmenter
+from djoek.storage import setup_storage, shutdown_storage
 
 logger = logging.getLogger(__name__)
 
@@ -27,14 +35,28 @@ def fix_cookies() -> None:
 @app.on_event("startup")
 async def on_startup() -> None:
     fix_cookies()
+    await setup_diagnostics(app)
     await setup_manager(app)
+    downloader.start()
+    await setup_repository(app)
+    youtube_quota.start(app.state.repository)
     await setup_player(app)
+    await setup_relay(app)
+    await setup_segmenter(app)
+    await setup_storage(app)
 
 
 @app.on_event("shutdown")
 async def on_shutdown() -> None:
+    await shutdown_storage(app)
+    await shutdown_segmenter(app)
+    await shutdown_relay(app)
     await shutdown_player(app)
+    await shutdown_repository(app)
     await shutdown_manager(app)
+    shutdown_executor()
+    downloader.shutdown()
+    await shutdown_diagnostics(app)
 
 
 if settings.SERVE_PLAYER:
@@ -1,43 +1,81 @@
 import asyncio
 import logging
-import re
+import math
+import mimetypes
 from enum import Enum
 from pathlib import Path
-from typing import List, cast
+from typing import List, Union, cast
 
-import aiofiles
-import aiofiles.os
-import mutagen
-from fastapi import Depends, FastAPI, HTTPException
-from peewee import JOIN, DatabaseError, IntegrityError, fn
+from fastapi import Depends, FastAPI, HTTPException, Query
+from peewee import JOIN, IntegrityError
 from peewee_async import Manager
-from starlette.responses import Response
-from starlette.status import HTTP_204_NO_CONTENT, HTTP_400_BAD_REQUEST
+from starlette.requests import Request
+from starlette.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+from starlette.status import (
+    HTTP_204_NO_CONTENT,
+    HTTP_400_BAD_REQUEST,
+    HTTP_404_NOT_FOUND,
+    HTTP_503_SERVICE_UNAVAILABLE,
+)
 from starlette.websockets import WebSocket
 
 from djoek import settings
-from djoek.auth import is_authenticated, require_auth, require_user, require_user_id
+from djoek.auth import (
+    is_authenticated,
+    require_admin,
+    require_auth,
+    require_user,
+    require_user_id,
+)
+from djoek.diagnostics import profiler
+from djoek.health import Unavailable
+from djoek.library import (
+    complete_download,
+    discard_download,
+    download,
+    download_progressive,
+    file_exists,
+    partial_path,
+    read_partial,
+    search_value,
+    wait_for_song,
+)
+from djoek.metrics import WS_CLIENTS, render as render_metrics
 from djoek.models import Song, User, get_manager
-from djoek.mpdclient import MPDClient
 from djoek.player import Player, get_player
-from djoek.providers import Provider
+from djoek.prefetch import prefetcher
 from djoek.providers.registry import PROVIDERS
+from djoek.records import UserRecord
+from djoek.relay import RelayResponse, StreamRelay, get_relay
+from djoek.repository import Repository, get_repository
 from djoek.schemas import (
     ItemSchema,
     LibraryAddSchema,
     SearchRequestSchema,
     StatusSchema,
 )
-from djoek.util import send_updates
+from djoek.search import search_all
+from djoek.util import DefaultResponse
+from djoek.views import view_response
 
-app = FastAPI()
+app = FastAPI(default_response_class=DefaultResponse)
 app.state.ws_clients = []
-app.state.vote_song_id = None
-app.state.voting = set()
-app.state.votes = {}
 
 logger = logging.getLogger(__name__)
-WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+@app.exception_handler(Unavailable)
+async def unavailable(request: Request, e: Unavailable) -> Response:
+    return JSONResponse(
+        {"detail": str(e)},
+        status_code=HTTP_503_SERVICE_UNAVAILABLE,
+        headers={"Retry-After": str(math.ceil(e.retry_after))},
+    )
 
 
 class VoteDirection(Enum):
@@ -47,72 +85,20 @@ class VoteDirection(Enum):
 
 @app.get("/", response_model=StatusSchema)
 async def status(
+    request: Request,
     player: Player = Depends(get_player),
     is_authenticated: bool = Depends(is_authenticated),
-) -> StatusSchema:
-    return StatusSchema(
-        current_song=ItemSchema.from_song(
-            player.current_song, is_authenticated=is_authenticated
-        ),
-        next_song=ItemSchema.from_song(
-            player.next_song, is_authenticated=is_authenticated
-        ),
-    )
+) -> Response:
+    return view_response(request, player.views.get("status", is_authenticated))
 
 
 @app.get(
     "/playlist/", response_model=List[ItemSchema], dependencies=[Depends(require_auth)]
 )
-async def playlist_list(player: Player = Depends(get_player)) -> List[ItemSchema]:
-    return [ItemSchema.from_song(song, is_authenticated=True) for song in player.queue]
-
-
-def edge_ngrams(key: str) -> List[str]:
-    return [key[0:i] for i in range(1, len(key) + 1)]
-
-
-async def wait_for_song(song: Song) -> None:
-    async with MPDClient(settings.MPD_HOST) as mpd_client:
-        await mpd_client.execute(f"update {song.filename}")
-        while not await mpd_client.execute(f"find file {song.filename}"):
-            await mpd_client.execute("idle update")
-
-
-async def download(
-    manager: Manager,
-    provider: Provider,
-    content_id: str,
-    song: Song,
-    do_update: bool = True,
-) -> None:
-    try:
-        await aiofiles.os.stat(song.path)
-    except FileNotFoundError:
-        pass
-    else:
-        return
-
-    await provider.download(content_id, song)
-    process = await asyncio.create_subprocess_exec(
-        "loudgain", "-s", "i", str(song.path)
-    )
-    await process.communicate()
-
-    def process_metadata(song_path: Path, title: str) -> float:
-        m = mutagen.File(song_path, easy=True)
-        m["title"] = title
-        m.save()
-        return float(m.info.length)
-
-    loop = asyncio.get_event_loop()
-    try:
-        song.duration = await loop.run_in_executor(
-            None, process_metadata, song.path, song.title
-        )
-        if do_update:
-            await manager.update(song, only=["duration"])
-    except Exception:
-        logger.exception("Failed to determine song length")
+async def playlist_list(
+    request: Request, player: Player = Depends(get_player)
+) -> Response:
+    return view_response(request, player.views.get("playlist", True))
 
 
 @app.post("/library/", response_model=str)
@@ -126,74 +112,130 @@ async def playlist_add(
     provider = PROVIDERS[provider_key]
 
     metadata = await provider.get_metadata(content_id)
+    search_field = search_value(content_id, metadata)
 
-    keywords = [content_id]
-
-    for keyword in metadata.title.split():
-        keywords.append(keyword)
-        keyword = "".join(WORD_RE.findall(keyword))
-        keywords.extend([ngram for ngram in edge_ngrams(keyword) if ngram != keyword])
-
-    for tag in metadata.tags:
-        keywords.extend(edge_ngrams(tag))
-
-    search_value = fn.to_tsvector(" ".join(keywords))
-
+    # Download before touching the database so no transaction or pooled
+    # connection is held while youtube-dl, loudgain and MPD do their work.
     song: Song
+    downloaded: Song
+    try:
+        song = await manager.get(
+            Song.select(Song, User)
+            .join(User, JOIN.LEFT_OUTER)
+            .where(Song.external_id == task.external_id)
+        )
+    except Song.DoesNotExist:
+        song = Song(
+            title=metadata.title,
+            tags=metadata.tags,
+            search_field=search_field,
+            external_id=task.external_id,
+            extension=metadata.extension,
+            preview_url=metadata.preview_url,
+            duration=metadata.duration,
+            user=user,
+        )
 
-    async with manager.atomic():
-        try:
-            async with manager.atomic():
-                song = await manager.create(
-                    Song,
-                    title=metadata.title,
-                    tags=metadata.tags,
-                    search_field=search_value,
-                    external_id=task.external_id,
-                    extension=metadata.extension,
-                    preview_url=metadata.preview_url,
-                    user=user,
-                )
-                await download(manager, provider, content_id, song)
-        except IntegrityError:
-            song = await manager.get(
-                Song.select(Song, User)
-                .join(User, JOIN.LEFT_OUTER)
-                .where(Song.external_id == task.external_id)
+    downloaded = song
+    is_new = song.id is None
+
+    # Songs that are played right away can start while they download, unless
+    # they were prefetched.
+    download_task = None
+    try:
+        if (
+            settings.PROGRESSIVE_URL
+            and task.enqueue
+            and not await prefetcher.available(song)
+        ):
+            download_task = await download_progressive(
+                manager, provider, content_id, song
             )
-            song.title = metadata.title
-            song.search_field = search_value
+        else:
             await download(manager, provider, content_id, song, False)
-            await manager.update(song, only=["title", "search_field", "duration"])
 
-        try:
-            await asyncio.wait_for(wait_for_song(song), timeout=5.0)
-        except asyncio.TimeoutError:
-            logger.warning("Timed out waiting for %s", song.filename)
-            raise HTTPException(status_code=500, detail="Song did not appear")
+            try:
+                await asyncio.wait_for(wait_for_song(song), timeout=5.0)
+            except asyncio.TimeoutError:
+                logger.warning("Timed out waiting for %s", song.filename)
+                raise HTTPException(status_code=500, detail="Song did not appear")
+
+        if is_new:
+            try:
+                song.id = await manager.execute(Song.insert(**song.__data__))
+            except IntegrityError:
+                # Added by a concurrent request in the meantime.
+                song = await manager.get(
+                    Song.select(Song, User)
+                    .join(User, JOIN.LEFT_OUTER)
+                    .where(Song.external_id == task.external_id)
+                )
+    finally:
+        if song.id is None:
+            # Don't leave a file behind for a song that isn't in the library.
+            await discard_download(manager, downloaded, download_task)
+
+    if not is_new:
+        song.title = metadata.title
+        song.search_field = search_field
+        await manager.update(
+            song,
+            only=[
+                "title",
+                "search_field",
+                "extension",
+                "duration",
+                "content_hash",
+                "fingerprint",
+            ],
+        )
+
+    if download_task is not None:
+        # The task fills in the downloaded instance, which may have lost the
+        # race to be inserted.
+        downloaded.id = song.id
+        complete_download(manager, downloaded, download_task)
 
     if task.enqueue:
-        await player.enqueue(song)
+        await player.enqueue(song.id)
 
     return cast(str, song.title)
 
 
+@app.get("/progressive/{filename}", include_in_schema=False)
+async def progressive(filename: str) -> Response:
+    """
+    Serve the partial file of a progressive download for MPD to play.
+    """
+    if (
+        not settings.PROGRESSIVE_URL
+        or Path(filename).name != filename
+        or not await file_exists(partial_path(filename))
+    ):
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND)
+    media_type = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+    return StreamingResponse(read_partial(filename), media_type=media_type)
+
+
 @app.post(
     "/search/", response_model=List[ItemSchema], dependencies=[Depends(require_auth)],
 )
 async def search(
-    query: SearchRequestSchema, manager: Manager = Depends(get_manager)
-) -> List[ItemSchema]:
-    if query.provider == "local":
-        songs = await manager.execute(
-            Song.select(Song, User)
-            .join(User, JOIN.LEFT_OUTER)
-            .where(Song.search_field.match(query.q, plain=True))
+    query: SearchRequestSchema, repository: Repository = Depends(get_repository)
+) -> Union[List[ItemSchema], Response]:
+    if query.provider == "all":
+        return StreamingResponse(
+            search_all(repository, query.q), media_type="application/x-ndjson"
         )
+
+    if query.provider == "local":
+        songs = await repository.search(query.q)
         return [ItemSchema.from_song(song, is_authenticated=True) for song in songs]
 
     provider = PROVIDERS[query.provider]
-    return await provider.search(query.q)
+    items = await provider.search(query.q)
+    prefetcher.prefetch(repository, provider, items)
+    return items
 
 
 @app.post(
@@ -205,31 +247,18 @@ async def vote_up(
     direction: VoteDirection,
     user_id: int = Depends(require_user_id),
     player: Player = Depends(get_player),
-    manager: Manager = Depends(get_manager),
+    repository: Repository = Depends(get_repository),
 ) -> None:
-    if player.current_song_id is None or player.current_song is None:
-        return
-
-    if direction is VoteDirection.up:
-        field, counter_field = Song.upvotes, Song.downvotes
-    else:
-        field, counter_field = Song.downvotes, Song.upvotes
-
-    if player.current_song_id != app.state.vote_song_id:
-        app.state.vote_song_id = player.current_song_id
-        app.state.voting = set()
-        app.state.votes = {}
-
+    playlist_id = player.current_song_id
     current_song = player.current_song
-    voting = app.state.voting
-    votes = app.state.votes
-
-    # From this point on, don't trust app state to prevent race conditions
-    # due to asynchronicity.
+    if playlist_id is None or current_song is None:
+        return
 
-    current_vote = votes.get(user_id)
+    # Votes are kept per playlist position in the database, the player
+    # leader drops them when the song changes.
+    current_vote = await repository.current_vote(playlist_id, user_id)
 
-    if direction is VoteDirection.up and current_vote is not VoteDirection.down:
+    if direction is VoteDirection.up and current_vote != VoteDirection.down.value:
         if current_song.user_id is None:
             raise HTTPException(
                 status_code=HTTP_400_BAD_REQUEST, detail="Can't upvote unclaimed song.",
@@ -240,68 +269,42 @@ async def vote_up(
                 status_code=HTTP_400_BAD_REQUEST, detail="Can't upvote your own songs.",
             )
 
-    if current_vote is direction:
+    if current_vote == direction.value:
         return
 
-    if user_id in voting:
-        raise HTTPException(
-            status_code=HTTP_400_BAD_REQUEST, detail="Have some patience."
-        )
-    voting.add(user_id)
-
-    votes[user_id] = direction if current_vote is None else None
-
-    try:
-        async with manager.atomic():
-            if current_vote is not None:
-                await manager.execute(
-                    Song.update({counter_field: counter_field - 1}).where(
-                        Song.id == current_song.id
-                    )
-                )
-            else:
-                await manager.execute(
-                    Song.update({field: field + 1}).where(Song.id == current_song.id)
-                )
-    except DatabaseError:
-        votes[user_id] = current_vote
-        raise
-    finally:
-        voting.remove(user_id)
-
-    if current_vote is not None:
-        setattr(
-            current_song,
-            counter_field.name,
-            getattr(current_song, counter_field.name) - 1,
-        )
-    else:
-        setattr(current_song, field.name, getattr(current_song, field.name) + 1)
-
-    await send_updates(app.state.ws_clients)
+    counts = await repository.cast_vote(
+        playlist_id, current_song.id, user_id, direction.value
+    )
+    if counts is not None:
+        player.replace_song(current_song.with_votes(*counts))
 
 
 @app.post("/current/user", status_code=HTTP_204_NO_CONTENT, response_class=Response)
 async def claim(
     user: User = Depends(require_user),
     player: Player = Depends(get_player),
-    manager: Manager = Depends(get_manager),
+    repository: Repository = Depends(get_repository),
 ) -> None:
     current_song = player.current_song
     if current_song is not None and current_song.user_id is None:
-        await manager.execute(
-            Song.update(user_id=user.id).where(
-                Song.id == current_song.id, Song.user_id.is_null()
+        if await repository.claim(current_song.id, user.id):
+            player.replace_song(
+                current_song.with_user(UserRecord(user.id, user.sub, user.profile))
             )
-        )
-        current_song.user = user
-        await send_updates(app.state.ws_clients)
+
+
+@app.get("/stream.ogg", response_class=RelayResponse, include_in_schema=False)
+async def stream(relay: StreamRelay = Depends(get_relay)) -> RelayResponse:
+    if not settings.STREAM_URL:
+        raise HTTPException(status_code=HTTP_404_NOT_FOUND)
+    return RelayResponse(relay)
 
 
 @app.websocket("/events")
 async def websocket_endpoint(websocket: WebSocket) -> None:
     await websocket.accept()
     app.state.ws_clients.append(websocket)
+    WS_CLIENTS.inc()
     try:
         while True:
             message = await websocket.receive()
@@ -310,3 +313,40 @@ async def websocket_endpoint(websocket: WebSocket) -> None:
             await websocket.close(code=1000)
     finally:
         app.state.ws_clients.remove(websocket)
+        WS_CLIENTS.dec()
+
+
+@app.post(
+    "/diagnostics/profiler/start",
+    status_code=HTTP_204_NO_CONTENT,
+    response_class=Response,
+    dependencies=[Depends(require_admin)],
+)
+async def profiler_start(interval: float = Query(0.005, gt=0.001, le=1)) -> None:
+    profiler.start(interval)
+
+
+@app.post(
+    "/diagnostics/profiler/stop",
+    status_code=HTTP_204_NO_CONTENT,
+    response_class=Response,
+    dependencies=[Depends(require_admin)],
+)
+async def profiler_stop() -> None:
+    await profiler.stop()
+
+
+@app.get(
+    "/diagnostics/profiler",
+    response_class=PlainTextResponse,
+    dependencies=[Depends(require_admin)],
+)
+async def profiler_samples() -> PlainTextResponse:
+    return PlainTextResponse(profiler.collapsed())
+
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def metrics() -> PlainTextResponse:
+    return PlainTextResponse(
+        render_metrics(), media_type="text/plain; version=0.0.4; charset=utf-8"
+    )
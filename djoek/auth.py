@@ -15,7 +15,9 @@ from starlette.datastructures import URL
 from starlette.status import HTTP_403_FORBIDDEN
 
 import djoek.settings as settings
+from djoek.metrics import AUTH_VERIFY_LATENCY
 from djoek.models import User, get_manager
+from djoek.repository import Repository, get_repository
 
 
 class AuthenticationFailed(Exception):
@@ -85,6 +87,10 @@ class Authenticator:
         return userinfo
 
     async def verify(self, auth_header: Optional[str]) -> Dict[str, Any]:
+        with AUTH_VERIFY_LATENCY.time():
+            return await self._verify(auth_header)
+
+    async def _verify(self, auth_header: Optional[str]) -> Dict[str, Any]:
         if auth_header is None:
             raise AuthenticationFailed("no authentication provided")
 
@@ -161,6 +167,11 @@ async def require_auth(
         raise HTTPException(HTTP_403_FORBIDDEN, detail=str(e))
 
 
+async def require_admin(token: Dict[str, Any] = Depends(require_auth)) -> None:
+    if token["sub"] not in settings.ADMIN_SUBS:
+        raise HTTPException(HTTP_403_FORBIDDEN, detail="not an administrator")
+
+
 async def require_userinfo(
     auth_header: str = Depends(oauth2_scheme),
     token: Dict[str, Any] = Depends(require_auth),
@@ -172,15 +183,10 @@ async def require_userinfo(
 
 
 async def require_user_id(
-    manager: Manager = Depends(get_manager),
+    repository: Repository = Depends(get_repository),
     userinfo: Dict[str, Any] = Depends(require_userinfo),
 ) -> int:
-    user_id: int = await manager.execute(
-        User.insert(sub=userinfo["sub"], profile=userinfo).on_conflict(
-            conflict_target=[User.sub], update={User.profile: userinfo}
-        )
-    )
-    return user_id
+    return await repository.upsert_user(userinfo["sub"], userinfo)
 
 
 async def require_user(
@@ -0,0 +1,260 @@
+import argparse
+import asyncio
+import hashlib
+import logging
+import os
+import subprocess
+import sys
+from collections import defaultdict
+from pathlib import Path
+from typing import Dict, List, Optional, Set, Tuple, cast
+
+from peewee_async import Manager
+
+from djoek import settings
+from djoek.media import run_in_executor, timed
+from djoek.models import Song, database, init_database
+
+logger = logging.getLogger(__name__)
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# fpcalc -raw gives about eight 32-bit subfingerprints per second of audio.
+FINGERPRINT_MAX_OFFSET = 16
+FINGERPRINT_MIN_OVERLAP = 80
+DURATION_TOLERANCE = 5
+
+
+def hash_file(path: Path) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+async def fingerprint_file(path: Path) -> Optional[str]:
+    if not settings.FPCALC:
+        return None
+
+    process = await asyncio.create_subprocess_exec(
+        settings.FPCALC,
+        "-raw",
+        str(path),
+        stdout=subprocess.PIPE,
+        stderr=subprocess.DEVNULL,
+    )
+    data, _ = await process.communicate()
+    if process.returncode != 0:
+        logger.warning("fpcalc failed for %s", path)
+        return None
+    for line in data.decode("ascii").splitlines():
+        key, _, value = line.partition("=")
+        if key == "FINGERPRINT":
+            return value.strip() or None
+    return None
+
+
+def decode_fingerprint(fingerprint: Optional[str]) -> List[int]:
+    if not fingerprint:
+        return []
+    try:
+        return [int(value) for value in fingerprint.split(",")]
+    except ValueError:
+        return []
+
+
+def fingerprint_error(a: List[int], b: List[int]) -> float:
+    """
+    The lowest fraction of differing bits between two raw fingerprints over
+    small alignment offsets, 1.0 if they don't overlap enough to tell.
+    """
+    best = 1.0
+    for offset in range(-FINGERPRINT_MAX_OFFSET, FINGERPRINT_MAX_OFFSET + 1):
+        pairs = list(zip(a[max(offset, 0) :], b[max(-offset, 0) :]))
+        if len(pairs) < FINGERPRINT_MIN_OVERLAP:
+            continue
+        errors = sum(bin(x ^ y).count("1") for x, y in pairs)
+        best = min(best, errors / (32 * len(pairs)))
+    return best
+
+
+def similar(a: List[int], b: List[int]) -> bool:
+    return fingerprint_error(a, b) <= settings.FINGERPRINT_THRESHOLD
+
+
+async def identify(song: Song) -> None:
+    """
+    Record the content hash and acoustic fingerprint of a freshly downloaded
+    song, before normalization and tagging modify the file.
+    """
+    async with timed("identify"):
+        song.content_hash, song.fingerprint = await asyncio.gather(
+            run_in_executor(hash_file, song.path), fingerprint_file(song.path)
+        )
+
+
+def first_similar(song: Song, candidates: List[Song]) -> Optional[Song]:
+    # Runs in the executor.
+    fingerprint = decode_fingerprint(song.fingerprint)
+    for candidate in candidates:
+        if similar(fingerprint, decode_fingerprint(candidate.fingerprint)):
+            if candidate.path.exists():
+                return candidate
+    return None
+
+
+async def find_duplicate(manager: Manager, song: Song) -> Optional[Song]:
+    same_file = Song.extension == song.extension, Song.id != song.id
+
+    query = Song.select().where(Song.content_hash == song.content_hash, *same_file)
+    for original in await manager.execute(query):
+        if original.path.exists():
+            return cast(Song, original)
+
+    if song.fingerprint is None:
+        return None
+
+    # Fingerprints of different encodes of a recording differ in a few bits,
+    # so they're compared one by one with songs of about the same length.
+    query = Song.select().where(Song.fingerprint.is_null(False), *same_file)
+    if song.duration is not None:
+        duration = float(song.duration)
+        query = query.where(
+            Song.duration.is_null()
+            | Song.duration.between(
+                duration - DURATION_TOLERANCE, duration + DURATION_TOLERANCE
+            )
+        )
+    candidates = list(await manager.execute(query))
+    return cast(Optional[Song], await run_in_executor(first_similar, song, candidates))
+
+
+async def link_duplicate(manager: Manager, song: Song) -> bool:
+    """
+    Replace the file of a freshly downloaded song by a hard link to an
+    existing copy of the same content. Returns whether a duplicate was found.
+    """
+    original = await find_duplicate(manager, song)
+    if original is None:
+        return False
+
+    logger.info("%s is a duplicate of %s", song.external_id, original.external_id)
+    tmp_path = song.path.with_name(f"{song.path.name}.link")
+    os.link(original.path, tmp_path)
+    os.replace(tmp_path, song.path)
+    song.duration = original.duration
+    return True
+
+
+def fingerprint_clusters(songs: List[Song]) -> List[List[Song]]:
+    """
+    Group songs with similar fingerprints, comparing each song with the
+    clusters of songs of about the same length.
+    """
+    fingerprinted = sorted(
+        (song for song in songs if decode_fingerprint(song.fingerprint)),
+        key=lambda song: float(song.duration or 0),
+    )
+    clusters: List[Tuple[Song, List[int], List[Song]]] = []
+    for song in fingerprinted:
+        fingerprint = decode_fingerprint(song.fingerprint)
+        duration = float(song.duration or 0)
+        for first, first_fingerprint, members in clusters:
+            if (
+                first.extension == song.extension
+                and duration - float(first.duration or 0) <= DURATION_TOLERANCE
+                and similar(fingerprint, first_fingerprint)
+            ):
+                members.append(song)
+                break
+        else:
+            clusters.append((song, fingerprint, [song]))
+    return [members for _, _, members in clusters]
+
+
+def report(songs: List[Song]) -> None:
+    clusters: Dict[Tuple[str, str], List[Song]] = defaultdict(list)
+    for song in songs:
+        if song.content_hash is not None:
+            clusters[("hash", song.content_hash)].append(song)
+    for members in fingerprint_clusters(songs):
+        clusters[("fingerprint", str(members[0].id))] = members
+
+    seen: Set[Tuple[int, ...]] = set()
+    reclaimable = 0
+    for (kind, _), members in clusters.items():
+        key = tuple(sorted(song.id for song in members))
+        if len(members) < 2 or key in seen:
+            continue
+        seen.add(key)
+
+        inodes: Set[Tuple[int, int]] = set()
+        print(f"Duplicate cluster ({kind}):")
+        for song in members:
+            try:
+                stat = os.stat(song.path)
+            except FileNotFoundError:
+                print(f"  {song.external_id}  {song.title}  (missing)")
+                continue
+
+            inode = (stat.st_dev, stat.st_ino)
+            if inode in inodes:
+                state = "linked"
+            else:
+                if inodes:
+                    reclaimable += stat.st_size
+                inodes.add(inode)
+                state = f"{stat.st_size / 1024 / 1024:.1f} MiB"
+            print(f"  {song.external_id}  {song.title}  ({state})")
+
+    print(
+        f"{len(seen)} duplicate clusters, {reclaimable / 1024 / 1024:.1f} MiB reclaimable"
+    )
+
+
+async def run_report(scan: bool) -> None:
+    manager = Manager(database)
+    database.set_allow_sync(False)
+    try:
+        songs = list(await manager.execute(Song.select().order_by(Song.id)))
+
+        if scan:
+            missing = [
+                song
+                for song in songs
+                if (
+                    song.content_hash is None
+                    or (settings.FPCALC and song.fingerprint is None)
+                )
+                and song.path.exists()
+            ]
+            print(f"Scanning {len(missing)} songs")
+            for song in missing:
+                await identify(song)
+                await manager.update(song, only=["content_hash", "fingerprint"])
+    finally:
+        await manager.close()
+
+    report(songs)
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m djoek.dedupe",
+        description="Report duplicate songs and reclaimable disk space.",
+    )
+    parser.add_argument(
+        "--scan",
+        action="store_true",
+        help="compute missing content hashes and fingerprints first",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    init_database()
+    asyncio.run(run_report(args.scan))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
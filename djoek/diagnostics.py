@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import sys
+import threading
+import time
+from collections import Counter
+from types import FrameType
+from typing import Optional
+
+from fastapi import FastAPI
+
+from djoek import settings
+from djoek.metrics import Histogram
+
+logger = logging.getLogger(__name__)
+
+LOOP_LAG = Histogram(
+    "djoek_event_loop_lag_seconds",
+    "Delay between a scheduled wake-up of the event loop and the actual one.",
+)
+
+
+async def setup_diagnostics(app: FastAPI) -> None:
+    if not settings.DIAGNOSTICS:
+        return
+
+    loop = asyncio.get_event_loop()
+    loop.set_debug(True)
+    loop.slow_callback_duration = settings.SLOW_CALLBACK_DURATION
+    logging.getLogger("asyncio").setLevel(logging.WARNING)
+    app.state.lag_monitor_task = loop.create_task(monitor_loop_lag())
+
+
+async def shutdown_diagnostics(app: FastAPI) -> None:
+    await profiler.stop()
+    if settings.DIAGNOSTICS:
+        app.state.lag_monitor_task.cancel()
+
+
+async def monitor_loop_lag() -> None:
+    interval = settings.LOOP_LAG_INTERVAL
+    while True:
+        started = time.perf_counter()
+        await asyncio.sleep(interval)
+        lag = time.perf_counter() - started - interval
+        LOOP_LAG.observe(lag)
+        if lag > settings.SLOW_CALLBACK_DURATION:
+            logger.warning("Event loop lagged %.3fs behind", lag)
+
+
+def format_stack(frame: Optional[FrameType]) -> str:
+    stack = []
+    while frame is not None:
+        code = frame.f_code
+        stack.append(f"{code.co_name} ({code.co_filename}:{frame.f_lineno})")
+        frame = frame.f_back
+    return ";".join(reversed(stack))
+
+
+class SamplingProfiler:
+    """
+    Periodically samples the stack of the event loop thread from a background
+    thread. The result is in the collapsed format understood by flamegraph.pl
+    and speedscope. Nothing runs while the profiler is stopped.
+    """
+
+    _thread: Optional[threading.Thread]
+
+    def __init__(self) -> None:
+        self.samples: "Counter[str]" = Counter()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stop = threading.Event()
+
+    @property
+    def running(self) -> bool:
+        return self._thread is not None
+
+    def start(self, interval: float) -> None:
+        if self._thread is not None:
+            return
+
+        # A new event, a sampler that is still stopping keeps its own.
+        self.samples.clear()
+        self._stop = threading.Event()
+        self._thread = threading.Thread(
+            target=self._run,
+            args=(threading.get_ident(), interval, self._stop),
+            name="profiler",
+            daemon=True,
+        )
+        self._thread.start()
+
+    async def stop(self) -> None:
+        if self._thread is None:
+            return
+
+        # The sampler may be waiting for its interval to pass.
+        thread, self._thread = self._thread, None
+        self._stop.set()
+        await asyncio.get_event_loop().run_in_executor(None, thread.join)
+
+    def _run(self, thread_id: int, interval: float, stop: threading.Event) -> None:
+        while not stop.wait(interval):
+            frame = sys._current_frames().get(thread_id)
+            if frame is not None:
+                stack = format_stack(frame)
+                with self._lock:
+                    self.samples[stack] += 1
+
+    def collapsed(self) -> str:
+        with self._lock:
+            samples = list(self.samples.items())
+        return "".join(f"{stack} {count}\n" for stack, count in samples)
+
+
+profiler = SamplingProfiler()
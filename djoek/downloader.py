@@ -0,0 +1,268 @@
+import asyncio
+import logging
+import multiprocessing
+import re
+from multiprocessing.connection import Connection
+from typing import Any, Callable, Dict, List, Optional
+
+from djoek import settings
+from djoek.metrics import DOWNLOAD_BYTES
+
+logger = logging.getLogger(__name__)
+
+ProgressHook = Callable[[Dict[str, Any]], None]
+
+# The parts of youtube-dl's progress reports that are sent to the event loop.
+PROGRESS_FIELDS = (
+    "status",
+    "filename",
+    "downloaded_bytes",
+    "total_bytes",
+    "total_bytes_estimate",
+)
+WORKER_OPTIONS = {"quiet": True, "no_warnings": True, "noprogress": True}
+
+UNAVAILABLE_RE = re.compile(
+    r"unavailable|not available|private video|removed|does not exist|copyright",
+    re.IGNORECASE,
+)
+THROTTLED_RE = re.compile(r"HTTP Error 429|Too Many Requests", re.IGNORECASE)
+
+
+class DownloadError(Exception):
+    pass
+
+
+class ContentUnavailable(DownloadError):
+    """
+    The content itself can't be downloaded, for example because the video is
+    private or was removed. The site is fine.
+    """
+
+
+def is_unavailable(e: Exception) -> bool:
+    """
+    Runs in the worker processes. Whether youtube-dl failed on the content
+    rather than on the site, going by the error it raised or its message.
+    """
+    from youtube_dl.utils import GeoRestrictedError, UnavailableVideoError
+
+    message = str(e)
+    if THROTTLED_RE.search(message):
+        return False
+    exc_info = getattr(e, "exc_info", None)
+    cause = exc_info[1] if exc_info else e
+    if isinstance(cause, (GeoRestrictedError, UnavailableVideoError)):
+        return True
+    return UNAVAILABLE_RE.search(message) is not None
+
+
+def work(conn: Connection, max_jobs: int) -> None:
+    """
+    Runs in the worker processes. Loads youtube-dl and all its extractors
+    once, then runs the jobs received over the pipe until `max_jobs` are
+    done or the pipe is closed. A job either downloads, or extracts the info
+    of a URL and sends back the requested fields.
+    """
+    import youtube_dl
+    from youtube_dl.extractor import gen_extractor_classes
+
+    gen_extractor_classes()
+
+    def progress(report: Dict[str, Any]) -> None:
+        conn.send(("progress", {field: report.get(field) for field in PROGRESS_FIELDS}))
+
+    for _ in range(max_jobs):
+        try:
+            job = conn.recv()
+        except EOFError:
+            return
+        if job is None:
+            return
+
+        url, options, fields = job
+        try:
+            params = {**WORKER_OPTIONS, **options, "progress_hooks": [progress]}
+            with youtube_dl.YoutubeDL(params) as ydl:
+                if fields is None:
+                    ydl.download([url])
+                    result = None
+                else:
+                    info = ydl.extract_info(url, download=False)
+                    result = {field: info.get(field) for field in fields}
+        except Exception as e:
+            conn.send(("unavailable" if is_unavailable(e) else "error", str(e)))
+        else:
+            conn.send(("done", result))
+
+
+class Worker:
+    def __init__(self) -> None:
+        context = multiprocessing.get_context("spawn")
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(
+            target=work,
+            args=(child_conn, settings.DOWNLOAD_WORKER_JOBS),
+            name="youtube-dl",
+            daemon=True,
+        )
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+        self.broken = False
+
+    @property
+    def usable(self) -> bool:
+        return (
+            not self.broken
+            and self.jobs < settings.DOWNLOAD_WORKER_JOBS
+            and self.process.is_alive()
+        )
+
+    async def run(
+        self,
+        url: str,
+        options: Dict[str, Any],
+        fields: Optional[List[str]],
+        progress: Optional[ProgressHook],
+    ) -> Any:
+        loop = asyncio.get_event_loop()
+        done: "asyncio.Future[Any]" = loop.create_future()
+        downloaded: Dict[str, int] = {}
+
+        def on_readable() -> None:
+            while not done.done() and self.conn.poll():
+                try:
+                    kind, value = self.conn.recv()
+                except (EOFError, OSError):
+                    done.set_exception(DownloadError("youtube-dl worker died"))
+                    return
+
+                if kind == "progress":
+                    # Reported sizes are running totals per file, which start
+                    # over when youtube-dl retries a download.
+                    size = value.get("downloaded_bytes")
+                    if size is not None:
+                        filename = value.get("filename")
+                        delta = size - downloaded.get(filename, 0)
+                        if delta > 0:
+                            DOWNLOAD_BYTES.inc(delta)
+                        downloaded[filename] = size
+                    if progress is not None:
+                        progress(value)
+                elif kind == "done":
+                    done.set_result(value)
+                elif kind == "unavailable":
+                    done.set_exception(ContentUnavailable(value))
+                else:
+                    done.set_exception(DownloadError(value))
+
+        self.jobs += 1
+        loop.add_reader(self.conn.fileno(), on_readable)
+        try:
+            self.conn.send((url, options, fields))
+            return await done
+        finally:
+            loop.remove_reader(self.conn.fileno())
+            if not done.done() or done.cancelled():
+                # The worker may still be busy with the job.
+                self.broken = True
+
+    def stop(self) -> None:
+        self.conn.close()
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class DownloadPool:
+    """
+    Worker processes that keep youtube-dl loaded, so a download doesn't pay
+    for starting an interpreter and importing youtube-dl and its extractors.
+    Workers are replaced after `settings.DOWNLOAD_WORKER_JOBS` jobs and when
+    they die.
+    """
+
+    _idle: Optional["asyncio.Queue[Worker]"]
+
+    def __init__(self) -> None:
+        self._idle = None
+        self._workers: List[Worker] = []
+
+    @property
+    def idle(self) -> "asyncio.Queue[Worker]":
+        if self._idle is None:
+            self.start()
+        assert self._idle is not None
+        return self._idle
+
+    def start(self, workers: Optional[int] = None) -> None:
+        """
+        Start `workers` processes, `settings.DOWNLOAD_WORKERS` by default.
+        """
+        if self._idle is not None:
+            return
+        self._idle = asyncio.Queue()
+        for _ in range(workers or settings.DOWNLOAD_WORKERS):
+            self._idle.put_nowait(self._spawn())
+
+    def _spawn(self) -> Worker:
+        worker = Worker()
+        self._workers.append(worker)
+        return worker
+
+    def _retire(self, worker: Worker) -> Worker:
+        worker.stop()
+        self._workers.remove(worker)
+        return self._spawn()
+
+    def idle_workers(self) -> int:
+        return self.idle.qsize()
+
+    def shutdown(self) -> None:
+        for worker in self._workers:
+            worker.stop()
+        self._workers = []
+        self._idle = None
+
+    async def download(
+        self,
+        url: str,
+        options: Dict[str, Any],
+        progress: Optional[ProgressHook] = None,
+    ) -> None:
+        """
+        Download `url` with the given `youtube_dl.YoutubeDL` options. Progress
+        reports are passed to `progress` on the event loop.
+        """
+        await self.run(url, options, None, progress)
+
+    async def extract_info(
+        self, url: str, options: Dict[str, Any], fields: List[str]
+    ) -> Dict[str, Any]:
+        """
+        The given fields of the info youtube-dl extracts from `url`, without
+        downloading it.
+        """
+        info: Dict[str, Any] = await self.run(url, options, fields, None)
+        return info
+
+    async def run(
+        self,
+        url: str,
+        options: Dict[str, Any],
+        fields: Optional[List[str]],
+        progress: Optional[ProgressHook],
+    ) -> Any:
+        idle = self.idle
+        worker = await idle.get()
+        try:
+            if not worker.usable:
+                worker = self._retire(worker)
+            return await worker.run(url, options, fields, progress)
+        finally:
+            if not worker.usable:
+                worker = self._retire(worker)
+            idle.put_nowait(worker)
+
+
+downloader = DownloadPool()
@@ -0,0 +1,144 @@
+import time
+from typing import Dict, Optional, Tuple
+
+from cachetools import TTLCache
+
+from djoek import settings
+from djoek.metrics import BREAKER_OPEN, DOWNLOAD_BACKOFFS, FAST_FAILURES
+
+# Bumped whenever a breaker opens or closes, so views showing the health of
+# the providers know to render again.
+version = 0
+
+
+class Unavailable(Exception):
+    def __init__(self, message: str, retry_after: float) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ProviderUnavailable(Unavailable):
+    pass
+
+
+class DownloadBackoff(Unavailable):
+    pass
+
+
+class CircuitBreaker:
+    """
+    Fails calls right away after `settings.BREAKER_THRESHOLD` failures in a
+    row, for `settings.BREAKER_COOLDOWN` seconds. Then a single call is let
+    through to try the upstream again: if it works the breaker closes, if it
+    fails it stays open for another cooldown.
+    """
+
+    opened: Optional[float]
+
+    def __init__(self, provider: str, operation: str) -> None:
+        self.provider = provider
+        self.operation = operation
+        self.failures = 0
+        self.opened = None
+        self.trying = False
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened is not None
+
+    def check(self) -> None:
+        if self.opened is None:
+            return
+        retry_after = self.opened + settings.BREAKER_COOLDOWN - time.monotonic()
+        if self.trying or retry_after > 0:
+            FAST_FAILURES.inc(provider=self.provider, operation=self.operation)
+            raise ProviderUnavailable(
+                f"{self.provider} is failing", max(retry_after, 1.0)
+            )
+        self.trying = True
+
+    def succeeded(self) -> None:
+        self.failures = 0
+        self.trying = False
+        if self.opened is not None:
+            self.opened = None
+            self.changed()
+
+    def failed(self) -> None:
+        self.failures += 1
+        self.trying = False
+        if self.opened is not None or self.failures >= settings.BREAKER_THRESHOLD:
+            was_open = self.opened is not None
+            self.opened = time.monotonic()
+            if not was_open:
+                self.changed()
+
+    def abandoned(self) -> None:
+        # A cancelled call says nothing about the upstream.
+        self.trying = False
+
+    def changed(self) -> None:
+        global version
+        version += 1
+        BREAKER_OPEN.set(
+            int(self.is_open), provider=self.provider, operation=self.operation
+        )
+
+
+breakers: Dict[Tuple[str, str], CircuitBreaker] = {}
+
+
+def get_breaker(provider: str, operation: str) -> CircuitBreaker:
+    breaker = breakers.get((provider, operation))
+    if breaker is None:
+        breaker = breakers[(provider, operation)] = CircuitBreaker(provider, operation)
+    return breaker
+
+
+def provider_health(provider: str) -> str:
+    """
+    "down" while any of the provider's breakers is open, "up" otherwise.
+    """
+    if any(
+        breaker.is_open for (key, _), breaker in breakers.items() if key == provider
+    ):
+        return "down"
+    return "up"
+
+
+class FailedDownloads:
+    """
+    Content that failed to download, with a backoff before it is tried
+    again: `settings.DOWNLOAD_BACKOFF` seconds after the first failure,
+    doubling with every next one up to `settings.DOWNLOAD_BACKOFF_MAX`.
+    """
+
+    def __init__(self) -> None:
+        self.failures: TTLCache = TTLCache(
+            settings.DOWNLOAD_BACKOFF_SIZE, 2 * settings.DOWNLOAD_BACKOFF_MAX
+        )
+
+    def check(self, external_id: str) -> None:
+        failure = self.failures.get(external_id)
+        if failure is None:
+            return
+        _, retry_at = failure
+        retry_after = retry_at - time.monotonic()
+        if retry_after > 0:
+            DOWNLOAD_BACKOFFS.inc()
+            raise DownloadBackoff(
+                f"Downloading {external_id} failed recently", retry_after
+            )
+
+    def failed(self, external_id: str) -> None:
+        count, _ = self.failures.get(external_id, (0, 0.0))
+        backoff = min(
+            settings.DOWNLOAD_BACKOFF * 2 ** count, settings.DOWNLOAD_BACKOFF_MAX
+        )
+        self.failures[external_id] = (count + 1, time.monotonic() + backoff)
+
+    def succeeded(self, external_id: str) -> None:
+        self.failures.pop(external_id, None)
+
+
+failed_downloads = FailedDownloads()
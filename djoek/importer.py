@@ -0,0 +1,279 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import subprocess
+import sys
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Optional
+
+from peewee import SQL, fn
+from peewee_async import Manager
+
+from djoek import settings
+from djoek.dedupe import identify, link_duplicate
+from djoek.downloader import downloader
+from djoek.library import file_exists, search_value
+from djoek.media import tag_file, timed
+from djoek.metrics import STAGE_DURATION
+from djoek.models import Song, database, init_database
+from djoek.mpdclient import MPDClient
+from djoek.normalize import normalizer
+from djoek.providers import Provider
+from djoek.providers.registry import PROVIDERS
+from djoek.providers.youtube import YOUTUBE_URL_RE
+
+logger = logging.getLogger(__name__)
+
+BATCH_SIZE = 50
+
+
+class ImportStats:
+    def __init__(self) -> None:
+        self.started = time.monotonic()
+        self.resolved = 0
+        self.skipped = 0
+        self.downloaded = 0
+        self.failed = 0
+        self.imported = 0
+        self.bytes = 0
+
+    def report(self) -> str:
+        elapsed = time.monotonic() - self.started
+        return (
+            f"{self.imported}/{self.resolved} imported, {self.skipped} skipped, "
+            f"{self.failed} failed in {elapsed:.1f}s "
+            f"({self.imported / elapsed * 60:.1f} songs/min, "
+            f"{self.bytes / elapsed / 1024 / 1024:.2f} MiB/s)"
+        )
+
+
+async def expand_url(url: str) -> List[str]:
+    process = await asyncio.create_subprocess_exec(
+        "youtube-dl", "-J", "--flat-playlist", url, stdout=subprocess.PIPE,
+    )
+    data, _ = await process.communicate()
+    if process.returncode != 0:
+        logger.warning("Failed to resolve %s", url)
+        return []
+
+    info = json.loads(data)
+    entries = info.get("entries") or [info]
+
+    external_ids = []
+    for entry in entries:
+        extractor = (entry.get("ie_key") or entry.get("extractor_key") or "").lower()
+        provider_key = next((key for key in PROVIDERS if extractor == key), None)
+        if provider_key is None or not entry.get("id"):
+            logger.warning("Skipping unsupported entry %s", entry.get("url"))
+            continue
+        external_ids.append(f"{provider_key}:{entry['id']}")
+    return external_ids
+
+
+async def resolve(lines: Iterable[str]) -> List[str]:
+    external_ids: List[str] = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith("#"):
+            continue
+
+        m = YOUTUBE_URL_RE.match(line)
+        if m is not None and "list=" not in line:
+            external_ids.append(f"youtube:{m.group(1)}")
+        elif "://" not in line and line.split(":", 1)[0] in PROVIDERS:
+            external_ids.append(line)
+        else:
+            external_ids.extend(await expand_url(line))
+
+    # Remove duplicates, retain order.
+    return list(OrderedDict.fromkeys(external_ids))
+
+
+async def fetch(
+    provider: Provider, song: Song, semaphore: asyncio.Semaphore, stats: ImportStats
+) -> Optional[bool]:
+    """
+    Download a song unless its file already exists. Returns whether the song
+    was downloaded, or None if the download failed.
+    """
+    if await file_exists(song.path):
+        return False
+
+    async with semaphore:
+        try:
+            async with timed("download"):
+                await provider.download(song.content_id, song)
+        except Exception:
+            logger.exception("Failed to download %s", song.external_id)
+
+    try:
+        stats.bytes += os.stat(song.path).st_size
+    except FileNotFoundError:
+        stats.failed += 1
+        return None
+
+    stats.downloaded += 1
+    return True
+
+
+async def import_batch(
+    manager: Manager,
+    provider: Provider,
+    content_ids: List[str],
+    semaphore: asyncio.Semaphore,
+    stats: ImportStats,
+) -> None:
+    metadata = await provider.get_metadata_batch(content_ids)
+    stats.failed += len(content_ids) - len(metadata)
+
+    songs = [
+        Song(
+            title=item.title,
+            tags=item.tags,
+            search_field=search_value(content_id, item),
+            external_id=f"{provider.key}:{content_id}",
+            extension=item.extension,
+            preview_url=item.preview_url,
+            duration=item.duration,
+        )
+        for content_id, item in metadata.items()
+    ]
+
+    fetched = await asyncio.gather(
+        *[fetch(provider, song, semaphore, stats) for song in songs]
+    )
+    fresh = [song for song, status in zip(songs, fetched) if status]
+    songs = [song for song, status in zip(songs, fetched) if status is not None]
+    if not songs:
+        return
+
+    await asyncio.gather(*[identify(song) for song in fresh])
+    linked = [song for song in fresh if await link_duplicate(manager, song)]
+    pending = [song for song in songs if song not in linked]
+
+    async with timed("normalize"):
+        await normalizer.normalize_many([song.path for song in pending])
+
+    durations = await asyncio.gather(
+        *[
+            tag_file(
+                song.path,
+                song.title,
+                float(song.duration) if song.duration is not None else None,
+            )
+            for song in pending
+        ],
+        return_exceptions=True,
+    )
+    for song, duration in zip(pending, durations):
+        if isinstance(duration, BaseException):
+            logger.warning("Failed to determine length of %s", song.external_id)
+        else:
+            song.duration = duration
+
+    # Songs imported concurrently by someone else are skipped by the insert.
+    inserted = (
+        Song.insert_many(
+            [
+                {
+                    Song.title: song.title,
+                    Song.tags: song.tags,
+                    Song.search_field: song.search_field,
+                    Song.external_id: song.external_id,
+                    Song.extension: song.extension,
+                    Song.preview_url: song.preview_url,
+                    Song.duration: song.duration,
+                    Song.content_hash: song.content_hash,
+                    Song.fingerprint: song.fingerprint,
+                }
+                for song in songs
+            ]
+        )
+        .on_conflict_ignore()
+        .returning(Song.id)
+        .cte("inserted")
+    )
+    stats.imported += await manager.scalar(
+        Song.select(fn.COUNT(SQL("*"))).from_(inserted).with_cte(inserted)
+    )
+
+
+async def run_import(lines: Iterable[str], workers: int) -> None:
+    manager = Manager(database)
+    database.set_allow_sync(False)
+    stats = ImportStats()
+    semaphore = asyncio.Semaphore(workers)
+    # Every concurrent download needs a youtube-dl worker.
+    downloader.start(workers)
+
+    external_ids = await resolve(lines)
+    stats.resolved = len(external_ids)
+
+    existing = {
+        external_id
+        for external_id, in await manager.execute(
+            Song.select(Song.external_id)
+            .where(Song.external_id.in_(external_ids))
+            .tuples()
+        )
+    }
+    stats.skipped = len(existing)
+
+    by_provider: Dict[str, List[str]] = {}
+    for external_id in external_ids:
+        if external_id not in existing:
+            provider_key, content_id = external_id.split(":", 1)
+            by_provider.setdefault(provider_key, []).append(content_id)
+
+    try:
+        for provider_key, content_ids in by_provider.items():
+            provider = PROVIDERS[provider_key]
+            for i in range(0, len(content_ids), BATCH_SIZE):
+                await import_batch(
+                    manager, provider, content_ids[i : i + BATCH_SIZE], semaphore, stats
+                )
+                print(stats.report())
+
+        if stats.imported:
+            async with MPDClient(settings.MPD_HOST, settings.MPD_PORT) as mpd_client:
+                await mpd_client.execute("update")
+    finally:
+        downloader.shutdown()
+        await manager.close()
+
+    print(stats.report())
+    for (stage,), timing in STAGE_DURATION.values.items():
+        print(f"{stage}: {timing.count} runs, mean {timing.sum / timing.count:.2f}s")
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m djoek.importer",
+        description="Bulk import songs from a file of external ids or URLs.",
+    )
+    parser.add_argument(
+        "file",
+        type=argparse.FileType("r"),
+        help="file with one external id (provider:id) or URL per line, - for stdin",
+    )
+    parser.add_argument(
+        "-j",
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="number of concurrent downloads",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    init_database()
+    with args.file:
+        lines = args.file.readlines()
+    asyncio.run(run_import(lines, args.workers))
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -0,0 +1,362 @@
+import asyncio
+import logging
+import os
+import re
+import shutil
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Union
+from weakref import WeakValueDictionary
+
+import aiofiles.os
+from peewee import fn
+from peewee_async import Manager
+
+from djoek import settings
+from djoek.dedupe import identify, link_duplicate
+from djoek.health import DownloadBackoff, failed_downloads
+from djoek.media import run_in_executor, tag_file, timed
+from djoek.models import Song
+from djoek.mpdclient import MPDClient
+from djoek.normalize import normalizer
+from djoek.prefetch import prefetcher
+from djoek.providers import Provider
+from djoek.providers.registry import PROVIDERS
+from djoek.records import SongRecord
+from djoek.schemas import MetadataSchema
+
+logger = logging.getLogger(__name__)
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+PARTIAL_POLL_INTERVAL = 0.25
+
+download_locks: "WeakValueDictionary[str, asyncio.Lock]" = WeakValueDictionary()
+background_tasks: "Set[asyncio.Task[None]]" = set()
+restoring: "Dict[str, asyncio.Task[None]]" = {}
+
+
+def edge_ngrams(key: str) -> List[str]:
+    return [key[0:i] for i in range(1, len(key) + 1)]
+
+
+def search_value(content_id: str, metadata: MetadataSchema) -> Any:
+    keywords = [content_id]
+
+    for keyword in metadata.title.split():
+        keywords.append(keyword)
+        keyword = "".join(WORD_RE.findall(keyword))
+        keywords.extend([ngram for ngram in edge_ngrams(keyword) if ngram != keyword])
+
+    for tag in metadata.tags:
+        keywords.extend(edge_ngrams(tag))
+
+    return fn.to_tsvector(" ".join(keywords))
+
+
+async def file_exists(path: Path) -> bool:
+    try:
+        await aiofiles.os.stat(path)
+    except FileNotFoundError:
+        return False
+    else:
+        return True
+
+
+async def remove_file(path: Path) -> None:
+    try:
+        await aiofiles.os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def partial_path(filename: str) -> Path:
+    return settings.MUSIC_DIR / f"{filename}.part"
+
+
+async def is_downloading(song: Union[Song, SongRecord]) -> bool:
+    """
+    Whether MPD should be given the partial file of a progressive download:
+    it is still growing, or it is complete and only kept around until MPD
+    knows the complete file. Partial files that stopped growing before that
+    are left overs of a crashed worker.
+    """
+    try:
+        stat = await aiofiles.os.stat(partial_path(song.filename))
+    except FileNotFoundError:
+        return False
+    return time.time() - stat.st_mtime < settings.PROGRESSIVE_TIMEOUT or (
+        await file_exists(song.path)
+    )
+
+
+async def playlist_uri(song: SongRecord) -> str:
+    """
+    What MPD should play: djoek's URL of the partial file while the song is
+    downloaded progressively, the file in the music directory otherwise.
+    """
+    if settings.PROGRESSIVE_URL and await is_downloading(song):
+        return f"{settings.PROGRESSIVE_URL.rstrip('/')}/progressive/{song.filename}"
+    return song.filename
+
+
+async def tag_song(song: Song) -> None:
+    duration = float(song.duration) if song.duration is not None else None
+    try:
+        song.duration = await tag_file(song.path, song.title, duration)
+    except Exception:
+        logger.exception("Failed to determine song length")
+
+
+async def download(
+    manager: Manager,
+    provider: Provider,
+    content_id: str,
+    song: Song,
+    do_update: bool = True,
+) -> None:
+    async with get_download_lock(song):
+        await _download(manager, provider, content_id, song, do_update)
+
+
+def get_download_lock(song: Song) -> asyncio.Lock:
+    # Concurrent requests for the same file wait for the first download.
+    lock = download_locks.get(song.filename)
+    if lock is None:
+        lock = download_locks[song.filename] = asyncio.Lock()
+    return lock
+
+
+async def _download(
+    manager: Manager, provider: Provider, content_id: str, song: Song, do_update: bool,
+) -> None:
+    if await file_exists(song.path):
+        return
+
+    if not await prefetcher.claim(song):
+        failed_downloads.check(song.external_id)
+        try:
+            async with timed("download"):
+                await provider.download(content_id, song)
+        except asyncio.CancelledError:
+            await remove_file(song.path)
+            raise
+        except Exception:
+            failed_downloads.failed(song.external_id)
+            # Don't leave a partial file that looks like the song.
+            await remove_file(song.path)
+            raise
+        failed_downloads.succeeded(song.external_id)
+
+    await process_file(manager, song)
+
+    if do_update:
+        await manager.update(
+            song, only=["extension", "duration", "content_hash", "fingerprint"]
+        )
+
+
+async def process_file(manager: Manager, song: Song) -> None:
+    await identify(song)
+    if not await link_duplicate(manager, song):
+        async with timed("normalize"):
+            await normalizer.normalize(song.path)
+        await tag_song(song)
+
+
+async def download_progressive(
+    manager: Manager, provider: Provider, content_id: str, song: Song
+) -> "asyncio.Task[None]":
+    """
+    Start downloading the song to its partial file, which djoek serves to
+    MPD while it grows. Returns as soon as there is enough to start playing,
+    with the task that finishes the download and processes the file. Pass
+    that task on to `complete_download` once the song is in the database.
+    """
+    loop = asyncio.get_event_loop()
+    playable = loop.create_future()
+    task = loop.create_task(
+        _download_progressive(manager, provider, content_id, song, playable)
+    )
+    await playable
+    return task
+
+
+async def _download_progressive(
+    manager: Manager,
+    provider: Provider,
+    content_id: str,
+    song: Song,
+    playable: "asyncio.Future[None]",
+) -> None:
+    async with get_download_lock(song):
+        if await file_exists(song.path):
+            playable.set_result(None)
+            return
+
+        part_path = partial_path(song.filename)
+        try:
+            failed_downloads.check(song.external_id)
+            async with timed("download"):
+                async with aiofiles.open(part_path, "wb") as f:
+                    size = 0
+                    async for chunk in provider.stream(content_id, song):
+                        await f.write(chunk)
+                        await f.flush()
+                        size += len(chunk)
+                        if (
+                            size >= settings.PROGRESSIVE_MIN_BYTES
+                            and not playable.done()
+                        ):
+                            playable.set_result(None)
+
+            # Normalizing and tagging rewrite the file, so they work on a copy
+            # while the partial file is still being played. Readers of the
+            # partial file stop once the copy is in place.
+            tmp_path = song.path.with_name(f"{song.filename}.tmp")
+            await run_in_executor(shutil.copyfile, part_path, tmp_path)
+            os.replace(tmp_path, song.path)
+        except asyncio.CancelledError:
+            await remove_file(part_path)
+            playable.cancel()
+            raise
+        except Exception as e:
+            if not isinstance(e, DownloadBackoff):
+                failed_downloads.failed(song.external_id)
+            await remove_file(part_path)
+            if playable.done():
+                raise
+            playable.set_exception(e)
+            return
+
+        failed_downloads.succeeded(song.external_id)
+        if not playable.done():
+            playable.set_result(None)
+        await process_file(manager, song)
+
+
+def complete_download(
+    manager: Manager, song: Song, download_task: "asyncio.Task[None]"
+) -> None:
+    """
+    In the background, wait for a progressive download to finish, store what
+    was learned about the file and retire the partial file once MPD knows
+    the complete one.
+    """
+    task = asyncio.get_event_loop().create_task(
+        _complete_download(manager, song, download_task)
+    )
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+
+
+async def _complete_download(
+    manager: Manager, song: Song, download_task: "asyncio.Task[None]"
+) -> None:
+    try:
+        await download_task
+        await manager.update(
+            song, only=["extension", "duration", "content_hash", "fingerprint"]
+        )
+        await asyncio.wait_for(wait_for_song(song), timeout=5.0)
+    except Exception:
+        logger.exception("Failed to complete the download of %s", song.external_id)
+    finally:
+        await remove_file(partial_path(song.filename))
+
+
+async def discard_download(
+    manager: Manager, song: Song, download_task: Optional["asyncio.Task[None]"]
+) -> None:
+    """
+    Stop the download of a song that didn't make it into the database and
+    remove its file, unless a concurrent request added the song after all.
+    """
+    if download_task is not None:
+        download_task.cancel()
+        await asyncio.gather(download_task, return_exceptions=True)
+
+    try:
+        added = await manager.count(
+            Song.select().where(Song.external_id == song.external_id)
+        )
+    except Exception:
+        logger.exception("Failed to check whether %s was added", song.external_id)
+        return
+    if not added:
+        await remove_file(song.path)
+
+
+async def read_partial(filename: str) -> AsyncIterator[bytes]:
+    """
+    Yield the partial file of a progressive download as it grows, until the
+    complete file is in place or the download fails or stalls.
+    """
+    path = settings.MUSIC_DIR / filename
+    part_path = partial_path(filename)
+    async with aiofiles.open(part_path, "rb") as f:
+        idle = 0.0
+        finished = False
+        while True:
+            chunk = await f.read(65536)
+            if chunk:
+                idle = 0.0
+                yield chunk
+            elif finished:
+                break
+            elif (
+                await file_exists(path)
+                or not await file_exists(part_path)
+                or idle >= settings.PROGRESSIVE_TIMEOUT
+            ):
+                # Read whatever was written since the last read.
+                finished = True
+            else:
+                await asyncio.sleep(PARTIAL_POLL_INTERVAL)
+                idle += PARTIAL_POLL_INTERVAL
+
+
+async def is_available(song: SongRecord) -> bool:
+    """
+    Whether MPD can be given the song now: its file is in the music directory
+    or it is being downloaded progressively.
+    """
+    return await file_exists(song.path) or await is_downloading(song)
+
+
+def restore_evicted(manager: Manager, song: SongRecord) -> None:
+    """
+    In the background, download the file of a song again that was evicted
+    from the music directory, unless that is already going.
+    """
+    if song.filename in restoring:
+        return
+    task = asyncio.get_event_loop().create_task(_restore_evicted(manager, song))
+    restoring[song.filename] = task
+    task.add_done_callback(lambda _: restoring.pop(song.filename, None))
+
+
+async def _restore_evicted(manager: Manager, song: SongRecord) -> None:
+    logger.info("Downloading evicted song %s", song.external_id)
+    try:
+        model = await manager.get(Song, id=song.id)
+        provider = PROVIDERS[song.provider]
+        if settings.PROGRESSIVE_URL:
+            download_task = await download_progressive(
+                manager, provider, song.content_id, model
+            )
+            complete_download(manager, model, download_task)
+        else:
+            # Updating MPD's database wakes up the player leader.
+            await download(manager, provider, song.content_id, model)
+            await asyncio.wait_for(wait_for_song(model), timeout=5.0)
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        logger.exception("Failed to download evicted song %s", song.external_id)
+
+
+async def wait_for_song(song: Song) -> None:
+    async with MPDClient(settings.MPD_HOST, settings.MPD_PORT) as mpd_client:
+        await mpd_client.execute(f"update {song.filename}")
+        while not await mpd_client.execute(f"find file {song.filename}"):
+            await mpd_client.execute("idle update")
@@ -0,0 +1,155 @@
+import asyncio
+import logging
+import os
+import subprocess
+import time
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import asynccontextmanager
+from functools import partial
+from pathlib import Path
+from typing import Any, AsyncIterator, Callable, List, Optional, TypeVar
+
+import mutagen
+
+from djoek import settings
+from djoek.metrics import STAGE_DURATION
+
+logger = logging.getLogger(__name__)
+
+T = TypeVar("T")
+
+_executor: Optional[Executor] = None
+
+
+@asynccontextmanager
+async def timed(stage: str) -> AsyncIterator[None]:
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        duration = time.perf_counter() - started
+        STAGE_DURATION.observe(duration, stage=stage)
+        logger.debug("Stage %s took %.3fs", stage, duration)
+
+
+def get_executor() -> Executor:
+    global _executor
+    if _executor is None:
+        if settings.MEDIA_EXECUTOR == "process":
+            _executor = ProcessPoolExecutor(max_workers=settings.MEDIA_WORKERS)
+        else:
+            _executor = ThreadPoolExecutor(
+                max_workers=settings.MEDIA_WORKERS, thread_name_prefix="media"
+            )
+    return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False)
+        _executor = None
+
+
+async def run_in_executor(func: Callable[..., T], *args: Any) -> T:
+    loop = asyncio.get_event_loop()
+    return await loop.run_in_executor(get_executor(), partial(func, *args))
+
+
+def process_metadata(song_path: Path, title: str) -> float:
+    m = mutagen.File(song_path, easy=True)
+    m["title"] = title
+    m.save()
+    return float(m.info.length)
+
+
+def tag_title(song_path: Path, title: str) -> None:
+    m = mutagen.File(song_path, easy=True)
+    m["title"] = title
+    m.save()
+
+
+async def probe_duration(path: Path) -> Optional[float]:
+    process = await asyncio.create_subprocess_exec(
+        "ffprobe",
+        "-v",
+        "error",
+        "-show_entries",
+        "format=duration",
+        "-of",
+        "default=noprint_wrappers=1:nokey=1",
+        str(path),
+        stdout=subprocess.PIPE,
+    )
+    data, _ = await process.communicate()
+    try:
+        return float(data.strip())
+    except ValueError:
+        return None
+
+
+async def tag_file(path: Path, title: str, duration: Optional[float]) -> float:
+    """
+    Write the title tag and return the song's duration, obtained from the
+    source configured by `settings.DURATION_SOURCE`.
+    """
+    if settings.DURATION_SOURCE == "mutagen" or (
+        settings.DURATION_SOURCE == "metadata" and duration is None
+    ):
+        async with timed("tag"):
+            return await run_in_executor(process_metadata, path, title)
+
+    async with timed("tag"):
+        await run_in_executor(tag_title, path, title)
+
+    if settings.DURATION_SOURCE == "ffprobe":
+        async with timed("probe"):
+            duration = await probe_duration(path)
+        if duration is None:
+            raise ValueError(f"ffprobe could not determine the length of {path}")
+
+    assert duration is not None
+    return duration
+
+
+async def pipe_output(*commands: List[str]) -> AsyncIterator[bytes]:
+    """
+    Run the commands as a shell-style pipeline and yield the output of the
+    last one as it comes in.
+    """
+    processes: List[asyncio.subprocess.Process] = []
+    stdin: Optional[int] = None
+    try:
+        for i, command in enumerate(commands):
+            last = i == len(commands) - 1
+            read_fd, write_fd = (None, subprocess.PIPE) if last else os.pipe()
+            try:
+                process = await asyncio.create_subprocess_exec(
+                    *command, stdin=stdin, stdout=write_fd
+                )
+            finally:
+                if stdin is not None:
+                    os.close(stdin)
+                if not last:
+                    os.close(write_fd)
+            processes.append(process)
+            stdin = read_fd
+
+        stdout = processes[-1].stdout
+        assert stdout is not None
+        while True:
+            chunk = await stdout.read(65536)
+            if not chunk:
+                break
+            yield chunk
+
+        for command, process in zip(commands, processes):
+            if await process.wait() != 0:
+                raise RuntimeError(
+                    f"{command[0]} exited with status {process.returncode}"
+                )
+    finally:
+        for process in processes:
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
@@ -0,0 +1,247 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Dict, Iterator, List, Sequence, Tuple
+
+LabelValues = Tuple[str, ...]
+
+DEFAULT_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+    300.0,
+)
+
+registry: List["Metric"] = []
+
+
+def format_labels(names: Sequence[str], values: Sequence[str]) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(
+        '{}="{}"'.format(
+            name, value.replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"),
+        )
+        for name, value in zip(names, values)
+    )
+    return f"{{{pairs}}}"
+
+
+def format_value(value: float) -> str:
+    if value == float("inf"):
+        return "+Inf"
+    return repr(float(value))
+
+
+class Metric:
+    type: str
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(labels)
+        registry.append(self)
+
+    def label_values(self, labels: Dict[str, str]) -> LabelValues:
+        return tuple(str(labels[name]) for name in self.label_names)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for name, labels, value in self.samples():
+            lines.append(f"{name}{labels} {format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self.label_values(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for key, value in self.values.items():
+            yield f"{self.name}_total", format_labels(self.label_names, key), value
+
+
+class Gauge(Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, labels: Sequence[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values: Dict[LabelValues, float] = {}
+
+    def set(self, value: float, **labels: str) -> None:
+        self.values[self.label_values(labels)] = value
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self.label_values(labels)
+        self.values[key] = self.values.get(key, 0.0) + amount
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        for key, value in self.values.items():
+            yield self.name, format_labels(self.label_names, key), value
+
+
+class HistogramValue:
+    def __init__(self, bucket_count: int) -> None:
+        self.buckets = [0] * bucket_count
+        self.count = 0
+        self.sum = 0.0
+
+
+class Histogram(Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labels: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(buckets) + (float("inf"),)
+        self.values: Dict[LabelValues, HistogramValue] = {}
+
+    def get(self, **labels: str) -> HistogramValue:
+        key = self.label_values(labels)
+        value = self.values.get(key)
+        if value is None:
+            value = self.values[key] = HistogramValue(len(self.buckets))
+        return value
+
+    def observe(self, amount: float, **labels: str) -> None:
+        value = self.get(**labels)
+        value.buckets[bisect_left(self.buckets, amount)] += 1
+        value.count += 1
+        value.sum += amount
+
+    @contextmanager
+    def time(self, **labels: str) -> Iterator[None]:
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def samples(self) -> Iterator[Tuple[str, str, float]]:
+        bucket_label_names = self.label_names + ("le",)
+        for key, value in self.values.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets, value.buckets):
+                cumulative += count
+                yield (
+                    f"{self.name}_bucket",
+                    format_labels(bucket_label_names, key + (format_value(bound),)),
+                    cumulative,
+                )
+            labels = format_labels(self.label_names, key)
+            yield f"{self.name}_count", labels, value.count
+            yield f"{self.name}_sum", labels, value.sum
+
+
+def render() -> str:
+    return "\n".join(metric.render() for metric in registry) + "\n"
+
+
+MPD_COMMAND_LATENCY = Histogram(
+    "djoek_mpd_command_seconds", "MPD command latency.", ["command"]
+)
+DB_QUERY_LATENCY = Histogram(
+    "djoek_db_query_seconds", "Database query latency.", ["query"]
+)
+DB_POOL_WAIT = Histogram(
+    "djoek_db_pool_wait_seconds",
+    "Time spent waiting for a pooled connection.",
+    ["pool"],
+)
+DB_POOL_IN_USE = Gauge(
+    "djoek_db_pool_connections_in_use",
+    "Pooled connections currently handed out.",
+    ["pool"],
+)
+PROVIDER_LATENCY = Histogram(
+    "djoek_provider_request_seconds",
+    "Provider request latency.",
+    ["provider", "operation"],
+)
+PROVIDER_ERRORS = Counter(
+    "djoek_provider_errors", "Failed provider requests.", ["provider", "operation"]
+)
+BREAKER_OPEN = Gauge(
+    "djoek_provider_breaker_open",
+    "Whether the circuit breaker of a provider operation is open.",
+    ["provider", "operation"],
+)
+FAST_FAILURES = Counter(
+    "djoek_provider_fast_failures",
+    "Provider requests failed right away by an open circuit breaker.",
+    ["provider", "operation"],
+)
+DOWNLOAD_BACKOFFS = Counter(
+    "djoek_download_backoffs", "Downloads refused because they failed recently."
+)
+STAGE_DURATION = Histogram(
+    "djoek_media_stage_seconds", "Duration of media processing stages.", ["stage"]
+)
+QUOTA_SPENT = Counter("djoek_quota_units", "API quota units spent.", ["service"])
+QUOTA_REMAINING = Gauge(
+    "djoek_quota_remaining", "API quota units left for today.", ["service"]
+)
+YOUTUBE_LOOKUPS = Counter(
+    "djoek_youtube_lookups",
+    "YouTube searches and metadata lookups by what answered them.",
+    ["operation", "source"],
+)
+DOWNLOAD_BYTES = Counter("djoek_download_bytes", "Bytes downloaded by youtube-dl.")
+PREFETCHES = Counter(
+    "djoek_prefetches", "Speculative downloads of search results.", ["outcome"]
+)
+PREFETCH_ADDS = Counter(
+    "djoek_prefetch_adds",
+    "Library additions by whether a prefetch had the song already.",
+    ["result"],
+)
+PREFETCH_WASTED_BYTES = Counter(
+    "djoek_prefetch_wasted_bytes", "Bytes of prefetched songs deleted unused."
+)
+WS_CLIENTS = Gauge("djoek_websocket_clients", "Connected websocket clients.")
+BROADCAST_LATENCY = Histogram(
+    "djoek_broadcast_seconds", "Time to send an update to all websocket clients."
+)
+AUTH_VERIFY_LATENCY = Histogram(
+    "djoek_auth_verify_seconds", "Time spent verifying access tokens."
+)
+NEXT_SONG_LATENCY = Histogram(
+    "djoek_next_song_seconds", "Time spent selecting the next song."
+)
+STREAM_LISTENERS = Gauge("djoek_stream_listeners", "Listeners of the stream relay.")
+STREAM_DROPPED = Counter(
+    "djoek_stream_dropped_listeners", "Stream listeners dropped for falling behind."
+)
@@ -1,34 +1,85 @@
 from base64 import urlsafe_b64encode
 from pathlib import Path
-from typing import Optional, cast
+from typing import Any, Dict, Optional, cast
 
 from fastapi import FastAPI
 from peewee import (
     SQL,
     AutoField,
+    CompositeKey,
+    DateField,
+    DateTimeField,
     DecimalField,
     ForeignKeyField,
     IntegerField,
     Model,
     TextField,
 )
-from peewee_async import Manager
+from peewee_async import AsyncPostgresqlConnection, Manager
 from peewee_asyncext import PooledPostgresqlExtDatabase
 from playhouse.postgres_ext import ArrayField, JSONField, TSVectorField
 from psycopg2._psycopg import parse_dsn
 from starlette.requests import Request
 
 from djoek import settings
+from djoek.metrics import DB_POOL_IN_USE, DB_POOL_WAIT, DB_QUERY_LATENCY
 
 database = PooledPostgresqlExtDatabase(None)
 
 
-async def setup_manager(app: FastAPI) -> None:
+def init_database(**kwargs: Any) -> None:
     db_config = parse_dsn(settings.DB_URI)
     db_name = db_config.pop("dbname")
+    db_config.update(kwargs)
     database.init(db_name, **db_config)
+
+
+class InstrumentedConnection(AsyncPostgresqlConnection):
+    async def acquire(self) -> Any:
+        with DB_POOL_WAIT.time(pool="peewee"):
+            conn = await super().acquire()
+        DB_POOL_IN_USE.inc(pool="peewee")
+        return conn
+
+    def release(self, conn: Any) -> None:
+        super().release(conn)
+        DB_POOL_IN_USE.dec(pool="peewee")
+
+
+class InstrumentedManager(Manager):
+    async def execute(self, query: Any) -> Any:
+        with DB_QUERY_LATENCY.time(query=type(query).__name__):
+            return await super().execute(query)
+
+
+def pool_options() -> Dict[str, Any]:
+    """
+    Options for the async connection pool. These are not understood by the
+    synchronous connections used by the command line tools.
+    """
+    # The asyncpg repository has a pool of its own.
+    max_connections = max(
+        settings.DB_MAX_CONNECTIONS - settings.DB_REPOSITORY_CONNECTIONS, 1
+    )
+    options: Dict[str, Any] = {
+        "min_connections": min(settings.DB_MIN_CONNECTIONS, max_connections),
+        "max_connections": max_connections,
+        "connection_timeout": settings.DB_CONNECTION_TIMEOUT,
+        "pool_recycle": settings.DB_POOL_RECYCLE,
+    }
+    if settings.DB_STATEMENT_TIMEOUT:
+        server_options = parse_dsn(settings.DB_URI).get("options", "")
+        options["options"] = (
+            f"{server_options} -c statement_timeout={settings.DB_STATEMENT_TIMEOUT}"
+        ).strip()
+    return options
+
+
+async def setup_manager(app: FastAPI) -> None:
+    init_database(**pool_options())
+    database._async_conn_cls = InstrumentedConnection
     database.set_allow_sync(False)
-    app.state.manager = Manager(database)
+    app.state.manager = InstrumentedManager(database)
 
 
 async def shutdown_manager(app: FastAPI) -> None:
@@ -39,6 +90,20 @@ async def get_manager(request: Request) -> Manager:
     return request.app.state.manager
 
 
+def song_filename(external_id: str, extension: str) -> str:
+    basename = (
+        urlsafe_b64encode(external_id.encode("utf-8")).rstrip(b"=").decode("utf-8")
+    )
+    return f"{basename}{extension}"
+
+
+def format_username(user: Any) -> Optional[str]:
+    if user is not None:
+        return settings.USER_FORMAT.format(user=user)
+    else:
+        return None
+
+
 class User(Model):
     class Meta:
         database = database
@@ -62,15 +127,13 @@ class Song(Model):
     user = ForeignKeyField(User, null=True)
     upvotes = IntegerField(default=0, constraints=[SQL("DEFAULT 0")])
     downvotes = IntegerField(default=0, constraints=[SQL("DEFAULT 0")])
+    content_hash = TextField(null=True, index=True)
+    fingerprint = TextField(null=True)
+    last_played = DateTimeField(null=True)
 
     @property
     def filename(self) -> str:
-        basename = (
-            urlsafe_b64encode(self.external_id.encode("utf-8"))
-            .rstrip(b"=")
-            .decode("utf-8")
-        )
-        return f"{basename}{self.extension}"
+        return song_filename(self.external_id, self.extension)
 
     @property
     def path(self) -> Path:
@@ -86,12 +149,76 @@ class Song(Model):
 
     @property
     def username(self) -> Optional[str]:
-        if self.user is not None:
-            return settings.USER_FORMAT.format(user=self.user)
-        else:
-            return None
+        return format_username(self.user)
 
     @property
     def rating(self) -> int:
         rating: int = self.upvotes - self.downvotes
         return rating
+
+
+class QueueEntry(Model):
+    class Meta:
+        database = database
+        table_name = "queue_entry"
+
+    id = AutoField()
+    song = ForeignKeyField(Song, unique=True, on_delete="CASCADE")
+
+
+class PlayerState(Model):
+    """
+    What the player leader last saw playing in MPD. There is a single row,
+    with id 1.
+    """
+
+    class Meta:
+        database = database
+        table_name = "player_state"
+
+    id = IntegerField(primary_key=True)
+    current_playlist_id = IntegerField(null=True)
+    current_song = ForeignKeyField(Song, null=True, on_delete="SET NULL", backref="+")
+    next_playlist_id = IntegerField(null=True)
+    next_song = ForeignKeyField(Song, null=True, on_delete="SET NULL", backref="+")
+
+
+class Vote(Model):
+    class Meta:
+        database = database
+        primary_key = CompositeKey("playlist_id", "user")
+
+    playlist_id = IntegerField()
+    user = ForeignKeyField(User, on_delete="CASCADE")
+    direction = TextField()
+
+
+class QuotaUsage(Model):
+    """
+    Units of a daily API quota spent per day, by all workers together.
+    """
+
+    class Meta:
+        database = database
+        table_name = "quota_usage"
+        primary_key = CompositeKey("service", "day")
+
+    service = TextField()
+    day = DateField()
+    units = IntegerField()
+
+
+class SchemaMigration(Model):
+    """
+    Migrations run by migrate.py. A data migration that is still going has a
+    row without `completed`, its checkpoint is the last song id it handled.
+    """
+
+    class Meta:
+        database = database
+        table_name = "schema_migration"
+
+    version = IntegerField(primary_key=True)
+    name = TextField()
+    checkpoint = IntegerField(null=True)
+    completed = DateTimeField(null=True)
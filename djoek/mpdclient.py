@@ -7,6 +7,8 @@ from typing import Match, Optional, Tuple, Type, Union
 
 from multidict import MultiDict
 
+from djoek.metrics import MPD_COMMAND_LATENCY
+
 logger = logging.getLogger(__name__)
 
 MPD_COMMAND_TIMEOUT = 10
@@ -189,6 +191,14 @@ class MPDClient:
             return reader, writer
 
     async def execute(self, command: str) -> MultiDict[Union[str, bytes]]:
+        name = command.split(" ", 1)[0]
+        # Idling lasts until MPD has something to report, it isn't latency.
+        if name in ("idle", "noidle"):
+            return await self._execute(command)
+        with MPD_COMMAND_LATENCY.time(command=name):
+            return await self._execute(command)
+
+    async def _execute(self, command: str) -> MultiDict[Union[str, bytes]]:
         loop = asyncio.get_event_loop()
         f: "asyncio.Future[MultiDict[Union[str, bytes]]]" = loop.create_future()
         await self.command_queue.put((command, f))
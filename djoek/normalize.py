@@ -0,0 +1,178 @@
+import argparse
+import asyncio
+import logging
+import sys
+import time
+from pathlib import Path
+from typing import List, Optional, Tuple
+
+import mutagen
+
+from djoek import settings
+from djoek.media import run_in_executor
+
+logger = logging.getLogger(__name__)
+
+REPLAYGAIN_TAGS = ("replaygain_track_gain", "r128_track_gain")
+
+
+async def loudgain(paths: List[Path]) -> List[Path]:
+    """
+    Tag the files with their loudness. Returns the files that loudgain failed
+    to tag.
+    """
+    if not paths:
+        return []
+    process = await asyncio.create_subprocess_exec(
+        "loudgain", "-s", "i", *[str(path) for path in paths]
+    )
+    await process.communicate()
+    if process.returncode == 0:
+        return []
+
+    # The exit status is for the whole batch, see which files didn't get tags.
+    tagged = await asyncio.gather(
+        *[run_in_executor(has_replaygain, path) for path in paths]
+    )
+    failed = [path for path, is_tagged in zip(paths, tagged) if not is_tagged]
+    logger.warning(
+        "loudgain exited with status %d, failed to normalize: %s",
+        process.returncode,
+        ", ".join(path.name for path in failed) or "none",
+    )
+    return failed
+
+
+def has_replaygain(path: Path) -> bool:
+    try:
+        m = mutagen.File(path)
+    except Exception:
+        return False
+    if m is None or m.tags is None:
+        return False
+    return any(tag in key.lower() for key in m.tags.keys() for tag in REPLAYGAIN_TAGS)
+
+
+class Normalizer:
+    """
+    Collects files to normalize over a short window and runs loudgain on them
+    in batches, with at most `settings.LOUDGAIN_WORKERS` processes at a time.
+    """
+
+    _semaphore: Optional[asyncio.Semaphore]
+    _flush_handle: Optional[asyncio.TimerHandle]
+
+    def __init__(self) -> None:
+        self._pending: List[Tuple[Path, "asyncio.Future[None]"]] = []
+        self._semaphore = None
+        self._flush_handle = None
+
+    @property
+    def semaphore(self) -> asyncio.Semaphore:
+        if self._semaphore is None:
+            self._semaphore = asyncio.Semaphore(settings.LOUDGAIN_WORKERS)
+        return self._semaphore
+
+    async def normalize(self, path: Path) -> None:
+        loop = asyncio.get_event_loop()
+        f: "asyncio.Future[None]" = loop.create_future()
+        self._pending.append((path, f))
+
+        if len(self._pending) >= settings.LOUDGAIN_BATCH_SIZE:
+            self._flush()
+        elif self._flush_handle is None:
+            self._flush_handle = loop.call_later(
+                settings.LOUDGAIN_BATCH_WINDOW, self._flush
+            )
+
+        await f
+
+    def _flush(self) -> None:
+        if self._flush_handle is not None:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+
+        batch, self._pending = self._pending, []
+        if batch:
+            asyncio.get_event_loop().create_task(self._run_batch(batch))
+
+    async def _run_batch(
+        self, batch: List[Tuple[Path, "asyncio.Future[None]"]]
+    ) -> None:
+        try:
+            async with self.semaphore:
+                await loudgain([path for path, _ in batch])
+        except Exception as e:
+            for _, f in batch:
+                if not f.done():
+                    f.set_exception(e)
+        else:
+            for _, f in batch:
+                if not f.done():
+                    f.set_result(None)
+
+    async def normalize_many(self, paths: List[Path]) -> List[Path]:
+        """
+        Normalize a known set of files, spread over all loudgain workers.
+        Returns the files that failed.
+        """
+        if not paths:
+            return []
+
+        workers = min(settings.LOUDGAIN_WORKERS, len(paths))
+        chunk_size = max(1, min(settings.LOUDGAIN_BATCH_SIZE, len(paths) // workers))
+
+        async def run_chunk(chunk: List[Path]) -> List[Path]:
+            async with self.semaphore:
+                return await loudgain(chunk)
+
+        failed = await asyncio.gather(
+            *[
+                run_chunk(paths[i : i + chunk_size])
+                for i in range(0, len(paths), chunk_size)
+            ]
+        )
+        return [path for chunk in failed for path in chunk]
+
+
+normalizer = Normalizer()
+
+
+async def renormalize(force: bool) -> bool:
+    started = time.monotonic()
+    paths = sorted(path for path in settings.MUSIC_DIR.iterdir() if path.is_file())
+
+    if not force:
+        tagged = await asyncio.gather(
+            *[run_in_executor(has_replaygain, path) for path in paths]
+        )
+        paths = [path for path, is_tagged in zip(paths, tagged) if not is_tagged]
+
+    print(f"Normalizing {len(paths)} files")
+    failed = await normalizer.normalize_many(paths)
+    print(f"Done in {time.monotonic() - started:.1f}s")
+    for path in failed:
+        print(f"Failed to normalize {path.name}")
+    return not failed
+
+
+def main(argv: Optional[List[str]] = None) -> None:
+    parser = argparse.ArgumentParser(
+        prog="python -m djoek.normalize",
+        description="Apply ReplayGain tags to all files in the music directory.",
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="also process files that already have ReplayGain tags",
+    )
+    args = parser.parse_args(argv)
+
+    logging.basicConfig(level=logging.INFO)
+    if not asyncio.run(renormalize(args.force)):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -1,29 +1,36 @@
 import asyncio
-import json
 import logging
 import os
 import random
+import time
 from base64 import urlsafe_b64decode
-from typing import List, Optional, cast
+from typing import Dict, List, Optional, Set, Tuple, cast
+from urllib.parse import urlparse
 
-import aiofiles
+import asyncpg
 from fastapi import FastAPI
-from peewee import JOIN
 from peewee_async import Manager
 from starlette.requests import Request
 from starlette.websockets import WebSocket
 
 from djoek import settings
-from djoek.models import Song, User
+from djoek.library import is_available, playlist_uri, restore_evicted, restoring
+from djoek.metrics import NEXT_SONG_LATENCY
+from djoek.models import Song
 from djoek.mpdclient import MPDClient, MPDCommandError
+from djoek.records import PlayerStateRecord, SongRecord
+from djoek.repository import Repository
 from djoek.util import send_updates
+from djoek.views import ViewCache
 
 logger = logging.getLogger(__name__)
 
 
 async def setup_player(app: FastAPI) -> None:
     loop = asyncio.get_event_loop()
-    app.state.player = player = Player(app.state.manager, app.state.ws_clients)
+    app.state.player = player = Player(
+        app.state.manager, app.state.repository, app.state.ws_clients
+    )
     app.state.player_task = loop.create_task(player.run())
 
 
@@ -36,104 +43,225 @@ async def get_player(request: Request) -> "Player":
 
 
 class Player:
+    """
+    Every worker runs a player. The players mirror the shared state in
+    Postgres and push changes to their own websocket clients. One of them,
+    the leader, holds an advisory lock and is the only one that talks to MPD.
+    """
+
     mpd_client: MPDClient
-    queue: List[Song]
+    queue: List[SongRecord]
     current_song_id: Optional[int]
-    current_song: Optional[Song]
+    current_song: Optional[SongRecord]
     next_song_id: Optional[int]
-    next_song: Optional[Song]
+    next_song: Optional[SongRecord]
     recent: List[int]
+    played: PlayerStateRecord
+    stream_listeners: Dict[str, Tuple[int, float]]
 
-    def __init__(self, manager: Manager, ws_clients: List[WebSocket]):
+    def __init__(
+        self, manager: Manager, repository: Repository, ws_clients: List[WebSocket]
+    ):
         self.manager = manager
+        self.repository = repository
         self.queue = []
-        self.mpd_client = MPDClient(settings.MPD_HOST)
         self.current_song_id = None
         self.current_song = None
         self.next_song_id = None
         self.next_song = None
         self.recent = []
+        self.played = PlayerStateRecord(None, None, None, None, [])
+        self.stream_listeners = {}
         self.ws_clients = ws_clients
+        self.views = ViewCache(self)
+        self.state_changed = asyncio.Event()
+        self.queue_changed = asyncio.Event()
 
-    async def load_state(self) -> None:
-        if not settings.STATE_PATH:
-            return
-        try:
-            async with aiofiles.open(settings.STATE_PATH, "r") as f:
-                state = json.loads(await f.read())
-        except Exception:
-            logger.exception("Failed to load state")
-        else:
-            queue_ids = state.get("queue", [])
-            songs = await self.manager.execute(
-                Song.select(Song, User)
-                .join(User, JOIN.LEFT_OUTER)
-                .where(Song.id.in_(queue_ids))
-            )
-            self.queue = sorted(songs, key=lambda song: queue_ids.index(song.id))
-            self.recent = state.get("recent", [])
+    async def run(self) -> None:
+        await asyncio.gather(self.follow(), self.elect())
 
-    async def save_state(self) -> None:
-        if not settings.STATE_PATH:
+    def notified(self, event: str) -> None:
+        name, _, args = event.partition(" ")
+        if name == "listeners":
+            worker_id, count = args.split(" ")
+            self.update_stream_listeners(worker_id, int(count))
             return
 
-        state = json.dumps(
-            {"queue": [song.id for song in self.queue], "recent": self.recent}, indent=4
-        )
-        async with aiofiles.open(settings.STATE_PATH, "w") as f:
-            await f.write(state)
-
-    async def run(self) -> None:
-        await self.load_state()
+        self.state_changed.set()
+        if name == "queue":
+            self.queue_changed.set()
+
+    def update_stream_listeners(self, worker_id: str, count: int) -> None:
+        """
+        Keep the stream listener counts reported by the workers, forgetting
+        workers that stopped reporting.
+        """
+        total = self.stream_listener_count()
+        now = time.monotonic()
+        self.stream_listeners[worker_id] = (count, now)
+        self.stream_listeners = {
+            worker_id: (count, reported)
+            for worker_id, (count, reported) in self.stream_listeners.items()
+            if now - reported < 3 * settings.STREAM_REPORT_INTERVAL
+        }
+        if self.stream_listener_count() != total:
+            self.views.invalidate()
+
+    def stream_listener_count(self) -> int:
+        return sum(count for count, _ in self.stream_listeners.values())
+
+    async def follow(self) -> None:
+        while True:
+            try:
+                async with self.repository.listen(self.notified) as listener:
+                    self.state_changed.set()
+                    await self.follow_state(listener)
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Lost the player state listener, reconnecting")
+            await asyncio.sleep(settings.PLAYER_ELECTION_INTERVAL)
+
+    async def follow_state(self, listener: asyncpg.Connection) -> None:
+        while True:
+            try:
+                await asyncio.wait_for(
+                    self.state_changed.wait(), settings.PLAYER_KEEPALIVE_INTERVAL
+                )
+            except asyncio.TimeoutError:
+                await listener.execute("SELECT 1")
+                continue
+            self.state_changed.clear()
+            await self.refresh()
+
+    async def refresh(self) -> None:
+        state = await self.repository.player_state()
+        self.current_song_id = state.current_song_id
+        self.current_song = state.current_song
+        self.next_song_id = state.next_song_id
+        self.next_song = state.next_song
+        self.queue = state.queue
+        self.views.invalidate()
+        await send_updates(self.ws_clients)
 
+    async def elect(self) -> None:
+        while True:
+            try:
+                async with self.repository.advisory_lock(
+                    settings.PLAYER_LOCK_ID
+                ) as locked:
+                    if locked:
+                        logger.info("Elected as the player leader")
+                        await self.lead()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Player leader failed")
+            await asyncio.sleep(settings.PLAYER_ELECTION_INTERVAL)
+
+    async def lead(self) -> None:
+        """
+        Play for as long as the session holding the lock is alive.
+        """
+        self.played = await self.repository.player_state()
+        self.recent = await self.repository.recent(settings.REMEMBER_RECENT)
+
+        play = asyncio.get_event_loop().create_task(self.play())
+        try:
+            while not play.done():
+                await asyncio.wait({play}, timeout=settings.PLAYER_KEEPALIVE_INTERVAL)
+                if not play.done():
+                    await self.repository.keep_locks()
+            play.result()
+        finally:
+            play.cancel()
+
+    async def play(self) -> None:
+        self.mpd_client = MPDClient(settings.MPD_HOST, settings.MPD_PORT)
         async with self.mpd_client:
-            self.mpd_client = self.mpd_client
             await self.mpd_client.execute("random 0")
             await self.mpd_client.execute("repeat 0")
             await self.mpd_client.execute("single 0")
             await self.mpd_client.execute("consume 1")
 
-            while await self.check_playlist():
-                await self.mpd_client.execute("idle playlist")
-
-            while True:
-                await self.mpd_client.execute("idle playlist update player")
-                await self.check_playlist()
-
-    async def enqueue(self, song: Song) -> bool:
-        if (
-            (self.current_song is not None and song.id == self.current_song.id)
-            or (self.next_song is not None and song.id == self.next_song.id)
-            or song.id in [s.id for s in self.queue]
-        ):
-            return False
+            watcher = asyncio.get_event_loop().create_task(self.watch_queue())
+            try:
+                while await self.check_playlist():
+                    await self.mpd_client.execute("idle playlist")
 
-        self.queue.append(song)
-        await self.save_state()
-        await self.check_playlist()
-        await send_updates(self.ws_clients)
-        return True
+                while True:
+                    await self.mpd_client.execute("idle playlist update player")
+                    await self.check_playlist()
+            finally:
+                watcher.cancel()
 
-    async def add_recent(self, song: Song) -> None:
+    async def watch_queue(self) -> None:
+        while True:
+            await self.queue_changed.wait()
+            self.queue_changed.clear()
+            try:
+                await self.prepare_queue()
+                await self.check_playlist()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to check the playlist")
+
+    async def enqueue(self, song_id: int) -> bool:
+        return await self.repository.enqueue(song_id)
+
+    def replace_song(self, song: SongRecord) -> None:
+        """
+        Swap in an updated record wherever the player holds this song, until
+        the next refresh of the shared state.
+        """
+        if self.current_song is not None and self.current_song.id == song.id:
+            self.current_song = song
+        if self.next_song is not None and self.next_song.id == song.id:
+            self.next_song = song
+        self.queue = [song if s.id == song.id else s for s in self.queue]
+        self.views.invalidate()
+
+    async def add_recent(self, song: SongRecord) -> None:
+        await self.repository.mark_played(song.id)
         self.recent.append(song.id)
         self.recent = self.recent[-settings.REMEMBER_RECENT :]
-        await self.save_state()
+
+    async def ready(self, song: SongRecord, restore: bool = True) -> bool:
+        """
+        Whether the song can be played now. Songs that were evicted from the
+        music directory are downloaded again in the background, and skipped
+        until they are back.
+        """
+        if await is_available(song):
+            return True
+        if restore:
+            restore_evicted(self.manager, song)
+        return False
+
+    async def prepare_queue(self) -> None:
+        """
+        Get evicted songs in the queue back before it is their turn.
+        """
+        for song in await self.repository.queued_songs():
+            await self.ready(song)
 
     async def check_playlist(self) -> bool:
         status = await self.mpd_client.execute("status")
 
         playlistlength = int(status["playlistlength"])
         if playlistlength < 2:
+            skip: Set[int] = set()
             while True:
-                song = await self.get_next_song()
+                song = await self.get_next_song(skip)
                 if not song:
                     break
 
                 try:
-                    await self.mpd_client.execute(f"addid {song.filename}")
+                    await self.mpd_client.execute(f"addid {await playlist_uri(song)}")
                 except MPDCommandError:
                     logger.exception("Failed to add song, deleting from database")
-                    await self.manager.delete(song)
+                    await self.manager.execute(Song.delete().where(Song.id == song.id))
                     continue
                 if playlistlength == 0:
                     await self.add_recent(song)
@@ -143,30 +271,31 @@ class Player:
             await self.mpd_client.execute("play")
             return False
 
-        playlist_updated = False
+        played = self.played
 
         current_song_id = int(status["songid"]) if "songid" in status else None
-        if current_song_id != self.current_song_id:
-            self.current_song_id = current_song_id
-            playlist_updated = True
-            self.current_song = await self.get_song_by_playlist_id(current_song_id)
-            if self.current_song is not None:
-                await self.add_recent(self.current_song)
+        if current_song_id != played.current_song_id:
+            current_song = await self.get_song_by_playlist_id(current_song_id)
+            played = played._replace(
+                current_song_id=current_song_id, current_song=current_song
+            )
+            if current_song is not None:
+                await self.add_recent(current_song)
 
         next_song_id = int(status["nextsongid"]) if "nextsongid" in status else None
-        if next_song_id != self.next_song_id:
-            self.next_song_id = next_song_id
-            playlist_updated = True
-            self.next_song = await self.get_song_by_playlist_id(next_song_id)
+        if next_song_id != played.next_song_id:
+            next_song = await self.get_song_by_playlist_id(next_song_id)
+            played = played._replace(next_song_id=next_song_id, next_song=next_song)
 
-        if playlist_updated:
-            await send_updates(self.ws_clients)
+        if played is not self.played:
+            self.played = played
+            await self.repository.save_player_state(played)
 
         return False
 
     async def get_song_by_playlist_id(
         self, playlist_song_id: Optional[int]
-    ) -> Optional[Song]:
+    ) -> Optional[SongRecord]:
         if playlist_song_id is None:
             return None
 
@@ -174,36 +303,32 @@ class Player:
         if not song_data:
             return None
 
-        basename, extension = os.path.splitext(song_data["file"])
-        song_external_id = urlsafe_b64decode(f"{basename}==")
-        try:
-            return cast(
-                Song,
-                await self.manager.get(
-                    Song.select(Song, User)
-                    .join(User, JOIN.LEFT_OUTER)
-                    .where(
-                        Song.external_id == song_external_id,
-                        Song.extension == extension,
-                    ),
-                ),
-            )
-        except Song.DoesNotExist:
-            return None
-
-    async def get_next_song(self) -> Optional[Song]:
-        if self.queue:
-            return self.queue.pop(0)
+        # Progressively downloaded songs are played from a URL.
+        filename = os.path.basename(urlparse(cast(str, song_data["file"])).path)
+        basename, extension = os.path.splitext(filename)
+        song_external_id = urlsafe_b64decode(f"{basename}==").decode("utf-8")
+        return await self.repository.song_by_file(song_external_id, extension)
+
+    async def get_next_song(self, skip: Set[int]) -> Optional[SongRecord]:
+        """
+        The first queued song that is ready to play, or a random one if none
+        is. Songs that aren't ready are added to `skip`.
+        """
+        with NEXT_SONG_LATENCY.time():
+            return await self._get_next_song(skip)
+
+    async def _get_next_song(self, skip: Set[int]) -> Optional[SongRecord]:
+        # Queued songs that aren't ready keep their place in the queue.
+        for queued in await self.repository.queued_songs():
+            if queued.id in skip:
+                continue
+            if not await self.ready(queued):
+                skip.add(queued.id)
+            elif await self.repository.dequeue(queued.id):
+                return queued
 
         while True:
-            songs = {
-                song.id: song.rating_
-                for song in await self.manager.execute(
-                    Song.select(
-                        Song.id, (Song.upvotes - Song.downvotes).alias("rating_")
-                    ).order_by(Song.id)
-                )
-            }
+            songs = dict(await self.repository.ratings())
             if not songs:
                 return None
 
@@ -213,8 +338,9 @@ class Player:
                 songs[key] -= min_rating - 1
 
             recent = self.recent.copy()
-            if self.next_song is not None and self.next_song.id in songs:
-                recent.append(self.next_song.id)
+            next_song = self.played.next_song
+            if next_song is not None and next_song.id in songs:
+                recent.append(next_song.id)
 
             # If length of songs is 1 the recent slicing will not work as expected.
             if len(songs) > 1:
@@ -222,6 +348,11 @@ class Player:
                     if recent_id in songs:
                         del songs[recent_id]
 
+            for song_id in skip:
+                songs.pop(song_id, None)
+            if not songs:
+                return None
+
             # Weighted random selection.
             i = random.randint(1, sum(songs.values()))
             for song_id, weight in songs.items():
@@ -229,9 +360,14 @@ class Player:
                 if i <= 0:
                     break
 
-            try:
-                song: Song = await self.manager.get(Song, id=song_id)
-                return song
-            except Song.DoesNotExist:
+            song = await self.repository.song_by_id(song_id)
+            if song is None:
                 # Song was deleted from database in between the selection and here.
-                pass
+                continue
+            # Don't start downloading every evicted song that happens to be
+            # picked, they'll come up again.
+            if await self.ready(
+                song, restore=len(restoring) < settings.DOWNLOAD_WORKERS
+            ):
+                return song
+            skip.add(song.id)
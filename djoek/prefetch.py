@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Set
+
+from djoek import settings
+from djoek.downloader import downloader
+from djoek.media import run_in_executor
+from djoek.metrics import PREFETCH_ADDS, PREFETCH_WASTED_BYTES, PREFETCHES
+from djoek.models import Song
+from djoek.repository import Repository
+from djoek.schemas import ItemSchema
+
+if TYPE_CHECKING:
+    from djoek.providers import Provider
+
+logger = logging.getLogger(__name__)
+
+
+def incoming_dir() -> Path:
+    return settings.PREFETCH_DIR / "incoming"
+
+
+def download_options(prefetch: bool) -> Dict[str, Any]:
+    """
+    Extra youtube-dl options for a provider download.
+    """
+    if prefetch and settings.PREFETCH_RATE:
+        return {"ratelimit": settings.PREFETCH_RATE}
+    return {}
+
+
+def find_prefetched(song: Song) -> Optional[Path]:
+    # The extension of a prefetched file can differ from the one guessed from
+    # the metadata.
+    for path in settings.PREFETCH_DIR.glob(f"{song.path.stem}.*"):
+        if path.is_file():
+            return path
+    return None
+
+
+def install_prefetched(song: Song) -> None:
+    path = settings.PREFETCH_DIR / song.filename
+    os.replace(incoming_dir() / song.filename, path)
+    # Pruning goes by the time the prefetch finished, not by youtube-dl's idea
+    # of when the video was uploaded.
+    os.utime(path)
+
+
+def remove_incoming(song: Song) -> None:
+    for path in incoming_dir().glob(f"{song.path.stem}.*"):
+        path.unlink()
+
+
+def prune_prefetched() -> int:
+    """
+    Delete prefetched files that are older than `settings.PREFETCH_TTL` and
+    the oldest ones beyond `settings.PREFETCH_BUDGET`, and downloads that
+    stopped making progress. Returns the number of bytes deleted.
+    """
+    now = time.time()
+    deleted = 0
+    for entry in os.scandir(incoming_dir()):
+        stat = entry.stat()
+        if entry.is_file() and now - stat.st_mtime >= settings.PREFETCH_TTL:
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                continue
+            deleted += stat.st_size
+
+    files = []
+    for entry in os.scandir(settings.PREFETCH_DIR):
+        if entry.is_file():
+            stat = entry.stat()
+            files.append((stat.st_mtime, stat.st_size, entry.path))
+
+    total = sum(size for _, size, _ in files)
+    for mtime, size, path in sorted(files):
+        if total <= settings.PREFETCH_BUDGET and now - mtime < settings.PREFETCH_TTL:
+            continue
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            # Claimed in the meantime.
+            continue
+        total -= size
+        deleted += size
+    return deleted
+
+
+class Prefetcher:
+    """
+    Downloads the top results of provider searches to a scratch directory
+    while the user makes up their mind, so adding one of them to the library
+    only has to move the file into place. Prefetches only use download
+    workers while another one is idle, are rate limited and stay within a
+    disk budget. Claims go by the scratch directory, so a song prefetched by
+    one worker can be added through any other.
+    """
+
+    def __init__(self) -> None:
+        self.pending: Dict[str, "asyncio.Task[None]"] = {}
+        self.tasks: "Set[asyncio.Task[None]]" = set()
+
+    def prefetch(
+        self, repository: Repository, provider: "Provider", items: List[ItemSchema]
+    ) -> None:
+        if not settings.PREFETCH_RESULTS or not items:
+            return
+        task = asyncio.get_event_loop().create_task(
+            self._prefetch_results(
+                repository, provider, items[: settings.PREFETCH_RESULTS]
+            )
+        )
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def _prefetch_results(
+        self, repository: Repository, provider: "Provider", items: List[ItemSchema]
+    ) -> None:
+        try:
+            songs = await repository.songs_by_external_ids(
+                [item.external_id for item in items]
+            )
+        except Exception:
+            logger.exception("Failed to look up search results to prefetch")
+            return
+
+        in_library = {song.external_id for song in songs}
+        loop = asyncio.get_event_loop()
+        for item in items:
+            if item.external_id in in_library or item.external_id in self.pending:
+                continue
+            # Keep a worker free for songs that are actually being added.
+            if downloader.idle_workers() < 2:
+                PREFETCHES.inc(outcome="skipped")
+                continue
+            self.pending[item.external_id] = loop.create_task(
+                self._prefetch(provider, item)
+            )
+
+    async def _prefetch(self, provider: "Provider", item: ItemSchema) -> None:
+        _, content_id = item.external_id.split(":", 1)
+        # The extension only names the download, the provider sets the real one.
+        song = Song(
+            title=item.title,
+            external_id=item.external_id,
+            extension=".mp3",
+            preview_url=item.preview_url,
+            duration=item.duration,
+        )
+        try:
+            if await run_in_executor(find_prefetched, song) is not None:
+                return
+            incoming_dir().mkdir(parents=True, exist_ok=True)
+            try:
+                await provider.download(content_id, song, prefetch=True)
+                await run_in_executor(install_prefetched, song)
+            except Exception:
+                logger.warning("Failed to prefetch %s", item.external_id, exc_info=True)
+                PREFETCHES.inc(outcome="failed")
+                await run_in_executor(remove_incoming, song)
+                return
+            PREFETCHES.inc(outcome="downloaded")
+            PREFETCH_WASTED_BYTES.inc(await run_in_executor(prune_prefetched))
+        finally:
+            del self.pending[item.external_id]
+
+    async def available(self, song: Song) -> bool:
+        if not settings.PREFETCH_RESULTS:
+            return False
+        return song.external_id in self.pending or (
+            await run_in_executor(find_prefetched, song) is not None
+        )
+
+    async def claim(self, song: Song) -> bool:
+        """
+        Move the prefetched file of the song into the music directory, after
+        waiting for its prefetch if it is still running. Sets the extension
+        of the song to that of the file.
+        """
+        if not settings.PREFETCH_RESULTS:
+            return False
+
+        result = "hit"
+        pending = self.pending.get(song.external_id)
+        if pending is not None:
+            result = "late"
+            await asyncio.wait({pending})
+
+        path = await run_in_executor(find_prefetched, song)
+        if path is not None:
+            extension = song.extension
+            song.extension = path.suffix
+            try:
+                await run_in_executor(os.replace, path, song.path)
+            except FileNotFoundError:
+                # Claimed by another worker or pruned in the meantime.
+                song.extension = extension
+            else:
+                PREFETCH_ADDS.inc(result=result)
+                return True
+
+        PREFETCH_ADDS.inc(result="miss")
+        return False
+
+
+prefetcher = Prefetcher()
@@ -1,9 +1,51 @@
+import asyncio
 from abc import ABC, abstractmethod
-from typing import List
+from functools import wraps
+from typing import Any, AsyncIterator, Awaitable, Callable, Dict, List, TypeVar, cast
 
+from djoek.downloader import ContentUnavailable
+from djoek.health import get_breaker
+from djoek.metrics import PROVIDER_ERRORS, PROVIDER_LATENCY
 from djoek.models import Song
 from djoek.schemas import ItemSchema, MetadataSchema
 
+F = TypeVar("F", bound=Callable[..., Awaitable[Any]])
+
+
+def instrumented(f: F) -> F:
+    """
+    Time the calls and guard them with a circuit breaker. Lookups of content
+    that doesn't exist and downloads of unavailable content don't count as
+    failures of the provider, `FailedDownloads` backs off from the content.
+    """
+
+    @wraps(f)
+    async def wrapper(self: "Provider", *args: Any, **kwargs: Any) -> Any:
+        breaker = get_breaker(self.key, f.__name__)
+        breaker.check()
+        with PROVIDER_LATENCY.time(provider=self.key, operation=f.__name__):
+            try:
+                result = await f(self, *args, **kwargs)
+            except asyncio.CancelledError:
+                # Not an Exception from Python 3.8 on, but it is on 3.7.
+                breaker.abandoned()
+                raise
+            except (LookupError, ContentUnavailable):
+                PROVIDER_ERRORS.inc(provider=self.key, operation=f.__name__)
+                breaker.succeeded()
+                raise
+            except Exception:
+                PROVIDER_ERRORS.inc(provider=self.key, operation=f.__name__)
+                breaker.failed()
+                raise
+            except BaseException:
+                breaker.abandoned()
+                raise
+        breaker.succeeded()
+        return result
+
+    return cast(F, wrapper)
+
 
 class Provider(ABC):
     key: str
@@ -12,9 +54,34 @@ class Provider(ABC):
     async def get_metadata(self, content_id: str) -> MetadataSchema:
         ...
 
+    async def get_metadata_batch(
+        self, content_ids: List[str]
+    ) -> Dict[str, MetadataSchema]:
+        results = await asyncio.gather(
+            *[self.get_metadata(content_id) for content_id in content_ids],
+            return_exceptions=True,
+        )
+        return {
+            content_id: result
+            for content_id, result in zip(content_ids, results)
+            if isinstance(result, MetadataSchema)
+        }
+
     @abstractmethod
-    async def download(self, content_id: str, song: Song) -> None:
-        ...
+    async def download(
+        self, content_id: str, song: Song, prefetch: bool = False
+    ) -> None:
+        """
+        Download the song to its path in the music directory. Prefetches go to
+        `djoek.prefetch.incoming_dir()` instead, with `download_options`.
+        """
+
+    @abstractmethod
+    def stream(self, content_id: str, song: Song) -> AsyncIterator[bytes]:
+        """
+        Yield the song's audio as it downloads, in the same format `download`
+        produces.
+        """
 
     @abstractmethod
     async def search(self, query: str) -> List[ItemSchema]:
@@ -1,13 +1,14 @@
-import asyncio
-import subprocess
-from typing import Any, Dict, List, cast
+from typing import Any, AsyncIterator, Dict, List, cast
 
-import aiofiles
+import aiofiles.os
 import httpx
 
 import djoek.settings as settings
+from djoek.downloader import DownloadError, downloader
+from djoek.media import pipe_output
 from djoek.models import Song
-from djoek.providers import Provider
+from djoek.prefetch import download_options, incoming_dir
+from djoek.providers import Provider, instrumented
 from djoek.schemas import ItemSchema, MetadataSchema
 
 
@@ -26,6 +27,7 @@ def get_title(item: Dict[str, Any]) -> str:
 class SoundcloudProvider(Provider):
     key = "soundcloud"
 
+    @instrumented
     async def get_track_info(self, content_id: str) -> Dict[str, Any]:
         async with httpx.AsyncClient() as client:
             r = await client.get(
@@ -34,6 +36,7 @@ class SoundcloudProvider(Provider):
             )
         return cast(Dict[str, Any], r.json()[0])
 
+    @instrumented
     async def get_metadata(self, content_id: str) -> MetadataSchema:
         metadata = await self.get_track_info(content_id)
         return MetadataSchema(
@@ -43,21 +46,32 @@ class SoundcloudProvider(Provider):
             preview_url=metadata["permalink_url"],
         )
 
-    async def download(self, content_id: str, song: Song) -> None:
-        p = await asyncio.create_subprocess_exec(
-            "youtube-dl",
-            "-f",
-            "mp3",
-            "-o",
-            "-",
+    @instrumented
+    async def download(
+        self, content_id: str, song: Song, prefetch: bool = False
+    ) -> None:
+        path = incoming_dir() / song.filename if prefetch else song.path
+        await downloader.download(
             song.preview_url,
-            stdout=subprocess.PIPE,
+            {
+                "format": "mp3",
+                "outtmpl": str(path),
+                "cachedir": False,
+                **download_options(prefetch),
+            },
         )
-        data, _ = await p.communicate()
+        # youtube-dl can report success and leave an empty file behind.
+        if not (await aiofiles.os.stat(path)).st_size:
+            await aiofiles.os.remove(path)
+            raise DownloadError(f"youtube-dl left {path.name} empty")
 
-        async with aiofiles.open(song.path, "wb") as f:
-            await f.write(data)
+    async def stream(self, content_id: str, song: Song) -> AsyncIterator[bytes]:
+        async for chunk in pipe_output(
+            ["youtube-dl", "-f", "mp3", "-o", "-", song.preview_url]
+        ):
+            yield chunk
 
+    @instrumented
     async def search(self, query: str) -> List[ItemSchema]:
         async with httpx.AsyncClient() as client:
             r = await client.get(
@@ -1,80 +1,365 @@
 import asyncio
 import html
+import logging
 import re
-from typing import List, Optional
+import time
+from pathlib import Path
+from typing import Any, AsyncIterator, Dict, List, Optional, Set, Union, cast
 
 import httpx
 import isodate
+from cachetools import TTLCache
 
 import djoek.settings as settings
+from djoek.downloader import downloader
+from djoek.media import pipe_output
+from djoek.metrics import YOUTUBE_LOOKUPS
 from djoek.models import Song
-from djoek.providers import Provider
+from djoek.prefetch import download_options, incoming_dir
+from djoek.providers import Provider, instrumented
+from djoek.quota import QuotaExceeded, youtube_quota
 from djoek.schemas import ItemSchema, MetadataSchema
 
+logger = logging.getLogger(__name__)
+
 YOUTUBE_URL_RE = re.compile(
     r"^(?:https?://(?:[^/]+.)?youtube.com/watch\?(?:v=|.*&v=)|https?://youtu.be/|youtube:)([a-zA-Z0-9_-]{11})"
 )
+VIDEOS_BATCH_SIZE = 50
+# Quota units per request.
+SEARCH_COST = 100
+VIDEOS_COST = 1
+# What youtube-dl -x names the audio it keeps without re-encoding.
+NATIVE_EXTENSIONS = (".opus", ".m4a", ".ogg", ".mp3", ".flac")
 
 
-class YouTubeProvider(Provider):
-    key = "youtube"
+def audio_extension() -> str:
+    """
+    The extension of new songs. In native mode it's a guess, YouTube serves
+    Opus for nearly everything, `download` corrects it if needed.
+    """
+    return ".opus" if settings.AUDIO_FORMAT == "native" else ".mp3"
 
-    async def get_metadata(self, content_id: str) -> MetadataSchema:
-        tags: List[str]
-        async with httpx.AsyncClient() as client:
-            r = await client.get(
-                "https://www.googleapis.com/youtube/v3/videos",
-                params={
-                    "part": "snippet,contentDetails",
-                    "id": content_id,
-                    "key": settings.GOOGLE_API_KEY,
-                },
+
+def find_download(basename: Path, since: float) -> str:
+    """
+    The extension of the audio youtube-dl just extracted.
+    """
+    for extension in NATIVE_EXTENSIONS:
+        path = basename.with_name(f"{basename.name}{extension}")
+        try:
+            if path.stat().st_mtime >= since:
+                return extension
+        except FileNotFoundError:
+            pass
+    raise FileNotFoundError(f"youtube-dl did not produce {basename}.*")
+
+
+def metadata_from_item(item: Dict[str, Any]) -> MetadataSchema:
+    snippet = item["snippet"]
+    return MetadataSchema(
+        title=snippet["title"],
+        tags=snippet.get("tags", []),
+        extension=audio_extension(),
+        preview_url=f"https://youtu.be/{item['id']}",
+        duration=isodate.parse_duration(
+            item["contentDetails"]["duration"]
+        ).total_seconds(),
+    )
+
+
+def quota_exceeded(r: httpx.Response) -> bool:
+    try:
+        errors = r.json()["error"]["errors"]
+    except (ValueError, KeyError, TypeError):
+        return False
+    return any(
+        error.get("reason") in ("quotaExceeded", "dailyLimitExceeded")
+        for error in errors
+    )
+
+
+async def api_get(
+    client: httpx.AsyncClient, endpoint: str, cost: int, reserve: int, **params: str
+) -> Any:
+    """
+    A YouTube Data API request, paid from the quota budget.
+    """
+    await youtube_quota.spend(cost, reserve)
+    r = await client.get(
+        f"https://www.googleapis.com/youtube/v3/{endpoint}",
+        params={**params, "key": settings.GOOGLE_API_KEY},
+    )
+    if r.status_code == 403:
+        if quota_exceeded(r):
+            await youtube_quota.exhaust()
+        raise QuotaExceeded(f"YouTube refused the {endpoint} request")
+    r.raise_for_status()
+    return r.json()
+
+
+class VideoBatcher:
+    """
+    Looks up the videos that concurrent requests ask for together, in calls
+    of up to 50 ids that cost a single quota unit each.
+    """
+
+    def __init__(self) -> None:
+        self.futures: Dict[str, "asyncio.Future[Optional[Dict[str, Any]]]"] = {}
+        self.queued: List[str] = []
+        self.flush_handle: Optional[asyncio.TimerHandle] = None
+        self.tasks: "Set[asyncio.Task[None]]" = set()
+
+    async def get(self, video_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        loop = asyncio.get_event_loop()
+        futures = {}
+        for video_id in video_ids:
+            future = self.futures.get(video_id)
+            if future is None:
+                future = self.futures[video_id] = loop.create_future()
+                self.queued.append(video_id)
+            futures[video_id] = future
+
+        while len(self.queued) >= VIDEOS_BATCH_SIZE:
+            self.flush()
+        if self.queued and self.flush_handle is None:
+            self.flush_handle = loop.call_later(
+                settings.YOUTUBE_BATCH_WINDOW, self.flush
             )
-            duration: Optional[float]
-            if r.status_code == 403:
-                # Fall back to oEmbed. Lacks tags, still better than failing.
-                r = await client.get(
-                    "https://noembed.com/embed",
-                    params={"url": f"https://youtu.be/{content_id}"},
+
+        items = {}
+        for video_id, future in futures.items():
+            # Other requests may wait for the same video.
+            item = await asyncio.shield(future)
+            if item is not None:
+                items[video_id] = item
+        return items
+
+    def flush(self) -> None:
+        if self.flush_handle is not None:
+            self.flush_handle.cancel()
+            self.flush_handle = None
+        batch = self.queued[:VIDEOS_BATCH_SIZE]
+        del self.queued[:VIDEOS_BATCH_SIZE]
+        task = asyncio.get_event_loop().create_task(self.fetch(batch))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def fetch(self, batch: List[str]) -> None:
+        try:
+            async with httpx.AsyncClient() as client:
+                result = await api_get(
+                    client,
+                    "videos",
+                    VIDEOS_COST,
+                    0,
+                    part="snippet,contentDetails",
+                    id=",".join(batch),
                 )
-                r.raise_for_status()
-                title = r.json()["title"]
-                tags = []
-                duration = None
-            else:
-                r.raise_for_status()
-                metadata = r.json()
-                snippet = metadata["items"][0]["snippet"]
-                title = snippet["title"]
-                tags = snippet.get("tags", [])
-                duration = isodate.parse_duration(
-                    metadata["items"][0]["contentDetails"]["duration"]
-                ).total_seconds()
+        except Exception as e:
+            for video_id in batch:
+                future = self.futures.pop(video_id)
+                if not future.done():
+                    future.set_exception(e)
+            return
+
+        items = {item["id"]: item for item in result["items"]}
+        for video_id in batch:
+            future = self.futures.pop(video_id)
+            if not future.done():
+                future.set_result(items.get(video_id))
 
+
+class YouTubeProvider(Provider):
+    """
+    Uses the YouTube Data API for as long as the daily quota lasts. Video
+    lookups are batched and cached, as are searches. Once only
+    `settings.YOUTUBE_SEARCH_RESERVE` units are left, searches go through
+    youtube-dl so the rest is kept for the metadata of songs being added.
+    Without quota, metadata comes from oEmbed and then from youtube-dl.
+    """
+
+    key = "youtube"
+
+    def __init__(self) -> None:
+        self.videos = VideoBatcher()
+        self.video_cache: TTLCache = TTLCache(
+            settings.YOUTUBE_CACHE_SIZE, settings.YOUTUBE_CACHE_TTL
+        )
+        self.search_cache: TTLCache = TTLCache(
+            settings.YOUTUBE_CACHE_SIZE, settings.YOUTUBE_SEARCH_CACHE_TTL
+        )
+
+    async def get_videos(self, video_ids: List[str]) -> Dict[str, Dict[str, Any]]:
+        items = {
+            video_id: self.video_cache[video_id]
+            for video_id in video_ids
+            if video_id in self.video_cache
+        }
+        missing = [video_id for video_id in video_ids if video_id not in items]
+        if missing:
+            found = await self.videos.get(missing)
+            self.video_cache.update(found)
+            items.update(found)
+        return items
+
+    async def get_oembed_metadata(
+        self, client: httpx.AsyncClient, content_id: str
+    ) -> MetadataSchema:
+        # Lacks tags, still better than failing.
+        r = await client.get(
+            "https://noembed.com/embed",
+            params={"url": f"https://youtu.be/{content_id}"},
+        )
+        r.raise_for_status()
         return MetadataSchema(
-            title=title,
-            tags=tags,
-            extension=".mp3",
+            title=r.json()["title"],
+            tags=[],
+            extension=audio_extension(),
             preview_url=f"https://youtu.be/{content_id}",
-            duration=duration,
         )
 
-    async def download(self, content_id: str, song: Song) -> None:
-        basename = song.path.parent / song.path.stem
-        process = await asyncio.create_subprocess_exec(
-            "youtube-dl",
-            "-x",
-            "--audio-format",
-            "mp3",
-            "--audio-quality",
-            "1",
-            "-o",
-            f"{basename}.%(ext)s",
-            "--no-cache-dir",
+    async def get_youtube_dl_metadata(self, content_id: str) -> MetadataSchema:
+        info = await downloader.extract_info(
             f"https://www.youtube.com/watch?v={content_id}",
+            {},
+            ["title", "tags", "duration"],
         )
-        await process.communicate()
+        return MetadataSchema(
+            title=info["title"],
+            tags=info["tags"] or [],
+            extension=audio_extension(),
+            preview_url=f"https://youtu.be/{content_id}",
+            duration=info["duration"],
+        )
+
+    async def get_fallback_metadata(
+        self, client: httpx.AsyncClient, content_id: str
+    ) -> MetadataSchema:
+        try:
+            metadata = await self.get_oembed_metadata(client, content_id)
+            source = "oembed"
+        except Exception:
+            logger.warning("oEmbed failed for %s", content_id, exc_info=True)
+            metadata = await self.get_youtube_dl_metadata(content_id)
+            source = "youtube-dl"
+        YOUTUBE_LOOKUPS.inc(operation="metadata", source=source)
+        return metadata
+
+    async def lookup_metadata(
+        self, content_ids: List[str]
+    ) -> Dict[str, Union[MetadataSchema, BaseException]]:
+        cached = sum(1 for content_id in content_ids if content_id in self.video_cache)
+        try:
+            items = await self.get_videos(content_ids)
+        except (QuotaExceeded, httpx.HTTPError) as e:
+            logger.warning("Falling back from the YouTube API: %s", e)
+        else:
+            if cached:
+                YOUTUBE_LOOKUPS.inc(cached, operation="metadata", source="cache")
+            if len(content_ids) > cached:
+                YOUTUBE_LOOKUPS.inc(
+                    len(content_ids) - cached, operation="metadata", source="api"
+                )
+            return {
+                content_id: metadata_from_item(item)
+                for content_id, item in items.items()
+            }
+
+        async with httpx.AsyncClient() as client:
+            results = await asyncio.gather(
+                *[
+                    self.get_fallback_metadata(client, content_id)
+                    for content_id in content_ids
+                ],
+                return_exceptions=True,
+            )
+        return dict(zip(content_ids, results))
+
+    @instrumented
+    async def get_metadata(self, content_id: str) -> MetadataSchema:
+        metadata = (await self.lookup_metadata([content_id])).get(content_id)
+        if metadata is None:
+            raise LookupError(f"No such video: {content_id}")
+        if isinstance(metadata, BaseException):
+            raise metadata
+        return metadata
+
+    @instrumented
+    async def get_metadata_batch(
+        self, content_ids: List[str]
+    ) -> Dict[str, MetadataSchema]:
+        return {
+            content_id: result
+            for content_id, result in (await self.lookup_metadata(content_ids)).items()
+            if isinstance(result, MetadataSchema)
+        }
+
+    @instrumented
+    async def download(
+        self, content_id: str, song: Song, prefetch: bool = False
+    ) -> None:
+        directory = incoming_dir() if prefetch else song.path.parent
+        basename = directory / song.path.stem
+        options: Dict[str, Any] = {
+            "format": "bestaudio/best",
+            "outtmpl": f"{basename}.%(ext)s",
+            "cachedir": False,
+            **download_options(prefetch),
+        }
+        if settings.AUDIO_FORMAT == "native":
+            # Keep the best audio stream as is, only the container changes.
+            options["updatetime"] = False
+            extract_audio = {"key": "FFmpegExtractAudio", "preferredcodec": "best"}
+        else:
+            extract_audio = {
+                "key": "FFmpegExtractAudio",
+                "preferredcodec": "mp3",
+                "preferredquality": "1",
+            }
+        options["postprocessors"] = [extract_audio]
+
+        started = time.time()
+        await downloader.download(
+            f"https://www.youtube.com/watch?v={content_id}", options
+        )
+        if settings.AUDIO_FORMAT == "native":
+            song.extension = find_download(basename, started)
+
+    async def stream(self, content_id: str, song: Song) -> AsyncIterator[bytes]:
+        if song.extension == ".opus":
+            # Remux the Opus stream out of its WebM container.
+            audio_format = "bestaudio[acodec=opus]"
+            encoder_args = ["-c:a", "copy", "-f", "opus"]
+        else:
+            # Same encoder settings as youtube-dl's --audio-quality 1.
+            audio_format = "bestaudio"
+            encoder_args = ["-c:a", "libmp3lame", "-q:a", "1", "-f", "mp3"]
+
+        async for chunk in pipe_output(
+            [
+                "youtube-dl",
+                "-f",
+                audio_format,
+                "-o",
+                "-",
+                "--no-cache-dir",
+                f"https://www.youtube.com/watch?v={content_id}",
+            ],
+            [
+                "ffmpeg",
+                "-loglevel",
+                "error",
+                "-i",
+                "pipe:0",
+                "-vn",
+                *encoder_args,
+                "pipe:1",
+            ],
+        ):
+            yield chunk
 
+    @instrumented
     async def search(self, query: str) -> List[ItemSchema]:
         m = YOUTUBE_URL_RE.match(query)
         if m is not None:
@@ -89,41 +374,72 @@ class YouTubeProvider(Provider):
                 )
             ]
 
+        items = self.search_cache.get(query)
+        if items is not None:
+            YOUTUBE_LOOKUPS.inc(operation="search", source="cache")
+            return cast(List[ItemSchema], items)
+
+        try:
+            items = await self.search_api(query)
+            source = "api"
+        except (QuotaExceeded, httpx.HTTPError) as e:
+            logger.warning("Searching with youtube-dl instead of the API: %s", e)
+            items = await self.search_youtube_dl(query)
+            source = "youtube-dl"
+        YOUTUBE_LOOKUPS.inc(operation="search", source=source)
+        self.search_cache[query] = items
+        return items
+
+    async def search_api(self, query: str) -> List[ItemSchema]:
         async with httpx.AsyncClient() as client:
-            r = await client.get(
-                "https://www.googleapis.com/youtube/v3/search",
-                params={
-                    "part": "snippet",
-                    "maxResults": "10",
-                    "q": query,
-                    "type": "video",
-                    "key": settings.GOOGLE_API_KEY,
-                },
+            result = await api_get(
+                client,
+                "search",
+                SEARCH_COST,
+                settings.YOUTUBE_SEARCH_RESERVE,
+                part="snippet",
+                maxResults="10",
+                q=query,
+                type="video",
             )
-            result = r.json()
-
-            r = await client.get(
-                "https://www.googleapis.com/youtube/v3/videos",
-                params={
-                    "part": "contentDetails",
-                    "id": ",".join(item["id"]["videoId"] for item in result["items"]),
-                    "key": settings.GOOGLE_API_KEY,
-                },
-            )
-            durations = {
-                item["id"]: isodate.parse_duration(
-                    item["contentDetails"]["duration"]
-                ).total_seconds()
-                for item in r.json()["items"]
-            }
+
+        video_ids = [
+            item["id"]["videoId"]
+            for item in result["items"]
+            if item["id"]["kind"] == "youtube#video"
+        ]
+        # The durations are nice to have, and the videos are cached for when
+        # one of them is added.
+        try:
+            videos = await self.get_videos(video_ids)
+        except (QuotaExceeded, httpx.HTTPError):
+            videos = {}
 
         return [
             ItemSchema(
                 title=html.unescape(item["snippet"]["title"]),
                 external_id=f"{self.key}:{item['id']['videoId']}",
                 preview_url=f"https://youtu.be/{item['id']['videoId']}",
-                duration=durations.get(item["id"]["videoId"]),
+                duration=isodate.parse_duration(
+                    videos[item["id"]["videoId"]]["contentDetails"]["duration"]
+                ).total_seconds()
+                if item["id"]["videoId"] in videos
+                else None,
             )
             for item in result["items"]
             if item["id"]["kind"] == "youtube#video"
         ]
+
+    async def search_youtube_dl(self, query: str) -> List[ItemSchema]:
+        info = await downloader.extract_info(
+            f"ytsearch10:{query}", {"extract_flat": "in_playlist"}, ["entries"]
+        )
+        return [
+            ItemSchema(
+                title=entry["title"],
+                external_id=f"{self.key}:{entry['id']}",
+                preview_url=f"https://youtu.be/{entry['id']}",
+                duration=entry.get("duration"),
+            )
+            for entry in info["entries"]
+        ]
@@ -0,0 +1,107 @@
+import logging
+import time
+from typing import Optional
+
+from djoek import settings
+from djoek.metrics import QUOTA_REMAINING, QUOTA_SPENT
+from djoek.repository import Repository
+
+logger = logging.getLogger(__name__)
+
+
+class QuotaExceeded(Exception):
+    pass
+
+
+class QuotaBudget:
+    """
+    Units spent today on an API with a daily quota, shared by the workers
+    through Postgres. Units are spent before the request is made, Google
+    charges for failed requests too. Without a repository, as in scripts,
+    only this process' spend counts.
+    """
+
+    repository: Optional[Repository]
+
+    def __init__(self, service: str, budget: int) -> None:
+        self.service = service
+        self.budget = budget
+        self.repository = None
+        self.spent = 0
+        self.refreshed = float("-inf")
+
+    def start(self, repository: Repository) -> None:
+        self.repository = repository
+        self.refreshed = float("-inf")
+
+    async def remaining(self) -> int:
+        # Other workers spend too, and the day may have ended.
+        if (
+            self.repository is not None
+            and time.monotonic() - self.refreshed >= settings.QUOTA_REFRESH_INTERVAL
+        ):
+            try:
+                self.spent = await self.repository.quota_spent(self.service)
+                self.refreshed = time.monotonic()
+            except Exception:
+                logger.exception("Failed to refresh the %s quota", self.service)
+        remaining = max(0, self.budget - self.spent)
+        QUOTA_REMAINING.set(remaining, service=self.service)
+        return remaining
+
+    async def spend(self, units: int, reserve: int = 0) -> None:
+        """
+        Spend `units`, provided at least `reserve` units remain after.
+        """
+        # The count can be behind, but not ahead: it only saves asking
+        # Postgres once the quota has run out.
+        if await self.remaining() - reserve < units:
+            raise QuotaExceeded(f"{self.service} quota is running out")
+
+        if not await self.add_within(units, self.budget - reserve):
+            raise QuotaExceeded(f"{self.service} quota is running out")
+        QUOTA_SPENT.inc(units, service=self.service)
+
+    async def exhaust(self) -> None:
+        """
+        The API says the quota is used up, whatever the count says.
+        """
+        remaining = await self.remaining()
+        if remaining:
+            await self.add(remaining)
+
+    async def add_within(self, units: int, limit: int) -> bool:
+        if self.repository is not None:
+            try:
+                spent = await self.repository.spend_quota_within(
+                    self.service, units, limit
+                )
+            except Exception:
+                logger.exception("Failed to record %s quota spend", self.service)
+            else:
+                if spent is None:
+                    # Other workers spent it in the meantime, so at least
+                    # this much is spent.
+                    self.spent = max(self.spent, limit - units + 1)
+                    return False
+                self.spent = spent
+                self.refreshed = time.monotonic()
+                return True
+        # Without Postgres only this process' spend counts, the check in
+        # `spend` already covers it.
+        self.spent += units
+        return True
+
+    async def add(self, units: int) -> None:
+        if self.repository is None:
+            self.spent += units
+            return
+        try:
+            self.spent = await self.repository.spend_quota(self.service, units)
+            self.refreshed = time.monotonic()
+        except Exception:
+            logger.exception("Failed to record %s quota spend", self.service)
+            self.spent += units
+
+
+youtube_quota = QuotaBudget("youtube", settings.YOUTUBE_QUOTA)
@@ -0,0 +1,98 @@
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, Dict, List, NamedTuple, Optional
+
+from djoek import settings
+from djoek.models import format_username, song_filename
+
+
+class UserRecord(NamedTuple):
+    id: int
+    sub: str
+    profile: Dict[str, Any]
+
+
+class SongRecord(NamedTuple):
+    """
+    An immutable view of a song with only what the player and the schemas
+    use. Use `create` to build one, it computes the derived fields once.
+    """
+
+    id: int
+    title: str
+    external_id: str
+    extension: str
+    preview_url: Optional[str]
+    duration: Optional[Decimal]
+    upvotes: int
+    downvotes: int
+    user: Optional[UserRecord]
+    filename: str
+    path: Path
+    username: Optional[str]
+
+    @classmethod
+    def create(
+        cls,
+        id: int,
+        title: str,
+        external_id: str,
+        extension: str,
+        preview_url: Optional[str],
+        duration: Optional[Decimal],
+        upvotes: int,
+        downvotes: int,
+        user: Optional[UserRecord],
+    ) -> "SongRecord":
+        filename = song_filename(external_id, extension)
+        return cls(
+            id,
+            title,
+            external_id,
+            extension,
+            preview_url,
+            duration,
+            upvotes,
+            downvotes,
+            user,
+            filename,
+            settings.MUSIC_DIR / filename,
+            format_username(user),
+        )
+
+    @property
+    def user_id(self) -> Optional[int]:
+        return self.user.id if self.user is not None else None
+
+    @property
+    def provider(self) -> str:
+        return self.external_id.split(":", 1)[0]
+
+    @property
+    def content_id(self) -> str:
+        return self.external_id.split(":", 1)[1]
+
+    def with_votes(self, upvotes: int, downvotes: int) -> "SongRecord":
+        return self._replace(upvotes=upvotes, downvotes=downvotes)
+
+    def with_extension(self, extension: str) -> "SongRecord":
+        filename = song_filename(self.external_id, extension)
+        return self._replace(
+            extension=extension, filename=filename, path=settings.MUSIC_DIR / filename,
+        )
+
+    def with_user(self, user: UserRecord) -> "SongRecord":
+        return self._replace(user=user, username=format_username(user))
+
+
+class PlayerStateRecord(NamedTuple):
+    """
+    The shared player state. Like on the player, the `*_song_id` fields are
+    MPD playlist ids, not song ids.
+    """
+
+    current_song_id: Optional[int]
+    current_song: Optional[SongRecord]
+    next_song_id: Optional[int]
+    next_song: Optional[SongRecord]
+    queue: List[SongRecord]
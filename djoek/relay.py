@@ -0,0 +1,251 @@
+import asyncio
+import logging
+import uuid
+from collections import deque
+from itertools import islice
+from typing import AsyncIterator, Deque, List, cast
+
+import httpx
+from fastapi import FastAPI
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.types import Receive, Scope, Send
+
+from djoek import settings
+from djoek.metrics import STREAM_DROPPED, STREAM_LISTENERS
+from djoek.repository import Repository
+
+logger = logging.getLogger(__name__)
+
+OGG_CAPTURE = b"OggS"
+OGG_HEADER_SIZE = 27
+OGG_BOS = 0x02
+
+
+async def setup_relay(app: FastAPI) -> None:
+    app.state.relay = relay = StreamRelay(app.state.repository)
+    if settings.STREAM_URL:
+        app.state.relay_task = asyncio.get_event_loop().create_task(relay.run())
+
+
+async def shutdown_relay(app: FastAPI) -> None:
+    if settings.STREAM_URL:
+        app.state.relay_task.cancel()
+
+
+async def get_relay(request: Request) -> "StreamRelay":
+    return cast(StreamRelay, request.app.state.relay)
+
+
+class OggPageReader:
+    """
+    Splits a byte stream into Ogg pages.
+    """
+
+    def __init__(self) -> None:
+        self.buffer = bytearray()
+
+    def feed(self, data: bytes) -> List[bytes]:
+        self.buffer.extend(data)
+        pages = []
+        while True:
+            start = self.buffer.find(OGG_CAPTURE)
+            if start < 0:
+                del self.buffer[: -len(OGG_CAPTURE) + 1]
+                break
+            del self.buffer[:start]
+
+            if len(self.buffer) < OGG_HEADER_SIZE:
+                break
+            segments = self.buffer[OGG_HEADER_SIZE - 1]
+            body_start = OGG_HEADER_SIZE + segments
+            if len(self.buffer) < body_start:
+                break
+            end = body_start + sum(self.buffer[OGG_HEADER_SIZE:body_start])
+            if len(self.buffer) < end:
+                break
+
+            pages.append(bytes(self.buffer[:end]))
+            del self.buffer[:end]
+        return pages
+
+
+def granule_position(page: bytes) -> int:
+    return int.from_bytes(page[6:14], "little", signed=True)
+
+
+class StreamRelay:
+    """
+    Holds a single connection to MPD's httpd output and serves its Ogg pages
+    to any number of listeners from a shared ring buffer. New listeners get
+    the stream headers and a short backlog so playback starts right away.
+    Listeners that fall behind the start of the ring buffer are dropped.
+    """
+
+    def __init__(self, repository: Repository) -> None:
+        self.repository = repository
+        self.worker_id = uuid.uuid4().hex
+        self.headers: List[bytes] = []
+        self.capturing_headers = False
+        self.pages: Deque[bytes] = deque()
+        self.pages_size = 0
+        self.first_seq = 0
+        self.next_seq = 0
+        self.stream_start_seq = 0
+        self.page_added = asyncio.Event()
+        self.listeners = 0
+
+    async def run(self) -> None:
+        await asyncio.gather(self.relay(), self.report())
+
+    async def relay(self) -> None:
+        timeout = 0
+        while True:
+            if timeout:
+                await asyncio.sleep(timeout)
+            timeout = max(1, min(timeout * 2, 60))
+
+            reader = OggPageReader()
+            try:
+                async with httpx.AsyncClient(timeout=settings.STREAM_TIMEOUT) as client:
+                    async with client.stream("GET", settings.STREAM_URL) as response:
+                        response.raise_for_status()
+                        async for chunk in response.aiter_raw():
+                            for page in reader.feed(chunk):
+                                self.add_page(page)
+                            timeout = 0
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception(
+                    "Lost the stream from %s, reconnecting in %ss.",
+                    settings.STREAM_URL,
+                    timeout,
+                )
+            else:
+                logger.warning("Stream from %s ended.", settings.STREAM_URL)
+
+    async def report(self) -> None:
+        """
+        Let every worker know how many listeners this one has.
+        """
+        while True:
+            try:
+                await self.repository.notify(
+                    f"listeners {self.worker_id} {self.listeners}"
+                )
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to report stream listeners")
+            await asyncio.sleep(settings.STREAM_REPORT_INTERVAL)
+
+    def add_page(self, page: bytes) -> None:
+        # A new (chained) logical stream starts with its header pages, they
+        # all have a granule position of 0 or -1.
+        if page[5] & OGG_BOS:
+            if not self.capturing_headers:
+                self.headers = []
+                self.capturing_headers = True
+            self.headers.append(page)
+        elif self.capturing_headers and granule_position(page) <= 0:
+            self.headers.append(page)
+        elif self.capturing_headers:
+            self.capturing_headers = False
+            self.stream_start_seq = self.next_seq
+
+        self.pages.append(page)
+        self.pages_size += len(page)
+        self.next_seq += 1
+        while self.pages_size > settings.STREAM_BUFFER_SIZE and len(self.pages) > 1:
+            self.pages_size -= len(self.pages.popleft())
+            self.first_seq += 1
+
+        page_added, self.page_added = self.page_added, asyncio.Event()
+        page_added.set()
+
+    def backlog_start(self) -> int:
+        """
+        The first page of the burst sent to new listeners.
+        """
+        seq, size = self.next_seq, 0
+        for page in reversed(self.pages):
+            if (
+                seq <= self.stream_start_seq
+                or size + len(page) > settings.STREAM_BURST_SIZE
+            ):
+                break
+            seq -= 1
+            size += len(page)
+        return seq
+
+    async def listen(self) -> AsyncIterator[bytes]:
+        # While headers are still coming in, start at the next page.
+        seq = self.next_seq if self.capturing_headers else self.backlog_start()
+        self.listeners += 1
+        STREAM_LISTENERS.inc()
+        try:
+            if self.headers:
+                yield b"".join(self.headers)
+
+            while True:
+                if seq < self.first_seq:
+                    logger.info("Dropping a stream listener that fell behind")
+                    STREAM_DROPPED.inc()
+                    return
+                if seq == self.next_seq:
+                    await self.page_added.wait()
+                    continue
+                pages = list(islice(self.pages, seq - self.first_seq, None))
+                seq += len(pages)
+                yield b"".join(pages)
+        finally:
+            self.listeners -= 1
+            STREAM_LISTENERS.dec()
+
+
+class RelayResponse(Response):
+    """
+    Streams the relay to a client until either side goes away.
+    """
+
+    media_type = "audio/ogg"
+
+    def __init__(self, relay: StreamRelay) -> None:
+        self.relay = relay
+        self.status_code = 200
+        self.init_headers({"Cache-Control": "no-cache, no-store"})
+
+    async def stream(self, send: Send) -> None:
+        await send(
+            {
+                "type": "http.response.start",
+                "status": self.status_code,
+                "headers": self.raw_headers,
+            }
+        )
+        async for chunk in self.relay.listen():
+            await send({"type": "http.response.body", "body": chunk, "more_body": True})
+        await send({"type": "http.response.body", "body": b"", "more_body": False})
+
+    async def wait_for_disconnect(self, receive: Receive) -> None:
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                break
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send) -> None:
+        loop = asyncio.get_event_loop()
+        tasks = {
+            loop.create_task(self.stream(send)),
+            loop.create_task(self.wait_for_disconnect(receive)),
+        }
+        try:
+            done, pending = await asyncio.wait(
+                tasks, return_when=asyncio.FIRST_COMPLETED
+            )
+        finally:
+            for task in tasks:
+                task.cancel()
+        for task in done:
+            task.result()
@@ -0,0 +1,444 @@
+import asyncio
+import json
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Callable, Dict, List, Optional, Tuple, cast
+
+import asyncpg
+from fastapi import FastAPI
+from starlette.requests import Request
+
+from djoek import settings
+from djoek.metrics import DB_POOL_IN_USE, DB_POOL_WAIT, DB_QUERY_LATENCY
+from djoek.records import PlayerStateRecord, SongRecord, UserRecord
+
+SELECT_SONG = """
+    SELECT
+        song.id, song.title, song.external_id, song.extension, song.preview_url,
+        song.duration, song.upvotes, song.downvotes,
+        "user".id, "user".sub, "user".profile
+    FROM song LEFT OUTER JOIN "user" ON "user".id = song.user_id
+"""
+SONG_BY_ID = f"{SELECT_SONG} WHERE song.id = $1"
+SONG_BY_FILE = f"{SELECT_SONG} WHERE song.external_id = $1 AND song.extension = $2"
+SONGS_BY_IDS = f"{SELECT_SONG} WHERE song.id = ANY($1::integer[])"
+SONGS_BY_EXTERNAL_IDS = f"{SELECT_SONG} WHERE song.external_id = ANY($1::text[])"
+SEARCH_SONGS = f"{SELECT_SONG} WHERE song.search_field @@ plainto_tsquery($1)"
+SONG_RATINGS = "SELECT id, upvotes - downvotes FROM song ORDER BY id"
+MARK_PLAYED = "UPDATE song SET last_played = NOW() WHERE id = $1"
+VOTE_UPDATES = {
+    field: f"""
+        UPDATE song SET {field} = {field} + $2 WHERE id = $1
+        RETURNING upvotes, downvotes
+    """
+    for field in ("upvotes", "downvotes")
+}
+CLAIM_SONG = "UPDATE song SET user_id = $2 WHERE id = $1 AND user_id IS NULL"
+RECENT_SONGS = """
+    SELECT id FROM song WHERE last_played IS NOT NULL
+    ORDER BY last_played DESC LIMIT $1
+"""
+PLAYER_STATE = """
+    SELECT current_playlist_id, current_song_id, next_playlist_id, next_song_id
+    FROM player_state WHERE id = 1
+"""
+SAVE_PLAYER_STATE = """
+    INSERT INTO player_state (
+        id, current_playlist_id, current_song_id, next_playlist_id, next_song_id
+    ) VALUES (1, $1, $2, $3, $4)
+    ON CONFLICT (id) DO UPDATE SET
+        current_playlist_id = EXCLUDED.current_playlist_id,
+        current_song_id = EXCLUDED.current_song_id,
+        next_playlist_id = EXCLUDED.next_playlist_id,
+        next_song_id = EXCLUDED.next_song_id
+"""
+QUEUE_SONG_IDS = "SELECT song_id FROM queue_entry ORDER BY id"
+ENQUEUE_SONG = """
+    INSERT INTO queue_entry (song_id)
+    SELECT $1 WHERE NOT EXISTS (
+        SELECT 1 FROM player_state WHERE current_song_id = $1 OR next_song_id = $1
+    )
+    ON CONFLICT (song_id) DO NOTHING
+    RETURNING id
+"""
+DEQUEUE_SONG = "DELETE FROM queue_entry WHERE song_id = $1 RETURNING id"
+CURRENT_VOTE = "SELECT direction FROM vote WHERE playlist_id = $1 AND user_id = $2"
+ADD_VOTE = """
+    INSERT INTO vote (playlist_id, user_id, direction) VALUES ($1, $2, $3)
+    ON CONFLICT DO NOTHING
+    RETURNING direction
+"""
+RETRACT_VOTE = """
+    DELETE FROM vote WHERE playlist_id = $1 AND user_id = $2 AND direction <> $3
+    RETURNING direction
+"""
+CLEAR_VOTES = "DELETE FROM vote WHERE playlist_id IS DISTINCT FROM $1"
+NOTIFY = "SELECT pg_notify($1, $2)"
+
+# Google resets API quotas at midnight Pacific time.
+QUOTA_DAY = "(NOW() AT TIME ZONE 'America/Los_Angeles')::date"
+QUOTA_SPENT = f"SELECT units FROM quota_usage WHERE service = $1 AND day = {QUOTA_DAY}"
+SPEND_QUOTA = f"""
+    INSERT INTO quota_usage (service, day, units) VALUES ($1, {QUOTA_DAY}, $2)
+    ON CONFLICT (service, day) DO UPDATE SET units = quota_usage.units + $2
+    RETURNING units
+"""
+SPEND_QUOTA_WITHIN = f"""
+    INSERT INTO quota_usage (service, day, units)
+    SELECT $1::text, {QUOTA_DAY}, $2::integer WHERE $2::integer <= $3::integer
+    ON CONFLICT (service, day) DO UPDATE SET units = quota_usage.units + $2
+    WHERE quota_usage.units + $2 <= $3
+    RETURNING units
+"""
+
+EVENTS_CHANNEL = "djoek_events"
+UPSERT_USER = """
+    INSERT INTO "user" (sub, profile) VALUES ($1, $2)
+    ON CONFLICT (sub) DO UPDATE SET profile = EXCLUDED.profile
+    RETURNING id
+"""
+
+
+async def setup_repository(app: FastAPI) -> None:
+    app.state.repository = repository = Repository()
+    await repository.connect()
+
+
+async def shutdown_repository(app: FastAPI) -> None:
+    await app.state.repository.close()
+
+
+async def get_repository(request: Request) -> "Repository":
+    return cast(Repository, request.app.state.repository)
+
+
+async def init_connection(conn: asyncpg.Connection) -> None:
+    await conn.set_type_codec(
+        "json", encoder=json.dumps, decoder=json.loads, schema="pg_catalog"
+    )
+
+
+def song_from_row(row: asyncpg.Record) -> SongRecord:
+    user = UserRecord(row[8], row[9], row[10]) if row[8] is not None else None
+    return SongRecord.create(
+        row[0], row[1], row[2], row[3], row[4], row[5], row[6], row[7], user
+    )
+
+
+class Repository:
+    """
+    Queries for the hot paths, straight on asyncpg. Results are plain
+    records and tuples instead of peewee models, statements are prepared
+    and cached per connection by asyncpg. The schema itself is still
+    defined by the peewee models.
+    """
+
+    pool: Optional[asyncpg.pool.Pool]
+    lock_conn: Optional[asyncpg.Connection]
+
+    def __init__(self) -> None:
+        self.pool = None
+        self.lock_conn = None
+        self.lock_mutex = asyncio.Lock()
+
+    async def connect(self) -> None:
+        server_settings: Dict[str, str] = {}
+        if settings.DB_STATEMENT_TIMEOUT:
+            server_settings["statement_timeout"] = str(settings.DB_STATEMENT_TIMEOUT)
+
+        self.pool = await asyncpg.create_pool(
+            settings.DB_URI,
+            min_size=min(
+                settings.DB_MIN_CONNECTIONS, settings.DB_REPOSITORY_CONNECTIONS
+            ),
+            max_size=settings.DB_REPOSITORY_CONNECTIONS,
+            max_inactive_connection_lifetime=settings.DB_POOL_RECYCLE,
+            command_timeout=settings.DB_CONNECTION_TIMEOUT,
+            server_settings=server_settings,
+            init=init_connection,
+        )
+
+    async def close(self) -> None:
+        if self.lock_conn is not None:
+            await self.lock_conn.close()
+            self.lock_conn = None
+        if self.pool is not None:
+            await self.pool.close()
+            self.pool = None
+
+    @asynccontextmanager
+    async def dedicated_connection(self) -> AsyncIterator[asyncpg.Connection]:
+        """
+        A connection outside of the pool, for listening.
+        """
+        conn = await asyncpg.connect(
+            settings.DB_URI, timeout=settings.DB_CONNECTION_TIMEOUT
+        )
+        try:
+            yield conn
+        finally:
+            await conn.close()
+
+    async def lock_session(self, query: str, *args: Any) -> Any:
+        """
+        Run a query in the session that holds the advisory locks of this
+        worker, connecting it when needed. A session that fails is dropped
+        along with its locks, so no lock outlives a session in doubt.
+        """
+        async with self.lock_mutex:
+            if self.lock_conn is None or self.lock_conn.is_closed():
+                self.lock_conn = await asyncpg.connect(
+                    settings.DB_URI, timeout=settings.DB_CONNECTION_TIMEOUT
+                )
+            try:
+                return await self.lock_conn.fetchval(query, *args)
+            except Exception:
+                self.lock_conn.terminate()
+                raise
+
+    async def keep_locks(self) -> None:
+        """
+        Check that the session holding the advisory locks is still alive.
+        """
+        if self.lock_conn is None or self.lock_conn.is_closed():
+            raise asyncpg.InterfaceError("The advisory lock session was lost")
+        await self.lock_session("SELECT 1")
+
+    @asynccontextmanager
+    async def advisory_lock(self, key: int) -> AsyncIterator[bool]:
+        """
+        Yields whether this worker got the lock. All locks of a worker are
+        held by one long-lived session, use `keep_locks` to make sure it
+        still holds them.
+        """
+        locked = await self.lock_session("SELECT pg_try_advisory_lock($1)", key)
+        session = self.lock_conn
+        try:
+            yield locked
+        finally:
+            # A lost session took the lock with it.
+            if (
+                locked
+                and session is not None
+                and session is self.lock_conn
+                and not session.is_closed()
+            ):
+                await self.lock_session("SELECT pg_advisory_unlock($1)", key)
+
+    @asynccontextmanager
+    async def listen(
+        self, callback: Callable[[str], None]
+    ) -> AsyncIterator[asyncpg.Connection]:
+        def notified(
+            conn: asyncpg.Connection, pid: int, channel: str, payload: str
+        ) -> None:
+            callback(payload)
+
+        async with self.dedicated_connection() as conn:
+            await conn.add_listener(EVENTS_CHANNEL, notified)
+            yield conn
+
+    async def notify(self, event: str) -> None:
+        async with self.connection("notify") as conn:
+            await conn.execute(NOTIFY, EVENTS_CHANNEL, event)
+
+    @asynccontextmanager
+    async def connection(self, query: str) -> AsyncIterator[asyncpg.Connection]:
+        assert self.pool is not None
+        with DB_POOL_WAIT.time(pool="asyncpg"):
+            conn = await self.pool.acquire()
+        DB_POOL_IN_USE.inc(pool="asyncpg")
+        try:
+            with DB_QUERY_LATENCY.time(query=query):
+                yield conn
+        finally:
+            await self.pool.release(conn)
+            DB_POOL_IN_USE.dec(pool="asyncpg")
+
+    async def song_by_id(self, song_id: int) -> Optional[SongRecord]:
+        async with self.connection("song_by_id") as conn:
+            row = await conn.fetchrow(SONG_BY_ID, song_id)
+        return song_from_row(row) if row is not None else None
+
+    async def song_by_file(
+        self, external_id: str, extension: str
+    ) -> Optional[SongRecord]:
+        async with self.connection("song_by_file") as conn:
+            row = await conn.fetchrow(SONG_BY_FILE, external_id, extension)
+        return song_from_row(row) if row is not None else None
+
+    async def songs_by_ids(self, song_ids: List[int]) -> List[SongRecord]:
+        async with self.connection("songs_by_ids") as conn:
+            rows = await conn.fetch(SONGS_BY_IDS, song_ids)
+        return [song_from_row(row) for row in rows]
+
+    async def songs_by_external_ids(self, external_ids: List[str]) -> List[SongRecord]:
+        async with self.connection("songs_by_external_ids") as conn:
+            rows = await conn.fetch(SONGS_BY_EXTERNAL_IDS, external_ids)
+        return [song_from_row(row) for row in rows]
+
+    async def search(self, q: str) -> List[SongRecord]:
+        async with self.connection("search") as conn:
+            rows = await conn.fetch(SEARCH_SONGS, q)
+        return [song_from_row(row) for row in rows]
+
+    async def ratings(self) -> List[Tuple[int, int]]:
+        async with self.connection("ratings") as conn:
+            rows = await conn.fetch(SONG_RATINGS)
+        return [(row[0], row[1]) for row in rows]
+
+    async def mark_played(self, song_id: int) -> None:
+        async with self.connection("mark_played") as conn:
+            await conn.execute(MARK_PLAYED, song_id)
+
+    async def vote(
+        self, song_id: int, field: str, delta: int
+    ) -> Optional[Tuple[int, int]]:
+        """
+        Returns the new upvotes and downvotes of the song.
+        """
+        async with self.connection("vote") as conn:
+            row = await conn.fetchrow(VOTE_UPDATES[field], song_id, delta)
+        return (row[0], row[1]) if row is not None else None
+
+    async def cast_vote(
+        self, playlist_id: int, song_id: int, user_id: int, direction: str
+    ) -> Optional[Tuple[int, int]]:
+        """
+        Adds the user's vote for the song at this playlist position, or
+        retracts their earlier vote if it went the other way. Returns the new
+        upvotes and downvotes of the song, or None if nothing changed, which
+        includes voting the same way twice.
+        """
+        async with self.connection("cast_vote") as conn:
+            async with conn.transaction():
+                retracted = await conn.fetchval(
+                    RETRACT_VOTE, playlist_id, user_id, direction
+                )
+                if retracted is not None:
+                    field, delta = f"{retracted}votes", -1
+                elif await conn.fetchval(ADD_VOTE, playlist_id, user_id, direction):
+                    field, delta = f"{direction}votes", 1
+                else:
+                    return None
+                row = await conn.fetchrow(VOTE_UPDATES[field], song_id, delta)
+                await conn.execute(NOTIFY, EVENTS_CHANNEL, "update")
+        return (row[0], row[1]) if row is not None else None
+
+    async def current_vote(self, playlist_id: int, user_id: int) -> Optional[str]:
+        async with self.connection("current_vote") as conn:
+            return cast(
+                Optional[str], await conn.fetchval(CURRENT_VOTE, playlist_id, user_id)
+            )
+
+    async def claim(self, song_id: int, user_id: int) -> bool:
+        async with self.connection("claim") as conn:
+            async with conn.transaction():
+                status = await conn.execute(CLAIM_SONG, song_id, user_id)
+                if cast(str, status) != "UPDATE 1":
+                    return False
+                await conn.execute(NOTIFY, EVENTS_CHANNEL, "update")
+        return True
+
+    async def recent(self, limit: int) -> List[int]:
+        async with self.connection("recent") as conn:
+            rows = await conn.fetch(RECENT_SONGS, limit)
+        return [row[0] for row in reversed(rows)]
+
+    async def player_state(self) -> PlayerStateRecord:
+        async with self.connection("player_state") as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                state = await conn.fetchrow(PLAYER_STATE)
+                queue_ids = [row[0] for row in await conn.fetch(QUEUE_SONG_IDS)]
+                song_ids = [*queue_ids]
+                if state is not None:
+                    song_ids.extend(
+                        song_id for song_id in (state[1], state[3]) if song_id
+                    )
+                rows = await conn.fetch(SONGS_BY_IDS, song_ids)
+
+        songs = {row[0]: song_from_row(row) for row in rows}
+        queue = [songs[song_id] for song_id in queue_ids if song_id in songs]
+        if state is None:
+            return PlayerStateRecord(None, None, None, None, queue)
+        return PlayerStateRecord(
+            state[0], songs.get(state[1]), state[2], songs.get(state[3]), queue
+        )
+
+    async def save_player_state(self, state: PlayerStateRecord) -> None:
+        """
+        Store what is playing now, drop the votes for earlier songs and let
+        all workers know.
+        """
+        current_song_id = state.current_song.id if state.current_song else None
+        next_song_id = state.next_song.id if state.next_song else None
+        async with self.connection("save_player_state") as conn:
+            async with conn.transaction():
+                await conn.execute(
+                    SAVE_PLAYER_STATE,
+                    state.current_song_id,
+                    current_song_id,
+                    state.next_song_id,
+                    next_song_id,
+                )
+                await conn.execute(CLEAR_VOTES, state.current_song_id)
+                await conn.execute(NOTIFY, EVENTS_CHANNEL, "update")
+
+    async def enqueue(self, song_id: int) -> bool:
+        """
+        Add a song to the queue, unless it's already queued or playing.
+        """
+        async with self.connection("enqueue") as conn:
+            async with conn.transaction():
+                if await conn.fetchval(ENQUEUE_SONG, song_id) is None:
+                    return False
+                await conn.execute(NOTIFY, EVENTS_CHANNEL, "queue")
+        return True
+
+    async def queued_songs(self) -> List[SongRecord]:
+        async with self.connection("queued_songs") as conn:
+            async with conn.transaction(isolation="repeatable_read", readonly=True):
+                queue_ids = [row[0] for row in await conn.fetch(QUEUE_SONG_IDS)]
+                rows = await conn.fetch(SONGS_BY_IDS, queue_ids)
+        songs = {row[0]: song_from_row(row) for row in rows}
+        return [songs[song_id] for song_id in queue_ids if song_id in songs]
+
+    async def dequeue(self, song_id: int) -> bool:
+        """
+        Take a song off the queue. Returns False if it wasn't queued (anymore).
+        """
+        async with self.connection("dequeue") as conn:
+            async with conn.transaction():
+                if await conn.fetchval(DEQUEUE_SONG, song_id) is None:
+                    return False
+                await conn.execute(NOTIFY, EVENTS_CHANNEL, "update")
+        return True
+
+    async def upsert_user(self, sub: str, profile: Dict[str, Any]) -> int:
+        async with self.connection("upsert_user") as conn:
+            return cast(int, await conn.fetchval(UPSERT_USER, sub, profile))
+
+    async def quota_spent(self, service: str) -> int:
+        async with self.connection("quota_spent") as conn:
+            return cast(Optional[int], await conn.fetchval(QUOTA_SPENT, service)) or 0
+
+    async def spend_quota(self, service: str, units: int) -> int:
+        """
+        Add to today's spend of the service's quota, returns the total.
+        """
+        async with self.connection("spend_quota") as conn:
+            return cast(int, await conn.fetchval(SPEND_QUOTA, service, units))
+
+    async def spend_quota_within(
+        self, service: str, units: int, limit: int
+    ) -> Optional[int]:
+        """
+        Add to today's spend of the service's quota unless that takes it over
+        `limit`, returns the total or None if nothing was spent. The check
+        and the spend are a single statement, so workers can't overspend
+        together.
+        """
+        async with self.connection("spend_quota") as conn:
+            return cast(
+                Optional[int],
+                await conn.fetchval(SPEND_QUOTA_WITHIN, service, units, limit),
+            )
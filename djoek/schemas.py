@@ -1,9 +1,9 @@
 from decimal import Decimal
-from typing import List, Optional, TypeVar, overload
+from typing import Dict, List, Optional, TypeVar, overload
 
 from pydantic.main import BaseModel
 
-from djoek.models import Song
+from djoek.records import SongRecord
 
 T_ItemSchema = TypeVar("T_ItemSchema", bound="ItemSchema")
 
@@ -12,7 +12,7 @@ class ItemSchema(BaseModel):
     title: str
     duration: Optional[Decimal]
     external_id: str
-    preview_url: str
+    preview_url: Optional[str]
     username: Optional[str]
     upvotes: Optional[int]
     downvotes: Optional[int]
@@ -24,12 +24,12 @@ class ItemSchema(BaseModel):
 
     @classmethod  # noqa: F811
     @overload
-    def from_song(cls, song: Song, *, is_authenticated: bool) -> T_ItemSchema:
+    def from_song(cls, song: SongRecord, *, is_authenticated: bool) -> T_ItemSchema:
         ...
 
     @classmethod  # noqa: F811
     def from_song(
-        cls, song: Optional[Song], *, is_authenticated: bool
+        cls, song: Optional[SongRecord], *, is_authenticated: bool
     ) -> Optional[T_ItemSchema]:
         if song is not None:
             return cls(
@@ -48,6 +48,8 @@ class ItemSchema(BaseModel):
 class StatusSchema(BaseModel):
     current_song: Optional[ItemSchema]
     next_song: Optional[ItemSchema]
+    listeners: int = 0
+    providers: Dict[str, str] = {}
 
 
 class LibraryAddSchema(BaseModel):
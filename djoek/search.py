@@ -0,0 +1,89 @@
+import asyncio
+import logging
+from typing import AsyncIterator, Awaitable, Dict, List, Set
+
+from fastapi.encoders import jsonable_encoder
+
+from djoek import settings
+from djoek.health import Unavailable
+from djoek.prefetch import prefetcher
+from djoek.providers.registry import PROVIDERS
+from djoek.repository import Repository
+from djoek.schemas import ItemSchema
+from djoek.util import dumps
+
+logger = logging.getLogger(__name__)
+
+
+async def search_local(repository: Repository, q: str) -> List[ItemSchema]:
+    songs = await repository.search(q)
+    return [ItemSchema.from_song(song, is_authenticated=True) for song in songs]
+
+
+async def from_library(
+    repository: Repository, items: List[ItemSchema]
+) -> List[ItemSchema]:
+    """
+    Replace provider results that are already in the library by the song in
+    the library, with its votes and owner.
+    """
+    songs = await repository.songs_by_external_ids([item.external_id for item in items])
+    library = {song.external_id: song for song in songs}
+    return [
+        ItemSchema.from_song(library[item.external_id], is_authenticated=True)
+        if item.external_id in library
+        else item
+        for item in items
+    ]
+
+
+def result_line(provider: str, **content: object) -> bytes:
+    return dumps({"provider": provider, **jsonable_encoder(content)}) + b"\n"
+
+
+async def search_all(repository: Repository, q: str) -> AsyncIterator[bytes]:
+    """
+    Search the library and all providers at once, each with its own timeout.
+    Yields an NDJSON line per source as soon as its results are in, without
+    the results that an earlier line already had.
+    """
+    loop = asyncio.get_event_loop()
+    searches: Dict[str, Awaitable[List[ItemSchema]]] = {
+        "local": search_local(repository, q),
+        **{key: provider.search(q) for key, provider in PROVIDERS.items()},
+    }
+    tasks = {
+        loop.create_task(asyncio.wait_for(search, settings.SEARCH_TIMEOUT)): key
+        for key, search in searches.items()
+    }
+    seen: Set[str] = set()
+    try:
+        while tasks:
+            done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                key = tasks.pop(task)
+                try:
+                    items = task.result()
+                    if key != "local":
+                        prefetcher.prefetch(repository, PROVIDERS[key], items)
+                        items = await from_library(repository, items)
+                except asyncio.TimeoutError:
+                    logger.warning("Searching %s timed out", key)
+                    yield result_line(key, error="timeout")
+                    continue
+                except Unavailable:
+                    yield result_line(key, error="unavailable")
+                    continue
+                except asyncio.CancelledError:
+                    raise
+                except Exception:
+                    logger.exception("Searching %s failed", key)
+                    yield result_line(key, error="failed")
+                    continue
+
+                items = [item for item in items if item.external_id not in seen]
+                seen.update(item.external_id for item in items)
+                yield result_line(key, items=items)
+    finally:
+        for task in tasks:
+            task.cancel()
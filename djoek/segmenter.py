@@ -0,0 +1,131 @@
+import asyncio
+import logging
+
+from fastapi import FastAPI
+
+from djoek import settings
+from djoek.media import run_in_executor
+from djoek.relay import StreamRelay
+from djoek.repository import Repository
+
+logger = logging.getLogger(__name__)
+
+PLAYLIST_NAME = "stream.m3u8"
+
+
+def remove_stream() -> None:
+    """
+    Remove the playlist and segments, so clients don't load a stream that is
+    no longer being segmented.
+    """
+    assert settings.HLS_DIR is not None
+    for pattern in (PLAYLIST_NAME, "*.ts", "*.tmp"):
+        for path in settings.HLS_DIR.glob(pattern):
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+
+
+async def setup_segmenter(app: FastAPI) -> None:
+    if not settings.HLS_DIR or not settings.STREAM_URL:
+        return
+    loop = asyncio.get_event_loop()
+    segmenter = Segmenter(app.state.repository, app.state.relay)
+    app.state.segmenter_task = loop.create_task(segmenter.run())
+
+
+async def shutdown_segmenter(app: FastAPI) -> None:
+    if settings.HLS_DIR and settings.STREAM_URL:
+        app.state.segmenter_task.cancel()
+
+
+class Segmenter:
+    """
+    Feeds the relay's stream to ffmpeg, which cuts it into AAC segments with
+    a rolling HLS playlist in `settings.HLS_DIR`. Segments are numbered from
+    the time ffmpeg started, so a name is never reused and segments can be
+    cached forever. Only one worker segments, the one holding the advisory
+    lock.
+    """
+
+    def __init__(self, repository: Repository, relay: StreamRelay) -> None:
+        self.repository = repository
+        self.relay = relay
+
+    async def run(self) -> None:
+        while True:
+            try:
+                async with self.repository.advisory_lock(
+                    settings.HLS_LOCK_ID
+                ) as locked:
+                    if locked:
+                        await self.segment()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Segmenter failed")
+            await asyncio.sleep(settings.PLAYER_ELECTION_INTERVAL)
+
+    async def segment(self) -> None:
+        assert settings.HLS_DIR is not None
+        settings.HLS_DIR.mkdir(parents=True, exist_ok=True)
+        # Left behind by an earlier leader that didn't get to clean up.
+        await run_in_executor(remove_stream)
+        process = await asyncio.create_subprocess_exec(
+            "ffmpeg",
+            "-loglevel",
+            "warning",
+            "-f",
+            "ogg",
+            "-i",
+            "pipe:0",
+            "-vn",
+            "-c:a",
+            "aac",
+            "-b:a",
+            settings.HLS_BITRATE,
+            "-f",
+            "hls",
+            "-hls_time",
+            str(settings.HLS_SEGMENT_DURATION),
+            "-hls_list_size",
+            str(settings.HLS_PLAYLIST_SIZE),
+            "-hls_flags",
+            "delete_segments+temp_file+omit_endlist",
+            "-hls_start_number_source",
+            "epoch",
+            "-hls_segment_filename",
+            str(settings.HLS_DIR / "%d.ts"),
+            str(settings.HLS_DIR / PLAYLIST_NAME),
+            stdin=asyncio.subprocess.PIPE,
+        )
+        feed = asyncio.get_event_loop().create_task(self.feed(process))
+        try:
+            while process.returncode is None:
+                try:
+                    await asyncio.wait_for(
+                        process.wait(), settings.PLAYER_KEEPALIVE_INTERVAL
+                    )
+                except asyncio.TimeoutError:
+                    await self.repository.keep_locks()
+            logger.warning("ffmpeg exited with status %d", process.returncode)
+        finally:
+            feed.cancel()
+            if process.returncode is None:
+                process.kill()
+                await process.wait()
+            await run_in_executor(remove_stream)
+
+    async def feed(self, process: asyncio.subprocess.Process) -> None:
+        stdin = process.stdin
+        assert stdin is not None
+        try:
+            async for chunk in self.relay.listen():
+                stdin.write(chunk)
+                await stdin.drain()
+        except ConnectionError:
+            # ffmpeg went away, segment() notices and cleans up.
+            pass
+        finally:
+            stdin.close()
@@ -16,15 +16,95 @@ SERVE_PLAYER = os.environ.get("DJOEK_SERVE_PLAYER", "false").lower() in (
 USER_FORMAT = os.environ.get("DJOEK_USER_FORMAT") or "{user.sub}"
 
 MPD_HOST = os.environ.get("DJOEK_MPD_HOST", "localhost")
+MPD_PORT = int(os.environ.get("DJOEK_MPD_PORT", "6600"))
 DB_URI = os.environ.get("DJOEK_DB_URI", "postgres:///djoek")
+DB_MIN_CONNECTIONS = int(os.environ.get("DJOEK_DB_MIN_CONNECTIONS", "1"))
+DB_MAX_CONNECTIONS = int(os.environ.get("DJOEK_DB_MAX_CONNECTIONS", "20"))
+# The share of DB_MAX_CONNECTIONS for the asyncpg pool, peewee gets the rest.
+DB_REPOSITORY_CONNECTIONS = int(
+    os.environ.get("DJOEK_DB_REPOSITORY_CONNECTIONS") or DB_MAX_CONNECTIONS // 2 or 1
+)
+DB_CONNECTION_TIMEOUT = float(os.environ.get("DJOEK_DB_CONNECTION_TIMEOUT", "60"))
+DB_POOL_RECYCLE = float(os.environ.get("DJOEK_DB_POOL_RECYCLE", "3600"))
+DB_STATEMENT_TIMEOUT = int(os.environ.get("DJOEK_DB_STATEMENT_TIMEOUT", "10000"))
+PLAYER_LOCK_ID = int(os.environ.get("DJOEK_PLAYER_LOCK_ID", "7260300"))
+PLAYER_ELECTION_INTERVAL = float(os.environ.get("DJOEK_PLAYER_ELECTION_INTERVAL", "5"))
+PLAYER_KEEPALIVE_INTERVAL = float(
+    os.environ.get("DJOEK_PLAYER_KEEPALIVE_INTERVAL", "10")
+)
+STREAM_URL = os.environ.get("DJOEK_STREAM_URL", "")
+STREAM_TIMEOUT = float(os.environ.get("DJOEK_STREAM_TIMEOUT", "30"))
+STREAM_BUFFER_SIZE = int(os.environ.get("DJOEK_STREAM_BUFFER_SIZE", "1048576"))
+STREAM_BURST_SIZE = int(os.environ.get("DJOEK_STREAM_BURST_SIZE", "65536"))
+STREAM_REPORT_INTERVAL = float(os.environ.get("DJOEK_STREAM_REPORT_INTERVAL", "5"))
+HLS_DIR = Path(os.environ["DJOEK_HLS_DIR"]) if os.environ.get("DJOEK_HLS_DIR") else None
+HLS_SEGMENT_DURATION = int(os.environ.get("DJOEK_HLS_SEGMENT_DURATION", "6"))
+HLS_PLAYLIST_SIZE = int(os.environ.get("DJOEK_HLS_PLAYLIST_SIZE", "6"))
+HLS_BITRATE = os.environ.get("DJOEK_HLS_BITRATE", "128k")
+HLS_LOCK_ID = int(os.environ.get("DJOEK_HLS_LOCK_ID", str(PLAYER_LOCK_ID + 1)))
+PROGRESSIVE_URL = os.environ.get("DJOEK_PROGRESSIVE_URL", "")
+PROGRESSIVE_MIN_BYTES = int(os.environ.get("DJOEK_PROGRESSIVE_MIN_BYTES", "131072"))
+PROGRESSIVE_TIMEOUT = float(os.environ.get("DJOEK_PROGRESSIVE_TIMEOUT", "30"))
 MUSIC_DIR = Path(os.environ.get("DJOEK_MUSIC_DIR", "./music"))
+PREFETCH_RESULTS = int(os.environ.get("DJOEK_PREFETCH_RESULTS", "0"))
+PREFETCH_DIR = Path(os.environ.get("DJOEK_PREFETCH_DIR") or MUSIC_DIR / ".prefetch")
+PREFETCH_BUDGET = int(os.environ.get("DJOEK_PREFETCH_BUDGET", "209715200"))
+PREFETCH_TTL = int(os.environ.get("DJOEK_PREFETCH_TTL", "900"))
+PREFETCH_RATE = int(os.environ.get("DJOEK_PREFETCH_RATE", "1048576"))
 STATE_PATH = os.environ.get("DJOEK_STATE_PATH", "djoek.state")
 
 AUTH0_DOMAIN = os.environ.get("DJOEK_AUTH0_DOMAIN", "")
 AUTH0_AUDIENCE = os.environ.get("DJOEK_AUTH0_AUDIENCE", "")
 AUTH0_PARTIES = set(os.environ.get("DJOEK_AUTH0_PARTIES", "").split(","))
+ADMIN_SUBS = set(filter(None, os.environ.get("DJOEK_ADMIN_SUBS", "").split(",")))
 
 REMEMBER_RECENT = int(os.environ.get("DJOEK_REMEMBER_RECENT", "25"))
 
+SEARCH_TIMEOUT = float(os.environ.get("DJOEK_SEARCH_TIMEOUT", "5"))
+BREAKER_THRESHOLD = int(os.environ.get("DJOEK_BREAKER_THRESHOLD", "5"))
+BREAKER_COOLDOWN = float(os.environ.get("DJOEK_BREAKER_COOLDOWN", "30"))
+DOWNLOAD_BACKOFF = float(os.environ.get("DJOEK_DOWNLOAD_BACKOFF", "60"))
+DOWNLOAD_BACKOFF_MAX = float(os.environ.get("DJOEK_DOWNLOAD_BACKOFF_MAX", "3600"))
+DOWNLOAD_BACKOFF_SIZE = int(os.environ.get("DJOEK_DOWNLOAD_BACKOFF_SIZE", "10000"))
+
 GOOGLE_API_KEY = os.environ.get("DJOEK_GOOGLE_API_KEY", "")
+YOUTUBE_QUOTA = int(os.environ.get("DJOEK_YOUTUBE_QUOTA", "10000"))
+YOUTUBE_SEARCH_RESERVE = int(os.environ.get("DJOEK_YOUTUBE_SEARCH_RESERVE", "2000"))
+YOUTUBE_BATCH_WINDOW = float(os.environ.get("DJOEK_YOUTUBE_BATCH_WINDOW", "0.01"))
+YOUTUBE_CACHE_SIZE = int(os.environ.get("DJOEK_YOUTUBE_CACHE_SIZE", "10000"))
+YOUTUBE_CACHE_TTL = int(os.environ.get("DJOEK_YOUTUBE_CACHE_TTL", "86400"))
+YOUTUBE_SEARCH_CACHE_TTL = int(os.environ.get("DJOEK_YOUTUBE_SEARCH_CACHE_TTL", "3600"))
+QUOTA_REFRESH_INTERVAL = float(os.environ.get("DJOEK_QUOTA_REFRESH_INTERVAL", "60"))
 SOUNDCLOUD_CLIENT_ID = os.environ.get("DJOEK_SOUNDCLOUD_CLIENT_ID", "")
+
+LOUDGAIN_WORKERS = int(os.environ.get("DJOEK_LOUDGAIN_WORKERS") or os.cpu_count() or 1)
+LOUDGAIN_BATCH_SIZE = int(os.environ.get("DJOEK_LOUDGAIN_BATCH_SIZE", "25"))
+LOUDGAIN_BATCH_WINDOW = float(os.environ.get("DJOEK_LOUDGAIN_BATCH_WINDOW", "1.0"))
+
+MEDIA_EXECUTOR = os.environ.get("DJOEK_MEDIA_EXECUTOR", "thread")
+MEDIA_WORKERS = int(os.environ.get("DJOEK_MEDIA_WORKERS", "2"))
+DOWNLOAD_WORKERS = int(os.environ.get("DJOEK_DOWNLOAD_WORKERS", "2"))
+DOWNLOAD_WORKER_JOBS = int(os.environ.get("DJOEK_DOWNLOAD_WORKER_JOBS", "25"))
+AUDIO_FORMAT = os.environ.get("DJOEK_AUDIO_FORMAT", "mp3")
+DURATION_SOURCE = os.environ.get("DJOEK_DURATION_SOURCE", "mutagen")
+FPCALC = os.environ.get("DJOEK_FPCALC", "")
+FINGERPRINT_THRESHOLD = float(os.environ.get("DJOEK_FINGERPRINT_THRESHOLD", "0.15"))
+
+STORAGE_BUDGET = int(os.environ.get("DJOEK_STORAGE_BUDGET", "0"))
+STORAGE_LOW_WATERMARK = float(os.environ.get("DJOEK_STORAGE_LOW_WATERMARK", "0.9"))
+STORAGE_GRACE_PERIOD = int(os.environ.get("DJOEK_STORAGE_GRACE_PERIOD", "86400"))
+STORAGE_CHECK_INTERVAL = int(os.environ.get("DJOEK_STORAGE_CHECK_INTERVAL", "600"))
+STORAGE_LOCK_ID = int(os.environ.get("DJOEK_STORAGE_LOCK_ID", str(PLAYER_LOCK_ID + 2)))
+
+MIGRATE_WORKERS = int(os.environ.get("DJOEK_MIGRATE_WORKERS") or os.cpu_count() or 1)
+MIGRATE_BATCH_SIZE = int(os.environ.get("DJOEK_MIGRATE_BATCH_SIZE", "500"))
+
+DIAGNOSTICS = os.environ.get("DJOEK_DIAGNOSTICS", "false").lower() in (
+    "true",
+    "t",
+    "yes",
+    "y",
+    "1",
+)
+SLOW_CALLBACK_DURATION = float(os.environ.get("DJOEK_SLOW_CALLBACK_DURATION", "0.1"))
+LOOP_LAG_INTERVAL = float(os.environ.get("DJOEK_LOOP_LAG_INTERVAL", "0.5"))
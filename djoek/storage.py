@@ -0,0 +1,126 @@
+import asyncio
+import logging
+import os
+import time
+from pathlib import Path
+from typing import Dict, List, Set, Tuple
+
+from fastapi import FastAPI
+from peewee_async import Manager
+
+from djoek import settings
+from djoek.media import run_in_executor
+from djoek.models import Song
+from djoek.mpdclient import MPDClient
+from djoek.player import Player
+from djoek.repository import Repository
+
+logger = logging.getLogger(__name__)
+
+
+async def setup_storage(app: FastAPI) -> None:
+    if not settings.STORAGE_BUDGET:
+        return
+    loop = asyncio.get_event_loop()
+    storage = StorageManager(app.state.manager, app.state.repository, app.state.player)
+    app.state.storage_task = loop.create_task(storage.run())
+
+
+async def shutdown_storage(app: FastAPI) -> None:
+    if settings.STORAGE_BUDGET:
+        app.state.storage_task.cancel()
+
+
+def disk_usage() -> int:
+    inodes: Dict[Tuple[int, int], int] = {}
+    for entry in os.scandir(settings.MUSIC_DIR):
+        if entry.is_file():
+            stat = entry.stat()
+            inodes[(stat.st_dev, stat.st_ino)] = stat.st_size
+    return sum(inodes.values())
+
+
+def evict(paths: List[Path], usage: int, target: float, grace_deadline: float) -> int:
+    """
+    Delete files in order until `usage` is down to `target`. Returns the
+    number of bytes freed.
+    """
+    freed = 0
+    for path in paths:
+        if usage - freed <= target:
+            break
+
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            continue
+
+        # Hard linked duplicates free nothing, recently added songs haven't
+        # had a chance to be played yet.
+        if stat.st_nlink > 1 or stat.st_mtime > grace_deadline:
+            continue
+
+        os.unlink(path)
+        freed += stat.st_size
+    return freed
+
+
+class StorageManager:
+    """
+    Keeps the size of the music directory within `settings.STORAGE_BUDGET` by
+    deleting the files of the coldest, lowest rated songs. The songs stay in
+    the database and are downloaded again in the background when they are
+    queued or picked to play. Only the worker holding the advisory lock
+    evicts at a time.
+    """
+
+    def __init__(
+        self, manager: Manager, repository: Repository, player: Player
+    ) -> None:
+        self.manager = manager
+        self.repository = repository
+        self.player = player
+
+    async def run(self) -> None:
+        while True:
+            try:
+                async with self.repository.advisory_lock(
+                    settings.STORAGE_LOCK_ID
+                ) as locked:
+                    if locked:
+                        await self.enforce()
+            except asyncio.CancelledError:
+                raise
+            except Exception:
+                logger.exception("Failed to enforce storage budget")
+            await asyncio.sleep(settings.STORAGE_CHECK_INTERVAL)
+
+    def protected_ids(self) -> Set[int]:
+        songs = [self.player.current_song, self.player.next_song, *self.player.queue]
+        return {song.id for song in songs if song is not None}
+
+    async def enforce(self) -> None:
+        usage = await run_in_executor(disk_usage)
+        if usage <= settings.STORAGE_BUDGET:
+            return
+
+        target = settings.STORAGE_BUDGET * settings.STORAGE_LOW_WATERMARK
+        logger.info("Music directory uses %d bytes, evicting down to %d", usage, target)
+
+        protected = self.protected_ids()
+        grace_deadline = time.time() - settings.STORAGE_GRACE_PERIOD
+        candidates = await self.manager.execute(
+            Song.select(Song.id, Song.external_id, Song.extension).order_by(
+                Song.upvotes - Song.downvotes, Song.last_played.asc(nulls="FIRST"),
+            )
+        )
+
+        paths = [song.path for song in candidates if song.id not in protected]
+        freed = await run_in_executor(evict, paths, usage, target, grace_deadline)
+
+        if freed:
+            logger.info(
+                "Evicted %d bytes, music directory uses %d bytes", freed, usage - freed
+            )
+            async with MPDClient(settings.MPD_HOST, settings.MPD_PORT) as mpd_client:
+                await mpd_client.execute("update")
@@ -1,13 +1,43 @@
 import asyncio
-from typing import List
+import json
+from typing import Any, List, Type
 
+from fastapi.responses import JSONResponse, ORJSONResponse
 from starlette.websockets import WebSocket
 
+from djoek.metrics import BROADCAST_LATENCY
 
-async def send_updates(ws_clients: List[WebSocket]) -> None:
-    fs = [
-        ws_client.send_json({"action": "EVENT", "event": "update"})
-        for ws_client in ws_clients
-    ]
+try:
+    import orjson
+except ImportError:  # pragma: no cover
+    orjson = None  # type: ignore
+
+
+def dumps(content: Any) -> bytes:
+    """
+    Encode JSON compatible content the way the app's default response
+    class does, with orjson when it is installed.
+    """
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(
+        content, ensure_ascii=False, allow_nan=False, separators=(",", ":")
+    ).encode("utf-8")
+
+
+DefaultResponse: Type[JSONResponse] = (
+    ORJSONResponse if orjson is not None else JSONResponse
+)
+
+UPDATE_EVENT = dumps({"action": "EVENT", "event": "update"}).decode("utf-8")
+
+
+async def broadcast(ws_clients: List[WebSocket], message: str) -> None:
+    fs = [ws_client.send_text(message) for ws_client in ws_clients]
     if fs:
-        await asyncio.gather(*fs)
+        with BROADCAST_LATENCY.time():
+            await asyncio.gather(*fs)
+
+
+async def send_updates(ws_clients: List[WebSocket]) -> None:
+    await broadcast(ws_clients, UPDATE_EVENT)
@@ -0,0 +1,85 @@
+import hashlib
+from typing import TYPE_CHECKING, Any, Callable, Dict, NamedTuple, Tuple
+
+from fastapi.encoders import jsonable_encoder
+from starlette.requests import Request
+from starlette.responses import Response
+from starlette.status import HTTP_304_NOT_MODIFIED
+
+from djoek import health
+from djoek.providers.registry import PROVIDERS
+from djoek.schemas import ItemSchema, StatusSchema
+from djoek.util import dumps
+
+if TYPE_CHECKING:
+    from djoek.player import Player
+
+
+class RenderedView(NamedTuple):
+    body: bytes
+    etag: str
+
+
+def render_status(player: "Player", is_authenticated: bool) -> Any:
+    return StatusSchema(
+        current_song=ItemSchema.from_song(
+            player.current_song, is_authenticated=is_authenticated
+        ),
+        next_song=ItemSchema.from_song(
+            player.next_song, is_authenticated=is_authenticated
+        ),
+        listeners=player.stream_listener_count(),
+        providers={key: health.provider_health(key) for key in PROVIDERS},
+    )
+
+
+def render_playlist(player: "Player", is_authenticated: bool) -> Any:
+    return [
+        ItemSchema.from_song(song, is_authenticated=is_authenticated)
+        for song in player.queue
+    ]
+
+
+RENDERERS: Dict[str, Callable[["Player", bool], Any]] = {
+    "status": render_status,
+    "playlist": render_playlist,
+}
+
+
+class ViewCache:
+    """
+    JSON bodies of the player's views, rendered once per state change instead
+    of once per request. The player invalidates the cache whenever the queue,
+    the current or next song or their votes change, and it is dropped when
+    the health of a provider changes.
+    """
+
+    def __init__(self, player: "Player") -> None:
+        self.player = player
+        self.views: Dict[Tuple[str, bool], RenderedView] = {}
+        self.health_version = health.version
+
+    def invalidate(self) -> None:
+        self.views.clear()
+
+    def get(self, name: str, is_authenticated: bool) -> RenderedView:
+        if self.health_version != health.version:
+            self.health_version = health.version
+            self.invalidate()
+
+        key = (name, is_authenticated)
+        view = self.views.get(key)
+        if view is None:
+            content = RENDERERS[name](self.player, is_authenticated)
+            body = dumps(jsonable_encoder(content))
+            etag = f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+            view = self.views[key] = RenderedView(body, etag)
+        return view
+
+
+def view_response(request: Request, view: RenderedView) -> Response:
+    headers = {"ETag": view.etag, "Cache-Control": "no-cache", "Vary": "Authorization"}
+    if_none_match = request.headers.get("if-none-match", "")
+    if view.etag in (tag.strip() for tag in if_none_match.split(",")):
+        return Response(status_code=HTTP_304_NOT_MODIFIED, headers=headers)
+    return Response(view.body, media_type="application/json", headers=headers)
@@ -1,17 +1,179 @@
 import asyncio
+import json
 import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from contextlib import contextmanager
+from datetime import datetime
+from typing import Any, Callable, Iterator, List, NamedTuple, Optional, Tuple
 
 import mutagen
 import peewee
 from psycopg2.errors import UndefinedColumn, UndefinedTable
-from psycopg2.extensions import parse_dsn
 
 import djoek.settings as settings
-from djoek.models import Song, User, database
+from djoek.models import (
+    PlayerState,
+    QueueEntry,
+    QuotaUsage,
+    SchemaMigration,
+    Song,
+    User,
+    Vote,
+    database,
+    init_database,
+)
 from djoek.mpdclient import MPDClient
 
 
-def migrate_extension() -> None:
+class Migration(NamedTuple):
+    version: int
+    name: str
+    run: Callable[["Migration"], None]
+    # Whether a database from before the migrations were versioned has it.
+    applied: Callable[[], bool]
+    # Schema changes run in a transaction. Data migrations commit a batch at
+    # a time and continue from their checkpoint when interrupted.
+    atomic: bool = True
+
+
+def table_exists(table_name: str) -> bool:
+    try:
+        database.execute_sql(f'SELECT 1 FROM "{table_name}"')
+    except peewee.ProgrammingError as e:
+        if isinstance(e.orig, UndefinedTable):
+            database.rollback()
+            return False
+        else:
+            raise
+    return True
+
+
+def column_exists(column_name: str) -> bool:
+    try:
+        database.execute_sql(f'SELECT "{column_name}" FROM song;')
+    except peewee.ProgrammingError as e:
+        if isinstance(e.orig, UndefinedColumn):
+            database.rollback()
+            return False
+        else:
+            raise
+    return True
+
+
+def get_checkpoint(migration: Migration) -> int:
+    row = SchemaMigration.get_or_none(SchemaMigration.version == migration.version)
+    return row.checkpoint if row is not None and row.checkpoint is not None else 0
+
+
+def save_checkpoint(migration: Migration, song_id: Optional[int]) -> None:
+    SchemaMigration.insert(
+        version=migration.version, name=migration.name, checkpoint=song_id
+    ).on_conflict(
+        conflict_target=[SchemaMigration.version],
+        update={SchemaMigration.checkpoint: song_id},
+    ).execute()
+
+
+def mark_completed(migration: Migration) -> None:
+    SchemaMigration.insert(
+        version=migration.version, name=migration.name, completed=datetime.now()
+    ).on_conflict(
+        conflict_target=[SchemaMigration.version],
+        update={SchemaMigration.completed: datetime.now()},
+    ).execute()
+
+
+def song_batches(migration: Migration, *fields: peewee.Field) -> Iterator[List[Song]]:
+    """
+    The songs in batches of `settings.MIGRATE_BATCH_SIZE`, in id order from
+    the checkpoint of the migration on, with progress reports. Handle each
+    batch within `checkpoint_batch`.
+    """
+    checkpoint = get_checkpoint(migration)
+    total = Song.select().count()
+    done = Song.select().where(Song.id <= checkpoint).count()
+    handled = 0
+    started = time.monotonic()
+    while True:
+        batch = list(
+            Song.select(Song.id, *fields)
+            .where(Song.id > checkpoint)
+            .order_by(Song.id)
+            .limit(settings.MIGRATE_BATCH_SIZE)
+        )
+        if not batch:
+            break
+        yield batch
+        checkpoint = batch[-1].id
+        done += len(batch)
+        handled += len(batch)
+        rate = handled / max(time.monotonic() - started, 0.001)
+        print(f"  {migration.name}: {done}/{total} songs ({rate:.0f}/s)", flush=True)
+
+
+@contextmanager
+def checkpoint_batch(migration: Migration, batch: List[Song]) -> Iterator[None]:
+    """
+    A transaction for the writes of a batch, which also moves the checkpoint
+    past it.
+    """
+    with database.atomic():
+        yield
+        save_checkpoint(migration, batch[-1].id)
+
+
+def update_songs(column: str, cast: str, rows: List[Tuple[int, Any]]) -> None:
+    """
+    Set `column` of many songs in a single statement.
+    """
+    if not rows:
+        return
+    values = ", ".join(["(%s, %s)"] * len(rows))
+    database.execute_sql(
+        f"""
+        UPDATE song SET {column} = v.value::{cast}
+        FROM (VALUES {values}) AS v(id, value)
+        WHERE song.id = v.id
+        """,
+        [value for row in rows for value in row],
+    )
+
+
+def probe_duration(path: str) -> Tuple[Optional[float], Optional[str]]:
+    # Runs in the process pool.
+    try:
+        m = mutagen.File(path)
+        return float(m.info.length), None
+    except Exception as e:
+        return None, str(e)
+
+
+def rename_file(old_path: str, new_path: str) -> None:
+    if os.path.exists(old_path):
+        if not os.path.exists(new_path):
+            os.rename(old_path, new_path)
+        else:
+            os.unlink(old_path)
+
+
+def update_mpd() -> None:
+    async def update() -> None:
+        async with MPDClient(settings.MPD_HOST, settings.MPD_PORT) as client:
+            await client.execute("update")
+
+    asyncio.run(update())
+
+
+def create_user(migration: Migration) -> None:
+    database.create_tables([User])
+
+
+def create_song(migration: Migration) -> None:
+    database.create_tables([Song])
+
+
+def migrate_extension(migration: Migration) -> None:
     database.execute_sql(
         """
         ALTER TABLE song ADD COLUMN extension TEXT;
@@ -20,23 +182,27 @@ def migrate_extension() -> None:
         """
     )
 
-    for song in Song.select(Song.id, Song.external_id, Song.extension):
-        old_path = os.path.join(settings.MUSIC_DIR, f"{song.id}{song.extension}")
-        new_path = os.path.join(settings.MUSIC_DIR, song.filename)
-        if os.path.exists(old_path):
-            if not os.path.exists(new_path):
-                os.rename(old_path, new_path)
-            else:
-                os.unlink(old_path)
 
-    async def update() -> None:
-        async with MPDClient(settings.MPD_HOST) as client:
-            await client.execute("update")
-
-    asyncio.run(update())
+def migrate_extension_files(migration: Migration) -> None:
+    # Files used to be named after the song id.
+    with ThreadPoolExecutor(settings.MIGRATE_WORKERS) as pool:
+        for batch in song_batches(migration, Song.external_id, Song.extension):
+            list(
+                pool.map(
+                    rename_file,
+                    [
+                        os.path.join(settings.MUSIC_DIR, f"{song.id}{song.extension}")
+                        for song in batch
+                    ],
+                    [os.path.join(settings.MUSIC_DIR, song.filename) for song in batch],
+                )
+            )
+            with checkpoint_batch(migration, batch):
+                pass
+    update_mpd()
 
 
-def migrate_preview_url() -> None:
+def migrate_preview_url(migration: Migration) -> None:
     database.execute_sql(
         """
         ALTER TABLE song ADD COLUMN preview_url TEXT;
@@ -47,47 +213,33 @@ def migrate_preview_url() -> None:
     )
 
 
-def migrate_duration() -> None:
+def migrate_duration(migration: Migration) -> None:
     database.execute_sql(
         """
         ALTER TABLE song ADD COLUMN duration NUMERIC(10, 5)
         """
     )
-    for song in Song.select(Song.id, Song.external_id, Song.extension):
-        path = os.path.join(settings.MUSIC_DIR, song.filename)
-        try:
-            m = mutagen.File(path)
-            song.duration = m.info.length
-            song.save(only={"duration"})
-        except Exception as e:
-            print(f"Skipping {song.title} ({e})")
 
 
-def table_exists(table_name: str) -> bool:
-    try:
-        database.execute_sql(f'SELECT 1 FROM "{table_name}"')
-    except peewee.ProgrammingError as e:
-        if isinstance(e.orig, UndefinedTable):
-            database.rollback()
-            return False
-        else:
-            raise
-    return True
-
-
-def column_exists(column_name: str) -> bool:
-    try:
-        database.execute_sql(f'SELECT "{column_name}" FROM song;')
-    except peewee.ProgrammingError as e:
-        if isinstance(e.orig, UndefinedColumn):
-            database.rollback()
-            return False
-        else:
-            raise
-    return True
+def migrate_duration_files(migration: Migration) -> None:
+    with ProcessPoolExecutor(settings.MIGRATE_WORKERS) as pool:
+        for batch in song_batches(
+            migration, Song.title, Song.external_id, Song.extension
+        ):
+            paths = [os.path.join(settings.MUSIC_DIR, song.filename) for song in batch]
+            rows = []
+            for song, (duration, error) in zip(
+                batch, pool.map(probe_duration, paths, chunksize=16)
+            ):
+                if duration is None:
+                    print(f"Skipping {song.title} ({error})")
+                else:
+                    rows.append((song.id, duration))
+            with checkpoint_batch(migration, batch):
+                update_songs("duration", "numeric", rows)
 
 
-def migrate_submitter() -> None:
+def migrate_submitter(migration: Migration) -> None:
     database.execute_sql(
         """
         ALTER TABLE song ADD COLUMN user_id INTEGER REFERENCES "user"(id) ON DELETE SET NULL;
@@ -95,7 +247,7 @@ def migrate_submitter() -> None:
     )
 
 
-def migrate_rating() -> None:
+def migrate_rating(migration: Migration) -> None:
     database.execute_sql(
         """
         ALTER TABLE song ADD COLUMN upvotes INTEGER DEFAULT 0;
@@ -107,27 +259,136 @@ def migrate_rating() -> None:
     )
 
 
-if __name__ == "__main__":
-    db_config = parse_dsn(settings.DB_URI)
-    database.init(db_config.pop("dbname"), **db_config)
+def migrate_content_hash(migration: Migration) -> None:
+    database.execute_sql(
+        """
+        ALTER TABLE song ADD COLUMN content_hash TEXT;
+        ALTER TABLE song ADD COLUMN fingerprint TEXT;
+        CREATE INDEX song_content_hash ON song (content_hash);
+        """
+    )
+
 
-    if not table_exists("user"):
-        database.create_tables([User])
+def migrate_last_played(migration: Migration) -> None:
+    database.execute_sql(
+        """
+        ALTER TABLE song ADD COLUMN last_played TIMESTAMP;
+        """
+    )
 
-    if not table_exists("song"):
-        database.create_tables([Song])
 
-    if not column_exists("extension"):
-        migrate_extension()
+def migrate_player_state(migration: Migration) -> None:
+    database.create_tables([QueueEntry, PlayerState, Vote])
 
-    if not column_exists("preview_url"):
-        migrate_preview_url()
+    # The queue used to be kept in a state file by the player.
+    if settings.STATE_PATH and os.path.exists(settings.STATE_PATH):
+        with open(settings.STATE_PATH) as f:
+            queue_ids = json.load(f).get("queue", [])
+        song_ids = {
+            song.id for song in Song.select(Song.id).where(Song.id.in_(queue_ids))
+        }
+        QueueEntry.insert_many(
+            [{"song": song_id} for song_id in queue_ids if song_id in song_ids]
+        ).execute()
 
-    if not column_exists("duration"):
-        migrate_duration()
 
-    if not column_exists("user_id"):
-        migrate_submitter()
+def migrate_quota_usage(migration: Migration) -> None:
+    database.create_tables([QuotaUsage])
 
-    if not column_exists("upvotes"):
-        migrate_rating()
+
+def migrate_raw_fingerprint(migration: Migration) -> None:
+    # Fingerprints are compared by similarity now, which needs them raw.
+    database.execute_sql(
+        """
+        DROP INDEX IF EXISTS song_fingerprint;
+        UPDATE song SET fingerprint = NULL WHERE fingerprint !~ '^[0-9,]+$';
+        """
+    )
+
+
+MIGRATIONS = [
+    Migration(1, "user", create_user, lambda: table_exists("user")),
+    Migration(2, "song", create_song, lambda: table_exists("song")),
+    Migration(3, "extension", migrate_extension, lambda: column_exists("extension")),
+    Migration(
+        4,
+        "extension files",
+        migrate_extension_files,
+        lambda: column_exists("extension"),
+        atomic=False,
+    ),
+    Migration(
+        5, "preview_url", migrate_preview_url, lambda: column_exists("preview_url")
+    ),
+    Migration(6, "duration", migrate_duration, lambda: column_exists("duration")),
+    Migration(
+        7,
+        "duration files",
+        migrate_duration_files,
+        lambda: column_exists("duration"),
+        atomic=False,
+    ),
+    Migration(8, "submitter", migrate_submitter, lambda: column_exists("user_id")),
+    Migration(9, "rating", migrate_rating, lambda: column_exists("upvotes")),
+    Migration(
+        10, "content_hash", migrate_content_hash, lambda: column_exists("content_hash")
+    ),
+    Migration(
+        11, "last_played", migrate_last_played, lambda: column_exists("last_played")
+    ),
+    Migration(
+        12, "player_state", migrate_player_state, lambda: table_exists("queue_entry")
+    ),
+    Migration(
+        13, "quota_usage", migrate_quota_usage, lambda: table_exists("quota_usage")
+    ),
+    Migration(14, "raw_fingerprint", migrate_raw_fingerprint, lambda: False),
+]
+
+
+def bootstrap() -> None:
+    """
+    Start keeping track of migrations. A new database gets the current
+    schema right away, one from before versioning gets the migrations it
+    already has marked as done.
+    """
+    new = not table_exists("song")
+    with database.atomic():
+        database.create_tables([SchemaMigration])
+        if new:
+            database.create_tables(
+                [User, Song, QueueEntry, PlayerState, Vote, QuotaUsage]
+            )
+    for migration in MIGRATIONS:
+        if new or migration.applied():
+            mark_completed(migration)
+
+
+def migrate() -> None:
+    if not table_exists("schema_migration"):
+        bootstrap()
+
+    completed = {
+        row.version
+        for row in SchemaMigration.select().where(
+            SchemaMigration.completed.is_null(False)
+        )
+    }
+    for migration in MIGRATIONS:
+        if migration.version in completed:
+            continue
+        print(f"Migrating to {migration.version}: {migration.name}", flush=True)
+        started = time.monotonic()
+        if migration.atomic:
+            with database.atomic():
+                migration.run(migration)
+                mark_completed(migration)
+        else:
+            migration.run(migration)
+            mark_completed(migration)
+        print(f"  done in {time.monotonic() - started:.1f}s", flush=True)
+
+
+if __name__ == "__main__":
+    init_database()
+    migrate()
@@ -7,23 +7,70 @@ document.addEventListener('DOMContentLoaded', (event) => {
   const control = document.getElementById('play');
   const currentSong = document.getElementById('current-song');
   const nextSong = document.getElementById('next-song');
+  const hlsUrl = '/hls/stream.m3u8';
+  const maxPlaylistAge = 30000;
   let failed = false;
+  let hls = null;
+
+  // The playlist is rewritten for every segment, one that hasn't been for a
+  // while is left behind by a segmenter that stopped. Both times come from
+  // the server, so the client's clock doesn't matter.
+  function isLive(r) {
+    const modified = Date.parse(r.headers.get('Last-Modified'));
+    const now = Date.parse(r.headers.get('Date'));
+    return r.ok && !(now - modified > maxPlaylistAge);
+  }
+
+  function loadOgg() {
+    player.src = '/mpd.ogg?' + Date.now();
+  }
+
+  // Prefer the segmented stream, it can be cached and recovers from network
+  // hiccups. Fall back to the continuous Ogg stream.
+  function load() {
+    return fetch(hlsUrl, { method: 'HEAD', cache: 'no-store' })
+      .then(isLive, () => false)
+      .then((hasHls) => {
+        if (hasHls && player.canPlayType('application/vnd.apple.mpegurl')) {
+          player.src = hlsUrl;
+        } else if (hasHls && window.Hls && Hls.isSupported()) {
+          hls = new Hls();
+          hls.on(Hls.Events.ERROR, (event, data) => {
+            if (data.fatal && hls !== null) {
+              // The segmenter went away while playing.
+              hls.destroy();
+              hls = null;
+              loadOgg();
+              player.play();
+            }
+          });
+          hls.loadSource(hlsUrl);
+          hls.attachMedia(player);
+        } else {
+          loadOgg();
+        }
+      });
+  }
 
   function toggle() {
     if (player.paused) {
       localStorage.setItem('state', 'play');
-      player.src = '/mpd.ogg?' + Date.now();
-      setTimeout(() => {
+      load().then(() => {
         failed = false;
         player.play().catch(() => {
           failed = true;
           control.textContent = playText;
         });
         player.muted = true;
-      }, 0);
+      });
     } else {
       localStorage.setItem('state', 'pause');
       player.pause();
+      if (hls !== null) {
+        // Start at the live edge again when resuming.
+        hls.destroy();
+        hls = null;
+      }
     }
   }
 